@@ -1,31 +1,334 @@
-from django.contrib import admin
+import json
+import logging
+from functools import reduce
+
+from django.conf.urls import patterns, url
+from django.contrib import admin, messages
 from django.core.exceptions import PermissionDenied
-from django.utils.translation import ugettext_lazy as _
+from django.core.urlresolvers import reverse
+from django.db.models import Count, Q
+from django.forms.models import BaseInlineFormSet
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
+from django.shortcuts import get_object_or_404, redirect
+from django.template.response import TemplateResponse
+from django.utils.html import format_html, format_html_join
+from django.utils.translation import ugettext, ugettext_lazy as _
 from orderedmodel.admin import OrderedStackedInline
 from orderedmodel.mptt_admin import OrderedMPTTModelAdmin
 
+from cmsplugin_media_center.conf import settings
 from cmsplugin_media_center.models import Picture, PictureCategory
+from cmsplugin_media_center.thumbnails import thumbnail_urls
 from cmsplugin_media_center.utils.admin import ActionsForObjectAdmin
+from cmsplugin_media_center.utils.db import chunks
+
+
+logger = logging.getLogger(__name__)
+
+
+# Pictures edited on one page of the change form of a category
+PICTURES_PER_PAGE = 25
+
+
+def pictures_page(request):
+    try:
+        return max(int(request.GET.get('pictures_page', 1)), 1)
+    except ValueError:
+        return 1
+
+
+class PicturePageFormSet(BaseInlineFormSet):
+    """
+    Forms for one page of the pictures of the category, the page is the
+    ?pictures_page=<n> of the change form, which is posted back with it
+    """
+    page = 1
+
+    def get_queryset(self):
+        if not hasattr(self, '_page_queryset'):
+            queryset = super(PicturePageFormSet, self).get_queryset().select_related('image')
+            start = (self.page - 1) * PICTURES_PER_PAGE
+            self._page_queryset = queryset[start:start + PICTURES_PER_PAGE]
+            set_near_duplicates(self._page_queryset)
+        return self._page_queryset
+
+
+def set_near_duplicates(pictures):
+    """
+    Loads the near duplicates of the pictures for PictureInline.duplicates in one query
+    """
+    pictures = [picture for picture in pictures if picture.phash is not None]
+    found = Picture.objects.near_duplicates_in_bulk(set(picture.phash_value for picture in pictures))
+    for picture in pictures:
+        picture._near_duplicates = [duplicate for duplicate in found[picture.phash_value] if duplicate.pk != picture.pk]
 
 
 class PictureInline(OrderedStackedInline):
     model = Picture
+    formset = PicturePageFormSet
     extra = 1
+    readonly_fields = ('preview', 'duplicates')
+
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super(PictureInline, self).get_formset(request, obj, **kwargs)
+        formset.page = pictures_page(request)
+        return formset
+
+    def preview(self, obj):
+        if not obj.pk:
+            return '-'
+        # Loaded by the browser when it is scrolled into view, the thumbnail is made then
+        return format_html('<img src="{0}" loading="lazy" alt="">', reverse(
+            'admin:cmsplugin_media_center_picturecategory_thumbnail', args=(obj.pk,)))
+    preview.short_description = _('Preview')
+    preview.allow_tags = True
+
+    def duplicates(self, obj):
+        pictures = getattr(obj, '_near_duplicates', None)
+        if pictures is None:
+            pictures = obj.near_duplicates() if obj.pk else []
+        return format_html_join(', ', '<a href="{0}">{1}</a> ({2})', (
+            (reverse('admin:cmsplugin_media_center_picturecategory_change', args=(picture.folder_id,)),
+             picture, picture.folder) for picture in pictures)) or '-'
+    duplicates.short_description = _('Near duplicates')
+    duplicates.allow_tags = True
+
+
+def split_pks(value):
+    return [int(pk) for pk in value.split(',') if pk]
+
+
+def set_ancestors(categories):
+    """
+    Loads the ancestors of the categories in one query per 100 of them
+    """
+    for chunk in chunks(categories, 100):
+        ancestors = sorted(PictureCategory.objects.filter(reduce(lambda x, y: x | y, (
+            Q(tree_id=c.tree_id, lft__lt=c.lft, rght__gt=c.rght) for c in chunk))).values_list(
+            'tree_id', 'lft', 'rght', 'pk', 'title'))
+        for category in chunk:
+            category._ancestors = [(pk, title) for tree_id, lft, rght, pk, title in ancestors
+                                   if tree_id == category.tree_id and lft < category.lft and rght > category.rght]
+
+
+class LazyTreeChangeList(object):
+    """
+    Mixed into the changelist of the categories with MEDIA_CENTER_ADMIN_LAZY_TREE:
+    only the roots are listed and their children are loaded when they are expanded.
+    A search lists the matches with the path to them.
+    """
+    def get_query_set(self, request):
+        queryset = super(LazyTreeChangeList, self).get_query_set(request)
+        if not self.query:
+            queryset = queryset.filter(parent=None)
+        return queryset.annotate(picture_count=Count('pictures'))
+
+    def get_results(self, request):
+        super(LazyTreeChangeList, self).get_results(request)
+        if self.query:
+            set_ancestors(self.result_list)
 
 
 class PictureCategoryAdmin(OrderedMPTTModelAdmin, ActionsForObjectAdmin):
     prepopulated_fields = {'slug': ('title', )}
     inlines = [PictureInline]
     list_display = ('title', 'is_visible', 'is_published')
+    # The tree toggle comes first with MEDIA_CENTER_ADMIN_LAZY_TREE
+    list_display_links = ('title',)
+    search_fields = ('title', 'slug')
     fields = ('parent', 'title', 'description', 'slug', 'is_published', 'is_visible')
     readonly_fields = ('is_visible', 'is_published')
 
+    class Media:
+        js = ('cmsplugin_media_center/admin/lazy_tree.js',)
+
+    def changelist_view(self, request, extra_context=None):
+        if 'expand' in request.GET:
+            # Read by the tree script, the changelist would take it for a filter
+            request.GET = request.GET.copy()
+            del request.GET['expand']
+        return super(PictureCategoryAdmin, self).changelist_view(request, extra_context)
+
+    def get_changelist(self, request, **kwargs):
+        changelist = super(PictureCategoryAdmin, self).get_changelist(request, **kwargs)
+        if settings.ADMIN_LAZY_TREE:
+            changelist = type('LazyTreeChangeList', (LazyTreeChangeList, changelist), {})
+        return changelist
+
+    def get_list_display(self, request):
+        list_display = super(PictureCategoryAdmin, self).get_list_display(request)
+        if settings.ADMIN_LAZY_TREE:
+            list_display = ('tree_toggle',) + tuple(list_display) + ('pictures', 'tree_path')
+        return list_display
+
+    def tree_toggle(self, obj):
+        if obj.rght - obj.lft == 1:
+            return ''
+        return format_html('<a href="#" class="media-center-tree-toggle" data-id="{0}" data-url="{1}">+</a>',
+                           obj.pk, reverse('admin:cmsplugin_media_center_picturecategory_tree'))
+    tree_toggle.short_description = ''
+    tree_toggle.allow_tags = True
+
+    def pictures(self, obj):
+        return obj.picture_count
+    pictures.short_description = _('Pictures')
+    pictures.admin_order_field = 'picture_count'
+
+    def tree_path(self, obj):
+        ancestors = getattr(obj, '_ancestors', None)
+        if ancestors is None:
+            return ''
+        path = ' / '.join([title for pk, title in ancestors] + [obj.title])
+        # Opens the tree down to the category
+        return format_html('<a href="?expand={0}">{1}</a>', obj.pk, path)
+    tree_path.short_description = _('Path')
+    tree_path.allow_tags = True
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.module_name
+        return patterns(
+            '',
+            url(r'^tree/$', self.admin_site.admin_view(self.tree_view), name='%s_%s_tree' % info),
+            url(r'^picture/(\d+)/thumbnail/$', self.admin_site.admin_view(self.thumbnail_view),
+                name='%s_%s_thumbnail' % info),
+            url(r'^reorder/$', self.admin_site.admin_view(self.reorder_view), name='%s_%s_reorder_roots' % info),
+            url(r'^(\d+)/reorder/$', self.admin_site.admin_view(self.reorder_view), name='%s_%s_reorder' % info),
+        ) + super(PictureCategoryAdmin, self).get_urls()
+
+    def reorder_view(self, request, object_id=None):
+        """
+        Drag and drop ordering of the subcategories and the pictures of a
+        category, or of the root categories. The complete new orders are posted
+        as comma separated pks and each is applied with one UPDATE.
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        category = get_object_or_404(PictureCategory, pk=object_id) if object_id is not None else None
+        if request.method == 'POST':
+            try:
+                if 'categories' in request.POST:
+                    PictureCategory.objects.reorder(category, split_pks(request.POST['categories']))
+                if 'pictures' in request.POST and category is not None:
+                    Picture.objects.reorder(category, split_pks(request.POST['pictures']))
+            except ValueError:
+                return HttpResponseBadRequest()
+            if request.is_ajax():
+                return HttpResponse(status=204)
+            self.message_user(request, ugettext('The new order was saved.'))
+            return redirect(request.path)
+        opts = self.model._meta
+        return TemplateResponse(request, 'admin/cmsplugin_media_center/reorder.html', {
+            'title': ugettext('Reorder %s') % (category or opts.verbose_name_plural),
+            'opts': opts,
+            'app_label': opts.app_label,
+            'category': category,
+            'children': PictureCategory.objects.filter(parent=category).order_by('tree_id', 'lft').values_list(
+                'pk', 'title'),
+            'pictures': category.pictures.values_list('pk', 'title') if category is not None else [],
+        }, current_app=self.admin_site.name)
+
+    def thumbnail_view(self, request, picture_id):
+        """
+        Redirects to the thumbnail of a picture, for the previews of the picture inline
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        try:
+            picture = Picture.objects.select_related('image').get(pk=picture_id)
+        except Picture.DoesNotExist:
+            raise Http404
+        if picture.image is None:
+            raise Http404
+        for extension, scale, url in thumbnail_urls(picture.image):
+            if extension is None and scale == 1:
+                return redirect(url)
+        raise Http404
+
+    def tree_view(self, request):
+        """
+        JSON for the lazy tree: ?parent=<pk> gives the children of a category,
+        ?ancestors=<pk> the pks of the ancestors of a category, root first
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        try:
+            if 'ancestors' in request.GET:
+                category = PictureCategory.objects.get(pk=int(request.GET['ancestors']))
+                data = {'ancestors': list(category.get_ancestors().values_list('pk', flat=True))}
+            else:
+                children = PictureCategory.objects.filter(parent=int(request.GET['parent']))
+                data = {'children': [self.tree_node(child) for child in children.annotate(
+                    picture_count=Count('pictures')).order_by('lft')]}
+        except (KeyError, ValueError, PictureCategory.DoesNotExist):
+            return HttpResponseBadRequest()
+        return HttpResponse(json.dumps(data), content_type='application/json')
+
+    def tree_node(self, category):
+        return {
+            'id': category.pk,
+            'title': category.title,
+            'url': reverse('admin:cmsplugin_media_center_picturecategory_change', args=(category.pk,)),
+            'level': category.level,
+            'has_children': category.rght - category.lft > 1,
+            'pictures': category.picture_count,
+            'status': ', '.join([
+                ugettext('visible') if category.is_visible else ugettext('hidden'),
+                ugettext('published') if category.is_published else ugettext('not published'),
+            ]),
+        }
+
     def change_view(self, request, object_id, form_url='', extra_context=None):
         return super(PictureCategoryAdmin, self).change_view(
             request,
             object_id,
             form_url='',
-            extra_context={'has_publish_permission': request.user.has_perm('cmsplugin_media_center.publish_permission')})
+            extra_context={
+                'has_publish_permission': request.user.has_perm('cmsplugin_media_center.publish_permission'),
+            })
+
+    def render_change_form(self, request, context, add=False, change=False, form_url='', obj=None):
+        if obj is not None:
+            # The links keep the rest of the query string, like _changelist_filters and _popup
+            query = request.GET.copy()
+            pages = (Picture.objects.filter(folder=obj).count() + PICTURES_PER_PAGE - 1) // PICTURES_PER_PAGE
+            links = []
+            for page in range(1, pages + 1) if pages > 1 else []:
+                query['pictures_page'] = page
+                links.append((page, query.urlencode()))
+            context.update({
+                'pictures_page': pictures_page(request),
+                'pictures_pages': links,
+            })
+        return super(PictureCategoryAdmin, self).render_change_form(request, context, add, change, form_url, obj)
+
+    def response_change(self, request, obj):
+        response = super(PictureCategoryAdmin, self).response_change(request, obj)
+        # Continue editing on the same page of pictures
+        if '_continue' in request.POST and 'pictures_page' in request.GET:
+            response['Location'] += '%spictures_page=%d' % (
+                '&' if '?' in response['Location'] else '?', pictures_page(request))
+        return response
+
+    def save_formset(self, request, form, formset, change):
+        super(PictureCategoryAdmin, self).save_formset(request, form, formset, change)
+        if formset.model is not Picture:
+            return
+        for picture_form in formset.forms:
+            picture = picture_form.instance
+            if picture.pk is None or 'image' not in picture_form.changed_data:
+                continue
+            try:
+                picture.update_phash()
+            except Exception:
+                # media_center_extract_metadata will try again
+                logger.exception('Can not hash the image of picture %s', picture.pk)
+                continue
+            duplicates = picture.near_duplicates()
+            if duplicates:
+                self.message_user(request, _('%(picture)s looks like a copy of %(duplicates)s.') % {
+                    'picture': picture,
+                    'duplicates': ', '.join('%s (%s)' % (duplicate, duplicate.folder) for duplicate in duplicates),
+                }, level=messages.WARNING)
 
     def make_published(self, request, queryset):
         if request.user.has_perm('cmsplugin_media_center.publish_permission'):
@@ -1,10 +1,21 @@
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Q
 from django.http import Http404
+from django.template.loader import get_template
 from django.utils.translation import ugettext_lazy as _
 
 from cms.plugin_base import CMSPluginBase
 from cms.plugin_pool import plugin_pool
 
-from cmsplugin_media_center.models import PictureCategory, MediaPlugin
+from cmsplugin_media_center import counters, instrumentation, metrics
+from cmsplugin_media_center.conf import settings
+from cmsplugin_media_center.instrumentation import span
+from cmsplugin_media_center.models import (
+    Picture, PictureCategory, MediaPlugin, PublishedCategory, PublishedPicture, ThumbnailURL)
+
+
+# Categories and pictures on a page of search results
+SEARCH_RESULTS = 20
 
 
 class CMSMediaPlugin(CMSPluginBase):
@@ -17,27 +28,154 @@ class CMSMediaPlugin(CMSPluginBase):
         category = None
         template = instance.template
 
-        if 'category' in context:
-            try:
-                category = PictureCategory.objects.get_visible(slug=context['category'])
-            except PictureCategory.DoesNotExist:
-                raise Http404
+        if 'search_query' in context:
+            return self.render_search(context, instance)
+        if 'picture' in context:
+            return self.render_picture(context, instance)
+
+        with span('render', skin=template):
+            if 'category' in context:
+                try:
+                    with span('get_visible'):
+                        category = get_category(context['category'])
+                except ObjectDoesNotExist:
+                    metrics.inc('media_center_not_found_total')
+                    raise Http404
+                counters.count('category', category.pk)
+
+                photo_list = list(pictures_queryset(category, instance.ordering))
+                context.update({
+                    'category': category,
+                    'photo_list': photo_list,
+                })
 
-            context.update({
-                'category': category,
-                'photo_list': category.pictures.all(),
-            })
+            with span('category_list', skin=template):
+                context['category_list'] = categories_queryset(
+                    template=template, category=category, ordering=instance.ordering)
+
+            with span('thumbnail_urls'):
+                images = [photo.image for photo in context.get('photo_list', [])]
+                if template != 'list':
+                    images.extend(node.get_cover().image for node in context['category_list'] if node.get_cover())
+                # One query for the thumbnails of the whole page instead of storage calls per picture
+                context['thumbnail_urls'] = ThumbnailURL.objects.for_images(images)
 
-        context['category_list'] = categories_queryset(template=template, category=category)
         self.render_template = 'cmsplugin_media_center/templates/pictures/{}.html'.format(template)
+        if instrumentation.enabled():
+            # The querysets are evaluated and the thumbnails generated while rendering the template
+            self.render_template = instrumentation.TimedTemplate(
+                get_template(self.render_template), 'template', skin=template)
+        return context
+
+    def render_search(self, context, instance):
+        query = context['search_query']
+        try:
+            page = max(int(context['request'].GET.get('page', 1)), 1)
+        except (KeyError, ValueError):
+            page = 1
+        offset = (page - 1) * SEARCH_RESULTS
+        with span('search'):
+            # One more result than shown tells whether there is a next page
+            category_list = list(PictureCategory.objects.search(query, offset, SEARCH_RESULTS + 1))
+            photo_list = list(Picture.objects.search(query, offset, SEARCH_RESULTS + 1).select_related('image', 'folder'))
+            thumbnail_urls = ThumbnailURL.objects.for_images([photo.image for photo in photo_list])
+        context.update({
+            'search_query': query,
+            'category_list': category_list[:SEARCH_RESULTS],
+            'photo_list': photo_list[:SEARCH_RESULTS],
+            'thumbnail_urls': thumbnail_urls,
+            'page': page,
+            'has_next': len(category_list) > SEARCH_RESULTS or len(photo_list) > SEARCH_RESULTS,
+        })
+        self.render_template = 'cmsplugin_media_center/templates/pictures/search.html'
+        return context
+
+    def render_picture(self, context, instance):
+        with span('render', skin='picture'):
+            try:
+                with span('get_visible'):
+                    category = get_category(context['category'])
+                pictures = pictures_queryset(category, instance.ordering)
+                picture = pictures.get(pk=context['picture'])
+            except ObjectDoesNotExist:
+                metrics.inc('media_center_not_found_total')
+                raise Http404
+            counters.count('picture', picture.pk)
+            previous, next = adjacent_pictures(pictures, picture, instance.ordering)
+        context.update({
+            'category': category,
+            'picture': picture,
+            'previous': previous,
+            'next': next,
+        })
+        self.render_template = 'cmsplugin_media_center/templates/pictures/picture.html'
         return context
 
 plugin_pool.register_plugin(CMSMediaPlugin)
 
 
-def categories_queryset(template, category=None):
+def get_category(slug):
+    """
+    The shown category with the slug, from the published tables with MEDIA_CENTER_PUBLISHED_READS
+    """
+    if settings.PUBLISHED_READS:
+        return PublishedCategory.objects.get(slug=slug)
+    return PictureCategory.objects.get_shown(slug)
+
+
+def pictures_queryset(category, ordering='tree'):
+    if settings.PUBLISHED_READS:
+        pictures = PublishedPicture.objects.filter(category_id=category.pk).order_by('order', 'pk')
+    else:
+        pictures = category.pictures.all()
+    if ordering == 'popular':
+        pictures = pictures.order_by('-views', 'pk')
+    return pictures.select_related('image')
+
+
+def adjacent_pictures(pictures, picture, ordering='tree'):
+    """
+    The pictures before and after picture in pictures (ordered by pictures_queryset),
+    None at the ends. Each is one query on the index of the ordering, never an OFFSET.
+    """
+    field = 'views' if ordering == 'popular' else 'order'
+    value = getattr(picture, field)
+    # Popular is by descending views, the pk breaks the ties in both orderings
+    later, earlier = ('lt', 'gt') if ordering == 'popular' else ('gt', 'lt')
+    following = pictures.filter(Q(**{'%s__%s' % (field, later): value}) | Q(**{field: value, 'pk__gt': picture.pk}))
+    preceding = pictures.filter(Q(**{'%s__%s' % (field, earlier): value}) | Q(**{field: value, 'pk__lt': picture.pk}))
+    descending = '-%s' % field
+    following = list(following.order_by(descending if ordering == 'popular' else field, 'pk')[:1])
+    preceding = list(preceding.order_by(field if ordering == 'popular' else descending, '-pk')[:1])
+    return preceding[0] if preceding else None, following[0] if following else None
+
+
+def categories_queryset(template, category=None, ordering='tree'):
+    if settings.PUBLISHED_READS:
+        return published_categories(template, category, ordering)
     if template == 'list':
+        # recursetree needs the tree order
         return PictureCategory.objects.whole_tree()
     else:
         from_node, depth = category, 0 if category is None else 1
-        return PictureCategory.objects.show_subtree(from_node=from_node, depth=depth)
+        categories = PictureCategory.objects.show_subtree(from_node=from_node, depth=depth)
+        if ordering == 'popular':
+            categories = categories.order_by('-views', 'tree_id', 'lft')
+        # The thumbnail view shows the cover of every category
+        return Picture.objects.set_covers(list(categories))
+
+
+def published_categories(template, category=None, ordering='tree'):
+    """
+    Like categories_queryset, from the published tables where every row is a shown category
+    """
+    if template == 'list':
+        return PublishedCategory.objects.all()
+    if category is None:
+        categories = PublishedCategory.objects.filter(parent_id=None)
+    else:
+        categories = PublishedCategory.objects.filter(Q(pk=category.pk) | Q(parent_id=category.pk))
+    if ordering == 'popular':
+        categories = categories.order_by('-views', 'tree_id', 'lft')
+    # The thumbnail view shows the cover of every category
+    return PublishedPicture.objects.set_covers(list(categories))
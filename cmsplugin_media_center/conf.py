@@ -0,0 +1,60 @@
+from django.conf import settings as django_settings
+
+
+DEFAULTS = {
+    # Database alias used by the public read paths, None keeps them on the primary
+    'READ_DATABASE': None,
+    # Database alias of the primary, all writes and visibility recomputes go there
+    'WRITE_DATABASE': 'default',
+    # Seconds after a write during which the same client keeps reading from the primary
+    'READ_YOUR_WRITES': 0,
+    # 'sync' recomputes visibility on every save, 'deferred' leaves it to media_center_worker
+    'VISIBILITY_UPDATES': 'sync',
+    # Time the rendering and the visibility cascade, see cmsplugin_media_center.instrumentation
+    'INSTRUMENTATION': False,
+    # Keep counters and histograms for the Prometheus endpoint, see cmsplugin_media_center.metrics
+    'METRICS': False,
+    # Directory shared by all worker processes, their metrics are added up
+    'METRICS_DIR': None,
+    # Seconds between two writes of the metrics of a process to METRICS_DIR, by a thread of the process
+    'METRICS_FLUSH_INTERVAL': 1,
+    # Formats offered next to the JPEG/PNG thumbnails, 'avif' needs a Pillow with AVIF support
+    'THUMBNAIL_FORMATS': ('webp',),
+    # Pixel densities of the thumbnails in the srcset, 2 is the 400x400 version for retina screens
+    'THUMBNAIL_SCALES': (1, 2),
+    # PostgreSQL text search configuration of the search index, 'english' adds stemming
+    'SEARCH_CONFIG': 'simple',
+    # Bits two perceptual hashes may differ in for near duplicate pictures, at most 3
+    'DUPLICATE_DISTANCE': 3,
+    # Seconds after which a hole in the change feed sequence is taken for a rolled back transaction,
+    # on PostgreSQL not before the open writing transactions have ended
+    'CHANGES_GAP_TIMEOUT': 60,
+    # Count the views of the categories and pictures, see cmsplugin_media_center.counters
+    'VIEW_COUNTS': False,
+    # Seconds the views are kept in memory before they are written
+    'VIEW_COUNTS_FLUSH_INTERVAL': 10,
+    # Objects with buffered views that make a process write them before the interval is over
+    'VIEW_COUNTS_BUFFER': 1000,
+    # Render the gallery from the published tables, kept up to date by media_center_publish
+    'PUBLISHED_READS': False,
+    # List only the root categories in the admin and load the children when they are expanded
+    'ADMIN_LAZY_TREE': False,
+    # Seconds a category found shown is looked up by its pk only, 0 checks its ancestors every time
+    'SHOWN_CACHE_TIMEOUT': 10,
+}
+
+
+class MediaCenterSettings(object):
+    """
+    Settings of the app with their defaults.
+    Each of them can be overridden in the project settings with MEDIA_CENTER_ prefix,
+    for example MEDIA_CENTER_READ_DATABASE = 'replica'
+    """
+    def __getattr__(self, name):
+        try:
+            default = DEFAULTS[name]
+        except KeyError:
+            raise AttributeError(name)
+        return getattr(django_settings, 'MEDIA_CENTER_%s' % name, default)
+
+settings = MediaCenterSettings()
@@ -0,0 +1,104 @@
+"""
+Buffered view counters of the categories and pictures.
+
+Counting a view only adds to a dictionary of the process. The counts are
+written with one UPDATE ... SET views = views + CASE ... END per chunk of
+rows when the buffer is older than MEDIA_CENTER_VIEW_COUNTS_FLUSH_INTERVAL
+seconds, when it holds MEDIA_CENTER_VIEW_COUNTS_BUFFER objects and when the
+process exits. A killed process loses at most one interval of views.
+The published rows are counted along when MEDIA_CENTER_PUBLISHED_READS is
+on, views are not changes and do not wait for media_center_publish.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.db import DatabaseError, connections
+
+from cmsplugin_media_center.conf import settings
+from cmsplugin_media_center.models import Picture, PictureCategory, PublishedCategory, PublishedPicture
+from cmsplugin_media_center.utils.db import atomic, chunks
+
+
+logger = logging.getLogger(__name__)
+
+MODELS = {
+    'category': (PictureCategory, PublishedCategory),
+    'picture': (Picture, PublishedPicture),
+}
+
+
+def write_counts(counts):
+    """
+    Adds the counts, a dict {(kind, pk): views}, to the views of the objects.
+    All the pks of a kind are sorted and updated a chunk at a time, with the
+    count of every row in a CASE, so two flushing processes update the same
+    rows in the same order and can not deadlock each other. The chunks are
+    written in one transaction, a failed flush writes none of its counts.
+    """
+    increments = {}
+    for (kind, pk), value in counts.items():
+        increments.setdefault(kind, {})[pk] = value
+    # Not through the router: a flush must not pin the visitor to the primary
+    connection = connections[settings.WRITE_DATABASE]
+    qn = connection.ops.quote_name
+    with atomic(using=settings.WRITE_DATABASE):
+        for kind in sorted(increments):
+            model, published = MODELS[kind]
+            models = (model, published) if settings.PUBLISHED_READS else (model,)
+            for model in models:
+                pk_column = qn(model._meta.pk.column)
+                for chunk in chunks(sorted(increments[kind])):
+                    connection.cursor().execute('UPDATE %s SET %s = %s + CASE %s %s END WHERE %s IN (%s)' % (
+                        qn(model._meta.db_table), qn('views'), qn('views'), pk_column,
+                        ' '.join('WHEN %d THEN %d' % (pk, increments[kind][pk]) for pk in chunk),
+                        pk_column, ', '.join('%d' % pk for pk in chunk)))
+
+
+class ViewCounter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.started_at = time.time()
+
+    def count(self, kind, pk, value=1):
+        with self.lock:
+            if not self.counts:
+                self.started_at = time.time()
+            self.counts[kind, pk] = self.counts.get((kind, pk), 0) + value
+            due = (len(self.counts) >= settings.VIEW_COUNTS_BUFFER or
+                   time.time() - self.started_at >= settings.VIEW_COUNTS_FLUSH_INTERVAL)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered counts, returns the number of written views.
+        When the database fails they are kept for the next flush.
+        """
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        if not counts:
+            return 0
+        try:
+            write_counts(counts)
+        except DatabaseError:
+            logger.exception('Could not write %d view counts', len(counts))
+            with self.lock:
+                for key, value in counts.items():
+                    self.counts[key] = self.counts.get(key, 0) + value
+            return 0
+        return sum(counts.values())
+
+counter = ViewCounter()
+atexit.register(counter.flush)
+
+
+def count(kind, pk, value=1):
+    if settings.VIEW_COUNTS:
+        counter.count(kind, pk, value)
+
+
+def flush():
+    return counter.flush()
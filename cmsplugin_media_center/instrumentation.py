@@ -0,0 +1,148 @@
+"""
+Lightweight timing spans around the expensive parts of the media center.
+
+Enable them with MEDIA_CENTER_INSTRUMENTATION = True. Every finished span is
+sent with the span_finished signal and logged to the
+'cmsplugin_media_center.instrumentation' logger. The spans are also on with
+MEDIA_CENTER_METRICS = True, which feeds them to cmsplugin_media_center.metrics.
+When both are disabled span() returns a shared object that does nothing.
+"""
+import logging
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings as django_settings
+from django.db import connections
+from django.template import Template
+from easy_thumbnails.signals import thumbnail_created
+
+from cmsplugin_media_center.conf import settings
+from cmsplugin_media_center.signals import span_finished
+
+
+logger = logging.getLogger('cmsplugin_media_center.instrumentation')
+
+_state = threading.local()
+
+
+class NullSpan(object):
+    name = parent = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def incr(self, counter, value=1):
+        pass
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    """
+    Measures the wall time, the number and the time of the queries and any
+    custom counters (incr()) of the code run inside it.
+    """
+    def __init__(self, name, **tags):
+        self.name = name
+        self.tags = tags
+        self.counters = {}
+        self.duration = self.db_time = 0.0
+        self.queries = 0
+        self.parent = None
+
+    def incr(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def __enter__(self):
+        self.parent = getattr(_state, 'span', None)
+        _state.span = self
+        self._debug_cursors = {}
+        self._logged = {}
+        self._queries = {}
+        for connection in connections.all():
+            self._debug_cursors[connection.alias] = connection.use_debug_cursor
+            self._logged[connection.alias] = logs_queries(connection)
+            connection.use_debug_cursor = True
+            self._queries[connection.alias] = len(connection.queries)
+        self._started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = time.time() - self._started
+        for connection in connections.all():
+            if connection.alias not in self._queries:
+                continue
+            queries = connection.queries[self._queries[connection.alias]:]
+            self.queries += len(queries)
+            self.db_time += sum(float(query['time']) for query in queries)
+            connection.use_debug_cursor = self._debug_cursors[connection.alias]
+            if not self._logged[connection.alias]:
+                # Only the spans read them, and processes like media_center_worker never reset them
+                del connection.queries[self._queries[connection.alias]:]
+        _state.span = self.parent
+        span_finished.send(sender=Span, span=self)
+        if settings.INSTRUMENTATION:
+            logger.info('%s %s: %.1fms, %d queries in %.1fms %s', self.name, self.tags,
+                        self.duration * 1000, self.queries, self.db_time * 1000, self.counters)
+
+
+def logs_queries(connection):
+    """
+    Whether the connection keeps its queries without the spans, like with DEBUG
+    """
+    return connection.use_debug_cursor or (connection.use_debug_cursor is None and django_settings.DEBUG)
+
+
+def enabled():
+    return settings.INSTRUMENTATION or settings.METRICS
+
+
+def span(name, **tags):
+    if not enabled():
+        return NULL_SPAN
+    return Span(name, **tags)
+
+
+def timed(name, **tags):
+    """
+    Decorator version of span()
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, **tags):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_span():
+    return getattr(_state, 'span', None) or NULL_SPAN
+
+
+class TimedTemplate(Template):
+    """
+    Renders the wrapped template inside a span.
+    django CMS renders plugin templates given as Template instances directly.
+    """
+    def __init__(self, template, name, **tags):
+        self.template = template
+        self.name = name
+        self.tags = tags
+
+    def render(self, context):
+        with span(self.name, **self.tags):
+            return self.template.render(context)
+
+
+def count_thumbnail(sender, **kwargs):
+    span = getattr(_state, 'span', None)
+    while span is not None:
+        span.incr('thumbnails')
+        span = span.parent
+
+thumbnail_created.connect(count_thumbnail, dispatch_uid='cmsplugin_media_center_count_thumbnail')
@@ -0,0 +1,26 @@
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from cmsplugin_media_center.conf import settings
+from cmsplugin_media_center.models import Change
+from cmsplugin_media_center.routers import use_primary
+from cmsplugin_media_center.utils.db import atomic
+
+
+class Command(BaseCommand):
+    help = ('Deletes the changes of the change feed which are followed by a newer change '
+            'of the same object. The last change of every object is kept.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', default=1,
+                    help='Only compact changes older than this many days (default: 1).'),
+    )
+
+    @use_primary()
+    def handle(self, *args, **options):
+        with atomic(using=settings.WRITE_DATABASE):
+            deleted = Change.objects.compact(timezone.now() - timedelta(days=options['days']))
+        self.stdout.write('Deleted %d changes' % deleted)
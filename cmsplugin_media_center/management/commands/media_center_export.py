@@ -0,0 +1,100 @@
+import io
+import json
+from optparse import make_option
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from cmsplugin_media_center.models import Picture, PictureCategory
+
+
+FORMAT = 'cmsplugin_media_center'
+VERSION = 1
+
+
+def exported_fields(model, exclude=()):
+    """
+    Names of the fields of the model written to the export: the concrete
+    ones except the primary key and the relations, which are exported by slug or id
+    """
+    return [field.name for field in model._meta.local_fields
+            if not field.primary_key and not field.rel and field.name not in exclude]
+
+
+def category_fields():
+    # modified_at is set when the rows are inserted
+    return exported_fields(PictureCategory, exclude=('modified_at',))
+
+
+def picture_fields():
+    return exported_fields(Picture, exclude=('modified_at',))
+
+
+class Command(BaseCommand):
+    help = ('Writes all categories (in tree order) and pictures as JSON lines, '
+            'to be loaded with media_center_import. The images are referenced by their filer id.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output', '-o', default=None,
+                    help='File to write to (default: standard output).'),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Rows read from the database at once (default: 1000).'),
+    )
+
+    def handle(self, *args, **options):
+        output = io.open(options['output'], 'w', encoding='utf-8') if options['output'] else None
+        write = output.write if output else self.write_stdout
+        try:
+            write(self.line({'format': FORMAT, 'version': VERSION}))
+            categories = pictures = 0
+            for row in self.categories(options['batch_size']):
+                write(self.line(row))
+                categories += 1
+            for row in self.pictures(options['batch_size']):
+                write(self.line(row))
+                pictures += 1
+        finally:
+            if output:
+                output.close()
+        self.stderr.write('Exported %d categories and %d pictures' % (categories, pictures))
+
+    def write_stdout(self, line):
+        self.stdout.write(line, ending='')
+
+    def line(self, row):
+        return u'%s\n' % json.dumps(row, cls=DjangoJSONEncoder, sort_keys=True)
+
+    def categories(self, batch_size):
+        """
+        Parents always come before their children
+        """
+        fields = category_fields()
+        rows = PictureCategory.objects.order_by('tree_id', 'lft').values('parent__slug', *fields)
+        last = None
+        while True:
+            batch = rows if last is None else rows.filter(
+                Q(tree_id__gt=last['tree_id']) | Q(tree_id=last['tree_id'], lft__gt=last['lft']))
+            batch = list(batch[:batch_size])
+            if not batch:
+                break
+            last = batch[-1]
+            for row in batch:
+                row['model'] = 'category'
+                row['parent'] = row.pop('parent__slug')
+                yield row
+
+    def pictures(self, batch_size):
+        fields = picture_fields()
+        rows = Picture.objects.order_by('pk').values('pk', 'folder__slug', 'image', *fields)
+        last_pk = 0
+        while True:
+            batch = list(rows.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1]['pk']
+            for row in batch:
+                del row['pk']
+                row['model'] = 'picture'
+                row['category'] = row.pop('folder__slug')
+                yield row
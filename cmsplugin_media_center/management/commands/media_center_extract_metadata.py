@@ -0,0 +1,81 @@
+import logging
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from cmsplugin_media_center.conf import settings
+from cmsplugin_media_center.models import Picture, phash_fields
+from cmsplugin_media_center.routers import use_primary
+from cmsplugin_media_center.utils.db import atomic
+from cmsplugin_media_center.utils.images import extract_metadata
+
+
+logger = logging.getLogger(__name__)
+
+
+def read_metadata(job):
+    """
+    Runs in the worker threads, only touches the storage and PIL, never the database
+    """
+    pk, storage, name = job
+    try:
+        f = storage.open(name, 'rb')
+        try:
+            return pk, extract_metadata(f)
+        finally:
+            f.close()
+    except Exception:
+        logger.exception('Can not read the metadata of picture %s (%s)', pk, name)
+        return pk, {}
+
+
+class Command(BaseCommand):
+    help = ('Stores the dimensions, capture time, dominant colour and placeholder '
+            'of the pictures that do not have them yet.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+                    help='Pictures read and saved together (default: 100).'),
+        make_option('--workers', type='int', default=4,
+                    help='Threads reading the images (default: 4).'),
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Extract the metadata of all pictures again.'),
+    )
+
+    # The pictures marked in a batch are read back, a replica may not have them yet
+    @use_primary()
+    def handle(self, *args, **options):
+        pictures = Picture.objects.select_related('image').order_by('pk')
+        if not options['all']:
+            pictures = pictures.filter(metadata_updated_at=None)
+        pool = ThreadPool(options['workers'])
+        last_pk, processed = 0, 0
+        try:
+            while True:
+                batch = list(pictures.filter(pk__gt=last_pk)[:options['batch_size']])
+                if not batch:
+                    break
+                last_pk = batch[-1].pk
+                jobs = [(picture.pk, picture.image.file.storage, picture.image.file.name)
+                        for picture in batch if picture.image.file]
+                results = dict((pk, self.metadata_fields(metadata)) for pk, metadata in pool.map(read_metadata, jobs))
+                now = timezone.now()
+                with atomic(using=settings.WRITE_DATABASE):
+                    # Pictures that could not be read are marked too, --all retries them
+                    for picture in batch:
+                        Picture.objects.filter(pk=picture.pk).update(
+                            metadata_updated_at=now, **results.get(picture.pk, {}))
+                processed += len(batch)
+                if int(options.get('verbosity', 1)) > 1:
+                    self.stdout.write('Processed %d pictures' % processed)
+        finally:
+            pool.close()
+            pool.join()
+        self.stdout.write('Extracted the metadata of %d pictures' % processed)
+
+    def metadata_fields(self, metadata):
+        if 'phash' in metadata:
+            metadata.update(phash_fields(metadata.pop('phash')))
+        return metadata
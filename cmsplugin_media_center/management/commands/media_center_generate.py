@@ -0,0 +1,144 @@
+import random
+from io import BytesIO
+from optparse import make_option
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+from filer.models import Folder, Image
+
+from cmsplugin_media_center import search
+from cmsplugin_media_center.conf import settings
+from cmsplugin_media_center.models import Change, Picture, PictureCategory
+from cmsplugin_media_center.routers import use_primary
+from cmsplugin_media_center.thumbnails import generate_thumbnails
+from cmsplugin_media_center.utils.db import atomic, chunks
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    import Image as PILImage
+
+
+class Command(BaseCommand):
+    help = ('Generates a synthetic gallery for load testing. '
+            'The same options and --seed always generate the same gallery.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--roots', type='int', default=1,
+                    help='Number of root categories (default: 1).'),
+        make_option('--depth', type='int', default=3,
+                    help='Levels in every tree, roots included (default: 3).'),
+        make_option('--branching', type='int', default=3,
+                    help='Subcategories of every non leaf category (default: 3).'),
+        make_option('--pictures', type='int', default=10,
+                    help='Pictures in every leaf category (default: 10).'),
+        make_option('--published-ratio', type='float', dest='published_ratio', default=0.9,
+                    help='Share of published categories, between 0 and 1 (default: 0.9).'),
+        make_option('--images', type='int', default=10,
+                    help='Distinct filer images shared by the pictures (default: 10).'),
+        make_option('--seed', type='int', default=0,
+                    help='Seed of the random generator (default: 0).'),
+        make_option('--prefix', default='generated',
+                    help='Prefix of the slugs and of the filer folder (default: generated).'),
+        make_option('--no-thumbnails', action='store_false', dest='thumbnails', default=True,
+                    help='Do not generate the thumbnails of the images.'),
+    )
+
+    # The rows just inserted are read back, a replica may not have them yet
+    @use_primary()
+    def handle(self, *args, **options):
+        if options['depth'] < 1 or options['roots'] < 1 or options['images'] < 1:
+            raise CommandError('--depth, --roots and --images must be at least 1.')
+        rng = random.Random(options['seed'])
+        prefix = '%s-%s' % (options['prefix'], options['seed'])
+        if PictureCategory.objects.filter(slug__startswith=prefix + '-').exists():
+            raise CommandError('Gallery "%s" already exists, use another --prefix or --seed.' % prefix)
+
+        with atomic(using=settings.WRITE_DATABASE):
+            images = self.create_images(prefix, options['images'], rng)
+            nodes = self.create_categories(prefix, options, rng)
+            leaves = [node['pk'] for node in nodes if node['rght'] == node['lft'] + 1]
+            pictures = self.create_pictures(leaves, images, options['pictures'], rng)
+            PictureCategory.objects.refresh_visibility(leaves)
+            categories = PictureCategory.objects.filter(slug__startswith=prefix + '-')
+            generated_pictures = Picture.objects.filter(folder__in=categories)
+            # bulk_create does not send the signals which keep the search index up to date
+            search.index_queryset('category', categories)
+            search.index_queryset('picture', generated_pictures)
+            Change.objects.record_queryset('category', categories)
+            Change.objects.record_queryset('picture', generated_pictures)
+
+        thumbnails = generate_thumbnails(images) if options['thumbnails'] else 0
+        self.stdout.write('Generated %d categories, %d pictures, %d images and %d thumbnails' % (
+            len(nodes), pictures, len(images), thumbnails))
+
+    def create_images(self, prefix, count, rng):
+        folder, _ = Folder.objects.get_or_create(name=prefix, parent=None)
+        images = []
+        for index in range(count):
+            color = tuple(rng.randint(0, 255) for _ in range(3))
+            buf = BytesIO()
+            PILImage.new('RGB', (64, 48), color).save(buf, 'JPEG')
+            name = '%s-%d.jpg' % (prefix, index)
+            image = Image(folder=folder, original_filename=name, name=name)
+            image.file = ContentFile(buf.getvalue(), name=name)
+            image.save()
+            images.append(image)
+        return images
+
+    def create_categories(self, prefix, options, rng):
+        """
+        The nested set values are computed here, the categories are
+        inserted level by level so the parents have pks before their children.
+        """
+        first_tree = (PictureCategory.objects.aggregate(tree=Max('tree_id'))['tree'] or 0) + 1
+        nodes = []
+
+        def visit(path, parent, level, lft, tree_id):
+            node = {
+                'slug': '-'.join([prefix] + [str(i) for i in path]),
+                'parent': parent,
+                'level': level,
+                'lft': lft,
+                'tree_id': tree_id,
+                'is_published': rng.random() < options['published_ratio'],
+            }
+            nodes.append(node)
+            rght = lft + 1
+            if level < options['depth'] - 1:
+                for index in range(options['branching']):
+                    rght = visit(path + [index], node, level + 1, rght, tree_id) + 1
+            node['rght'] = rght
+            return rght
+
+        for index in range(options['roots']):
+            visit([index], None, 0, 1, first_tree + index)
+
+        for level in range(options['depth']):
+            level_nodes = [node for node in nodes if node['level'] == level]
+            for chunk in chunks(level_nodes):
+                PictureCategory.objects.bulk_create([
+                    PictureCategory(
+                        parent_id=node['parent']['pk'] if node['parent'] else None,
+                        title=node['slug'].replace('-', ' ').capitalize(),
+                        slug=node['slug'],
+                        is_published=node['is_published'],
+                        is_visible=False,
+                        lft=node['lft'], rght=node['rght'], level=node['level'], tree_id=node['tree_id'],
+                    ) for node in chunk])
+                pks = dict(PictureCategory.objects.filter(
+                    slug__in=[node['slug'] for node in chunk]).values_list('slug', 'pk'))
+                for node in chunk:
+                    node['pk'] = pks[node['slug']]
+        return nodes
+
+    def create_pictures(self, leaves, images, per_leaf, rng):
+        pictures = (
+            Picture(folder_id=pk, image_id=rng.choice(images).pk, title='Picture %d' % index, is_cover=index == 0)
+            for pk in leaves for index in range(per_leaf))
+        count = 0
+        for chunk in chunks(pictures, 1000):
+            Picture.objects.bulk_create(chunk)
+            count += len(chunk)
+        return count
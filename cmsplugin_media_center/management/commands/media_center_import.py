@@ -0,0 +1,210 @@
+import io
+import json
+import os
+from collections import Counter
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+from filer.models import Image
+
+from cmsplugin_media_center import search
+from cmsplugin_media_center.conf import settings
+from cmsplugin_media_center.management.commands.media_center_export import (
+    FORMAT, VERSION, category_fields, picture_fields)
+from cmsplugin_media_center.models import Change, Picture, PictureCategory, duplicate_distance
+from cmsplugin_media_center.routers import use_primary
+from cmsplugin_media_center.utils.db import atomic, chunks
+from cmsplugin_media_center.utils.images import hamming, hash_chunks
+
+
+class Command(BaseCommand):
+    help = ('Loads a file written by media_center_export. The categories and pictures '
+            'are inserted in bulk, the visibility and the search index are updated at the end.')
+    args = '<file>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Lines inserted in one transaction (default: 1000).'),
+        make_option('--checkpoint', default=None,
+                    help='File recording the progress, an interrupted import given the '
+                         'same checkpoint continues where it stopped.'),
+        make_option('--skip-duplicates', action='store_true', dest='skip_duplicates', default=False,
+                    help='Do not import pictures that are near duplicates of existing ones.'),
+    )
+
+    # The rows just inserted are read back, a replica may not have them yet
+    @use_primary()
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the file written by media_center_export.')
+        self.options = options
+        self.checkpoint_path = options['checkpoint']
+        checkpoint = self.read_checkpoint()
+        # The batch after the checkpoint may have been committed before the interruption
+        self.resumed = checkpoint is not None
+        if checkpoint is None:
+            # The imported trees come after the existing ones
+            tree_offset = PictureCategory.objects.aggregate(tree=Max('tree_id'))['tree'] or 0
+            checkpoint = {'line': 1, 'tree_offset': tree_offset, 'skipped': 0,
+                          'last_picture': Picture.objects.aggregate(pk=Max('pk'))['pk'] or 0}
+        self.checkpoint = checkpoint
+        self.slugs = {}
+        self.category_fields = [PictureCategory._meta.get_field(name) for name in category_fields()]
+        self.picture_fields = [Picture._meta.get_field(name) for name in picture_fields()]
+
+        with io.open(args[0], encoding='utf-8') as f:
+            header = json.loads(f.readline() or '{}')
+            if header.get('format') != FORMAT or header.get('version') != VERSION:
+                raise CommandError('%s was not written by media_center_export.' % args[0])
+            batch, line_number = [], 1
+            for line in f:
+                line_number += 1
+                if line_number <= checkpoint['line']:
+                    continue
+                batch.append(json.loads(line))
+                if len(batch) >= options['batch_size']:
+                    self.import_batch(batch, line_number)
+                    batch = []
+            if batch:
+                self.import_batch(batch, line_number)
+
+        categories, pictures = self.finish()
+        self.stdout.write('Imported %d categories and %d pictures, skipped %d pictures' % (
+            categories, pictures, checkpoint['skipped']))
+
+    def read_checkpoint(self):
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with io.open(self.checkpoint_path, encoding='utf-8') as f:
+                return json.load(f)
+
+    def write_checkpoint(self):
+        if self.checkpoint_path:
+            # Replace the file in one step, an interruption leaves the old or the new one
+            temporary = self.checkpoint_path + '.tmp'
+            with io.open(temporary, 'w', encoding='utf-8') as f:
+                f.write(u'%s' % json.dumps(self.checkpoint))
+            os.rename(temporary, self.checkpoint_path)
+
+    def import_batch(self, rows, line_number):
+        with atomic(using=settings.WRITE_DATABASE):
+            self.import_categories([row for row in rows if row['model'] == 'category'])
+            self.import_pictures([row for row in rows if row['model'] == 'picture'])
+            self.checkpoint['last_picture'] = Picture.objects.aggregate(pk=Max('pk'))['pk'] or 0
+        self.resumed = False
+        self.checkpoint['line'] = line_number
+        self.write_checkpoint()
+        if int(self.options.get('verbosity', 1)) > 1:
+            self.stdout.write('Imported %d lines' % line_number)
+
+    def category_pks(self, slugs):
+        """
+        pks of the categories with the given slugs, the ones imported before
+        the last checkpoint are looked up in the database
+        """
+        missing = set(slug for slug in slugs if slug and slug not in self.slugs)
+        for chunk in chunks(missing):
+            self.slugs.update(PictureCategory.objects.filter(slug__in=chunk).values_list('slug', 'pk'))
+        return self.slugs
+
+    def import_categories(self, rows):
+        if not rows:
+            return
+        existing = self.category_pks(row['slug'] for row in rows)
+        # Categories of an interrupted batch are in the imported trees, the others are conflicts
+        conflicts = PictureCategory.objects.filter(
+            slug__in=[row['slug'] for row in rows if row['slug'] in existing],
+            tree_id__lte=self.checkpoint['tree_offset'])
+        conflict = list(conflicts.values_list('slug', flat=True)[:1])
+        if conflict:
+            raise CommandError('Category "%s" already exists.' % conflict[0])
+        # A slug repeated in the batch keeps its first row, like one repeated in a later batch
+        new_rows, slugs = [], set()
+        for row in rows:
+            if row['slug'] not in existing and row['slug'] not in slugs:
+                slugs.add(row['slug'])
+                new_rows.append(row)
+        rows = new_rows
+
+        # Parents come first in the file but can be in this batch: insert level by level
+        for level in sorted(set(row['level'] for row in rows)):
+            level_rows = [row for row in rows if row['level'] == level]
+            parents = self.category_pks(row['parent'] for row in level_rows)
+            categories = []
+            for row in level_rows:
+                if row['parent'] and row['parent'] not in parents:
+                    raise CommandError('Unknown parent "%s" of category "%s".' % (row['parent'], row['slug']))
+                category = PictureCategory(parent_id=parents[row['parent']] if row['parent'] else None)
+                # Files exported before a field was added keep its default
+                for field in self.category_fields:
+                    if field.name in row:
+                        setattr(category, field.attname, field.to_python(row[field.name]))
+                category.tree_id += self.checkpoint['tree_offset']
+                categories.append(category)
+            PictureCategory.objects.bulk_create(categories)
+            self.category_pks(row['slug'] for row in level_rows)
+
+    def import_pictures(self, rows):
+        if not rows:
+            return
+        folders = self.category_pks(row['category'] for row in rows)
+        images = set(Image.objects.filter(pk__in=set(row['image'] for row in rows)).values_list('pk', flat=True))
+        imported = Counter()
+        if self.resumed:
+            # Like the categories, the pictures inserted after the checkpoint are not inserted again
+            for chunk in chunks(set(folders[row['category']] for row in rows)):
+                imported.update(Picture.objects.filter(
+                    folder__in=chunk, pk__gt=self.checkpoint.get('last_picture', 0)).values_list('folder', 'image'))
+        pictures, hashes = [], {}
+        for row in rows:
+            if row['image'] not in images:
+                self.checkpoint['skipped'] += 1
+                continue
+            if imported[folders[row['category']], row['image']]:
+                imported[folders[row['category']], row['image']] -= 1
+                continue
+            picture = Picture(folder_id=folders[row['category']], image_id=row['image'])
+            for field in self.picture_fields:
+                if field.name in row:
+                    setattr(picture, field.attname, field.to_python(row[field.name]))
+            if self.options['skip_duplicates'] and picture.phash is not None and \
+                    self.is_duplicate(picture.phash_value, hashes):
+                self.checkpoint['skipped'] += 1
+                continue
+            pictures.append(picture)
+        Picture.objects.bulk_create(pictures)
+
+    def is_duplicate(self, phash, hashes):
+        """
+        Whether a picture with the hash is a near duplicate of an existing picture
+        or of one of the batch, whose hashes are kept in hashes by their parts
+        like the index of near_duplicates. Adds the hash otherwise.
+        """
+        distance = duplicate_distance()
+        parts = list(enumerate(hash_chunks(phash)))
+        for part in parts:
+            if any(hamming(phash, other) <= distance for other in hashes.get(part, ())):
+                return True
+        if Picture.objects.near_duplicates(phash):
+            return True
+        for part in parts:
+            hashes.setdefault(part, []).append(phash)
+        return False
+
+    def finish(self):
+        """
+        The pictures of the file may have been skipped and the visibility
+        of the exporting site may have been waiting for media_center_worker,
+        so it is computed again. bulk_create does not send the signals
+        which keep the search index up to date.
+        """
+        categories = PictureCategory.objects.filter(tree_id__gt=self.checkpoint['tree_offset'])
+        pks = list(categories.values_list('pk', flat=True))
+        for chunk in chunks(pks, 1000):
+            PictureCategory.objects.refresh_visibility(chunk)
+        pictures = Picture.objects.filter(folder__tree_id__gt=self.checkpoint['tree_offset'])
+        search.index_queryset('category', categories)
+        search.index_queryset('picture', pictures)
+        Change.objects.record_queryset('category', categories)
+        Change.objects.record_queryset('picture', pictures)
+        return len(pks), pictures.count()
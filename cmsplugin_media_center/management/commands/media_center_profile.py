@@ -0,0 +1,118 @@
+import cProfile
+import pstats
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import set_urlconf
+from django.template import RequestContext, Template
+from django.template.loader import render_to_string
+from django.test.client import RequestFactory
+from django.utils.six import StringIO
+
+from cmsplugin_media_center.cms_plugins import CMSMediaPlugin
+from cmsplugin_media_center.instrumentation import Span
+from cmsplugin_media_center.models import MediaPlugin, PictureCategory
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class Command(BaseCommand):
+    help = ('Renders every visible category with every skin of the gallery plugin '
+            'and prints the slowest ones.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', default=20,
+                    help='Rows in the reports (default: 20).'),
+        make_option('--skin', action='append', dest='skins',
+                    help='Only profile this skin, can be repeated.'),
+        make_option('--cprofile', action='store_true', default=False,
+                    help='Profile the renders with cProfile and print the hottest functions.'),
+        make_option('--tracemalloc', action='store_true', default=False,
+                    help='Track the memory allocated by the renders (Python 3.4+).'),
+    )
+
+    def handle(self, *args, **options):
+        if options['tracemalloc'] and tracemalloc is None:
+            raise CommandError('tracemalloc is not available in this Python version.')
+        skins = options['skins'] or [skin for skin, _ in MediaPlugin.MEDIA_SKINS]
+        profiler = cProfile.Profile() if options['cprofile'] else None
+        if options['tracemalloc']:
+            tracemalloc.start()
+
+        request = RequestFactory().get('/')
+        results = []
+        # The templates reverse the apphook urls, which are not attached outside of a CMS page
+        set_urlconf('cmsplugin_media_center.urls')
+        try:
+            for category in PictureCategory.objects.whole_tree().iterator():
+                for skin in skins:
+                    results.append(self.profile(request, category, skin, profiler))
+        finally:
+            set_urlconf(None)
+
+        self.report(results, options['limit'], options['tracemalloc'])
+        if profiler is not None:
+            output = StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(options['limit'])
+            self.stdout.write('\nHottest functions:\n' + output.getvalue())
+        if options['tracemalloc']:
+            self.stdout.write('\nTop allocations:\n')
+            for stat in tracemalloc.take_snapshot().statistics('lineno')[:options['limit']]:
+                self.stdout.write('%s\n' % stat)
+            tracemalloc.stop()
+
+    def profile(self, request, category, skin, profiler):
+        plugin = CMSMediaPlugin()
+        instance = MediaPlugin(template=skin)
+        context = RequestContext(request, {'category': category.slug})
+        if tracemalloc is not None and tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        span = Span('profile', skin=skin, category=category.slug)
+        error = None
+        with span:
+            try:
+                if profiler is not None:
+                    profiler.runcall(self.render, plugin, context, instance)
+                else:
+                    self.render(plugin, context, instance)
+            except Exception as e:
+                error = '%s: %s' % (e.__class__.__name__, e)
+        peak = tracemalloc.get_traced_memory()[1] if tracemalloc is not None and tracemalloc.is_tracing() else None
+        return {
+            'category': category,
+            'skin': skin,
+            'span': span,
+            'peak': peak,
+            'error': error,
+        }
+
+    def render(self, plugin, context, instance):
+        context = plugin.render(context, instance, None)
+        template = plugin.render_template
+        if isinstance(template, Template):
+            return template.render(context)
+        return render_to_string(template, context_instance=context)
+
+    def report(self, results, limit, memory):
+        results.sort(key=lambda result: result['span'].duration, reverse=True)
+        header = '%10s %8s %10s %11s %6s %-12s %s' % (
+            'time ms', 'queries', 'db ms', 'thumbnails', 'level', 'skin', 'category')
+        if memory:
+            header = '%10s ' % 'peak KB' + header
+        self.stdout.write(header + '\n')
+        for result in results[:limit]:
+            span = result['span']
+            line = '%10.1f %8d %10.1f %11d %6d %-12s %s' % (
+                span.duration * 1000, span.queries, span.db_time * 1000, span.counters.get('thumbnails', 0),
+                result['category'].level, result['skin'], result['category'].slug)
+            if memory:
+                line = '%10.1f ' % ((result['peak'] or 0) / 1024.0) + line
+            if result['error']:
+                line += '  (%s)' % result['error']
+            self.stdout.write(line + '\n')
+
+        total = sum(result['span'].duration for result in results)
+        self.stdout.write('\n%d renders in %.1fs\n' % (len(results), total))
@@ -0,0 +1,41 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from cmsplugin_media_center import publish
+
+
+class Command(BaseCommand):
+    help = ('Applies the changes of the categories and pictures to the published tables '
+            'read by the gallery when MEDIA_CENTER_PUBLISHED_READS is on.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', type='float', default=5,
+                    help='Seconds to wait between two passes over the changes (default: 5).'),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Changes applied in one transaction (default: 1000).'),
+        make_option('--once', action='store_true', default=False,
+                    help='Apply the pending changes once and exit.'),
+        make_option('--full', action='store_true', default=False,
+                    help='Publish the whole gallery again in one transaction and exit.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if options['full']:
+            count = publish.rebuild(batch_size=options['batch_size'])
+            self.stdout.write('Published %d categories' % count)
+            return
+        while True:
+            applied = 0
+            while True:
+                count = publish.publish(batch_size=options['batch_size'])
+                if not count:
+                    break
+                applied += count
+            if applied and verbosity > 1:
+                self.stdout.write('Applied %d changes' % applied)
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cmsplugin_media_center import search
+from cmsplugin_media_center.conf import settings
+from cmsplugin_media_center.utils.db import atomic
+
+
+class Command(BaseCommand):
+    help = ('Drops the full text search index and indexes the titles and '
+            'descriptions of all categories and pictures again.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Rows read and indexed together (default: 1000).'),
+    )
+
+    def handle(self, *args, **options):
+        using = settings.WRITE_DATABASE
+        if search.get_backend(using) is None:
+            raise CommandError('Full text search needs SQLite or PostgreSQL.')
+        with atomic(using=using):
+            count = search.rebuild(options['batch_size'], using)
+        self.stdout.write('Indexed %d categories and pictures' % count)
@@ -0,0 +1,45 @@
+import io
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cmsplugin_media_center import sitemaps
+
+
+class Command(BaseCommand):
+    help = ('Writes the sitemaps of the shown categories and pictures and their index '
+            '(sitemap.xml) to a directory, to be served from the root of the site.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output-dir', dest='output_dir', default=None,
+                    help='Directory the sitemaps are written to.'),
+        make_option('--base-url', dest='base_url', default=None,
+                    help='Scheme and host of the site, for example https://example.com.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Pictures read from the database at once (default: 1000).'),
+    )
+
+    def handle(self, *args, **options):
+        if not options['output_dir'] or not options['base_url']:
+            raise CommandError('Give --output-dir and --base-url.')
+        base_url = options['base_url'].rstrip('/')
+        categories = sitemaps.shown_categories()
+        names = []
+        for section in sorted(sitemaps.SECTIONS):
+            for number in range(1, sitemaps.sitemap_count(section) + 1):
+                name = 'sitemap-%s-%d.xml' % (section, number)
+                entries = sitemaps.entries(section, number, categories, options['batch_size'])
+                self.write(options['output_dir'], name, sitemaps.urlset(entries, base_url))
+                names.append(name)
+        self.write(options['output_dir'], 'sitemap.xml',
+                   sitemaps.sitemap_index('%s/%s' % (base_url, name) for name in names))
+        self.stdout.write('Wrote %d sitemaps' % len(names))
+
+    def write(self, directory, name, pieces):
+        # Replace the file in one step, crawlers never read a partial sitemap
+        path = os.path.join(directory, name)
+        with io.open(path + '.tmp', 'w', encoding='utf-8') as f:
+            for piece in pieces:
+                f.write(u'%s' % piece)
+        os.rename(path + '.tmp', path)
@@ -0,0 +1,43 @@
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from cmsplugin_media_center.models import Picture
+from cmsplugin_media_center.thumbnails import generate_thumbnails, thumbnail_formats
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Generates every thumbnail of the pictures (each format of THUMBNAIL_FORMATS '
+            'and each density of THUMBNAIL_SCALES) so the pages never have to.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+                    help='Pictures loaded together (default: 100).'),
+    )
+
+    def handle(self, *args, **options):
+        pictures = Picture.objects.select_related('image').order_by('pk')
+        self.stdout.write('Formats: %s' % ', '.join(['original'] + thumbnail_formats()))
+        last_pk, images, thumbnails, failed = 0, set(), 0, 0
+        while True:
+            batch = list(pictures.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            for picture in batch:
+                # The same image can be used by many pictures
+                if picture.image_id in images:
+                    continue
+                images.add(picture.image_id)
+                try:
+                    thumbnails += generate_thumbnails([picture.image])
+                except Exception:
+                    logger.exception('Can not generate the thumbnails of picture %s', picture.pk)
+                    failed += 1
+            if int(options.get('verbosity', 1)) > 1:
+                self.stdout.write('Processed %d images' % len(images))
+        self.stdout.write('%d thumbnails of %d images are ready, %d images failed' % (thumbnails, len(images), failed))
@@ -0,0 +1,35 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from cmsplugin_media_center.models import DirtyCategory
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the visibility of the categories queued by the signal handlers '
+            'when MEDIA_CENTER_VISIBILITY_UPDATES is "deferred".')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', type='float', default=5,
+                    help='Seconds to wait between two passes over the queue (default: 5).'),
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+                    help='Categories recomputed in one transaction (default: 500).'),
+        make_option('--once', action='store_true', default=False,
+                    help='Empty the queue once and exit.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            processed = 0
+            while True:
+                count = DirtyCategory.objects.process(batch_size=options['batch_size'])
+                if not count:
+                    break
+                processed += count
+            if processed and verbosity > 1:
+                self.stdout.write('Recomputed visibility of %d categories' % processed)
+            if options['once']:
+                break
+            time.sleep(options['interval'])
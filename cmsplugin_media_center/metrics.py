@@ -0,0 +1,294 @@
+"""
+In-process counters and histograms of the media center exposed in the
+Prometheus text format by cmsplugin_media_center.views.metrics_view.
+
+Enable them with MEDIA_CENTER_METRICS = True. With several worker processes
+(gunicorn, uwsgi) set MEDIA_CENTER_METRICS_DIR to a directory shared by them:
+a thread of every process writes its values there and the view adds them up.
+The values of the processes that have exited are added to metrics-dead.json
+after a while, so the totals never go down when a worker is recycled.
+"""
+import atexit
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from easy_thumbnails.signals import thumbnail_created
+
+from cmsplugin_media_center.conf import settings
+from cmsplugin_media_center.signals import span_finished
+
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DEPTH_BUCKETS = (1, 2, 3, 5, 8, 13, 21)
+
+# A file not written for this many flush intervals (and at least a minute)
+# belongs to a process that has exited
+STALE_INTERVALS = 10
+
+# The values of the processes that have exited, and the lock of its updates
+DEAD_FILE = 'metrics-dead.json'
+DEAD_LOCK = '.dead.lock'
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'media_center_renders_total': (
+        'counter', 'Gallery plugin renders.', None),
+    'media_center_render_seconds': (
+        'histogram', 'Gallery plugin render time, context and template phases.', LATENCY_BUCKETS),
+    'media_center_cache_requests_total': (
+        'counter', 'Media center cache lookups by result.', None),
+    'media_center_visibility_recomputes_total': (
+        'counter', 'Visibility recomputes, cascades from saves and batches.', None),
+    'media_center_cascade_depth': (
+        'histogram', 'Tree levels touched by a visibility recompute.', DEPTH_BUCKETS),
+    'media_center_thumbnails_generated_total': (
+        'counter', 'Thumbnails generated.', None),
+    'media_center_not_found_total': (
+        'counter', 'Requests for categories that are not shown.', None),
+}
+
+
+def enabled():
+    return settings.METRICS
+
+
+def merge(snapshots):
+    """
+    Adds up snapshots, returns the counters {(name, labels): value} and the
+    histograms {(name, labels): (bucket counts, sum, count)}
+    """
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(sorted(labels.items())))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, (counts, total, count) in snapshot['histograms']:
+            key = (name, tuple(sorted(labels.items())))
+            merged = histograms.get(key, ([0] * len(counts), 0.0, 0))
+            histograms[key] = ([a + b for a, b in zip(merged[0], counts)], merged[1] + total, merged[2] + count)
+    return counters, histograms
+
+
+def as_snapshot(counters, histograms):
+    return {
+        'counters': [[name, dict(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [[name, dict(labels), list(values)] for (name, labels), values in histograms.items()],
+    }
+
+
+def write_json(directory, filename, data):
+    """
+    Replaces the file at once, a reader never sees half of it
+    """
+    fd, path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(path, os.path.join(directory, filename))
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.flusher_pid = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.start_flusher()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = METRICS[name][2]
+        with self.lock:
+            counts, total, count = self.histograms.get(key, ([0] * len(buckets), 0.0, 0))
+            counts = [c + (1 if value <= bucket else 0) for c, bucket in zip(counts, buckets)]
+            self.histograms[key] = (counts, total + value, count + 1)
+        self.start_flusher()
+
+    def snapshot(self):
+        with self.lock:
+            return as_snapshot(self.counters, self.histograms)
+
+    def start_flusher(self):
+        """
+        Starts the thread writing the values of this process to MEDIA_CENTER_METRICS_DIR
+        every MEDIA_CENTER_METRICS_FLUSH_INTERVAL seconds. A forked worker starts
+        its own, the threads of its parent do not follow it.
+        """
+        pid = os.getpid()
+        if not settings.METRICS_DIR or self.flusher_pid == pid:
+            return
+        with self.lock:
+            if self.flusher_pid == pid:
+                return
+            self.flusher_pid = pid
+        thread = threading.Thread(target=self.run_flusher, name='media-center-metrics')
+        thread.daemon = True
+        thread.start()
+
+    def run_flusher(self):
+        pid = os.getpid()
+        while self.flusher_pid == pid:
+            time.sleep(settings.METRICS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except (IOError, OSError):
+                logger.exception('Could not write the metrics to %s', settings.METRICS_DIR)
+
+    def flush(self):
+        """
+        Writes the values of this process to MEDIA_CENTER_METRICS_DIR
+        """
+        directory = settings.METRICS_DIR
+        if not directory:
+            return
+        write_json(directory, 'metrics-%d.json' % os.getpid(), self.snapshot())
+
+    def fold(self, directory, filename):
+        """
+        Adds the values of the file of an exited process to DEAD_FILE and
+        removes it. The file is renamed first: a fold stopped halfway loses
+        its values once, it never adds them twice.
+        """
+        claimed = os.path.join(directory, '.fold-' + filename)
+        os.rename(os.path.join(directory, filename), claimed)
+        with open(claimed) as f:
+            snapshots = [json.load(f)]
+        try:
+            with open(os.path.join(directory, DEAD_FILE)) as f:
+                snapshots.append(json.load(f))
+        except (IOError, OSError):
+            pass
+        write_json(directory, DEAD_FILE, as_snapshot(*merge(snapshots)))
+        os.remove(claimed)
+
+    def collect(self):
+        """
+        Returns the values of all processes when MEDIA_CENTER_METRICS_DIR
+        is set, otherwise the ones of this process. The views of the workers
+        take turns, one never reads a file another one is folding (without
+        fcntl, on Windows, a scrape may count a folded process twice).
+        """
+        directory = settings.METRICS_DIR
+        if not directory:
+            return [self.snapshot()]
+        self.flush()
+        stale = time.time() - max(STALE_INTERVALS * settings.METRICS_FLUSH_INTERVAL, 60)
+        lock = open(os.path.join(directory, DEAD_LOCK), 'a')
+        try:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            for filename in os.listdir(directory):
+                path = os.path.join(directory, filename)
+                try:
+                    if filename == DEAD_FILE or os.path.getmtime(path) >= stale:
+                        continue
+                except OSError:
+                    # A temporary file the process has renamed since
+                    continue
+                try:
+                    if filename.startswith('metrics-') and filename.endswith('.json'):
+                        self.fold(directory, filename)
+                    elif filename.startswith('.tmp-'):
+                        os.remove(path)
+                except (IOError, OSError, ValueError):
+                    logger.exception('Could not fold the metrics file %s', path)
+            snapshots = []
+            for filename in os.listdir(directory):
+                if not (filename.startswith('metrics-') and filename.endswith('.json')):
+                    continue
+                try:
+                    with open(os.path.join(directory, filename)) as f:
+                        snapshots.append(json.load(f))
+                except (IOError, OSError, ValueError):
+                    # Another view folded it, without fcntl
+                    pass
+        finally:
+            lock.close()
+        return snapshots
+
+registry = Registry()
+
+
+def flush_at_exit():
+    if registry.flusher_pid == os.getpid():
+        registry.flush()
+
+atexit.register(flush_at_exit)
+
+
+def inc(name, value=1, **labels):
+    if enabled():
+        registry.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    if enabled():
+        registry.observe(name, value, **labels)
+
+
+def _format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(labels[key]).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key in sorted(labels))
+
+
+def render():
+    counters, histograms = merge(registry.collect())
+
+    lines = []
+    for name in sorted(METRICS):
+        kind, help_text, buckets = METRICS[name]
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        if kind == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append('%s%s %s' % (name, _format_labels(labels), value))
+        else:
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bucket, bucket_count in zip(buckets, counts):
+                    lines.append('%s_bucket%s %s' % (name, _format_labels(labels, le=bucket), bucket_count))
+                lines.append('%s_bucket%s %s' % (name, _format_labels(labels, le='+Inf'), count))
+                lines.append('%s_sum%s %s' % (name, _format_labels(labels), total))
+                lines.append('%s_count%s %s' % (name, _format_labels(labels), count))
+    return '\n'.join(lines) + '\n'
+
+
+def record_span(sender, span, **kwargs):
+    if span.name == 'render':
+        inc('media_center_renders_total', skin=span.tags.get('skin'))
+        observe('media_center_render_seconds', span.duration, skin=span.tags.get('skin'), phase='context')
+    elif span.name == 'template':
+        observe('media_center_render_seconds', span.duration, skin=span.tags.get('skin'), phase='template')
+    elif span.name == 'visibility_cascade':
+        inc('media_center_visibility_recomputes_total', kind='cascade')
+        observe('media_center_cascade_depth', span.counters.get('depth', 0))
+    elif span.name == 'refresh_visibility':
+        inc('media_center_visibility_recomputes_total', kind='batch')
+        observe('media_center_cascade_depth', span.counters.get('depth', 0))
+
+
+def record_thumbnail(sender, **kwargs):
+    inc('media_center_thumbnails_generated_total')
+
+span_finished.connect(record_span, dispatch_uid='cmsplugin_media_center_metrics_span')
+thumbnail_created.connect(record_thumbnail, dispatch_uid='cmsplugin_media_center_metrics_thumbnail')
@@ -0,0 +1,44 @@
+import time
+
+from django.core.urlresolvers import NoReverseMatch, reverse
+
+from cmsplugin_media_center import routers
+from cmsplugin_media_center.conf import settings
+
+
+class ReadYourWritesMiddleware(object):
+    """
+    Keeps the media center reads on the primary database for requests
+    that may write (non safe methods, the admin) and, when
+    MEDIA_CENTER_READ_YOUR_WRITES is set, for that many seconds after
+    the client wrote something.
+    """
+    cookie_name = 'media_center_primary'
+    safe_methods = ('GET', 'HEAD', 'OPTIONS')
+
+    def process_request(self, request):
+        routers.reset_state()
+        if settings.READ_DATABASE is None:
+            return
+        if (request.method not in self.safe_methods or
+                self.is_admin_request(request) or self.in_window(request)):
+            routers.pin()
+
+    def process_response(self, request, response):
+        window = settings.READ_YOUR_WRITES
+        if window and routers.has_written():
+            response.set_cookie(self.cookie_name, str(int(time.time() + window)), max_age=window)
+        routers.reset_state()
+        return response
+
+    def in_window(self, request):
+        try:
+            return int(request.COOKIES[self.cookie_name]) > time.time()
+        except (KeyError, ValueError):
+            return False
+
+    def is_admin_request(self, request):
+        try:
+            return request.path.startswith(reverse('admin:index'))
+        except NoReverseMatch:
+            return False
@@ -1,17 +1,51 @@
+from datetime import timedelta
 from functools import reduce
 
-from django.db import models
-from django.db.models import Min
-from django.db.models.signals import post_delete, post_save
+from django.conf import settings as django_settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, connections, models
+from django.db.models import Count, Max, Min, Q
+from django.db.models.signals import post_delete, post_save, post_syncdb
 from django.dispatch.dispatcher import receiver
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from cms.models import CMSPlugin
 from filer.fields.image import FilerImageField
+from filer.models import Image
 from mptt.models import TreeForeignKey
 from mptt.managers import TreeManager
 from orderedmodel import OrderedMPTTModel
 
+from cmsplugin_media_center import metrics  # connects the metric receivers
+from cmsplugin_media_center.conf import settings
+from cmsplugin_media_center.instrumentation import current_span, span, timed
+from cmsplugin_media_center.routers import use_primary
+from cmsplugin_media_center.thumbnails import THUMBNAIL_OPTIONS
+from cmsplugin_media_center.utils.db import atomic, chunks, retry_on_deadlock
+from cmsplugin_media_center.utils.images import HASH_BITS, HASH_CHUNKS, fit, hamming, hash_chunks, image_hash
+from cmsplugin_media_center.utils.models import TrackedFieldsMixin
+
+
+def shown_key(slug):
+    return 'cmsplugin_media_center:shown:%s' % slug
+
+
+def deferred_visibility():
+    return settings.VISIBILITY_UPDATES == 'deferred'
+
+
+def skip_view_counts(instance, kwargs):
+    """
+    Leaves the views out of the UPDATE of an object loaded from the database,
+    cmsplugin_media_center.counters increments them behind its back.
+    """
+    if instance._state.adding or kwargs.get('force_insert') or kwargs.get('update_fields') is not None:
+        return
+    kwargs['update_fields'] = [field.name for field in instance._meta.local_fields
+                               if not field.primary_key and field.name != 'views']
+
 
 class PictureCategoryManager(TreeManager):
     def get_visible(self, *args, **kwargs):
@@ -20,6 +54,37 @@ class PictureCategoryManager(TreeManager):
             return category
         raise self.model.DoesNotExist
 
+    def get_shown(self, slug):
+        """
+        get_visible(slug=slug) remembering for SHOWN_CACHE_TIMEOUT seconds that
+        the category is shown, so the next pages of it only load it by pk.
+        Visibility changes and moves forget the categories they concern.
+        """
+        key = shown_key(slug)
+        pk = cache.get(key)
+        if pk is not None:
+            try:
+                return self.get(pk=pk, slug=slug)
+            except self.model.DoesNotExist:
+                cache.delete(key)
+        category = self.get_visible(slug=slug)
+        if settings.SHOWN_CACHE_TIMEOUT:
+            cache.set(key, category.pk, settings.SHOWN_CACHE_TIMEOUT)
+        return category
+
+    def forget_shown(self, pks, descendants=False):
+        """
+        Drops the categories, and their descendants if asked, from the cache of get_shown
+        """
+        from cmsplugin_media_center.publish import descendant_pks  # publish imports this module
+        if not settings.SHOWN_CACHE_TIMEOUT:
+            return
+        pks = set(pks)
+        if descendants:
+            pks |= descendant_pks(pks)
+        for chunk in chunks(pks):
+            cache.delete_many([shown_key(slug) for slug in self.filter(pk__in=chunk).values_list('slug', flat=True)])
+
     def whole_tree(self):
         roots = self.filter(parent=None, is_visible=True)
         if roots.exists():
@@ -27,6 +92,252 @@ class PictureCategoryManager(TreeManager):
         else:
             return roots
 
+    def shown_pks(self, pks):
+        """
+        The pks of the given categories that are shown: visible, like all their ancestors.
+        Runs one query for the categories and one per 100 of them for their hidden ancestors.
+        """
+        categories = list(self.filter(pk__in=pks, is_visible=True).values('pk', 'tree_id', 'lft', 'rght'))
+        shown = set()
+        for chunk in chunks(categories, 100):
+            hidden = list(self.filter(is_visible=False).filter(reduce(lambda x, y: x | y, (
+                Q(tree_id=c['tree_id'], lft__lt=c['lft'], rght__gt=c['rght']) for c in chunk))).values_list(
+                'tree_id', 'lft', 'rght'))
+            for c in chunk:
+                if not any(tree_id == c['tree_id'] and lft < c['lft'] and rght > c['rght']
+                           for tree_id, lft, rght in hidden):
+                    shown.add(c['pk'])
+        return shown
+
+    def most_viewed(self, limit=10):
+        """
+        The shown categories with the most views, walks the views index in
+        batches until enough of them are shown
+        """
+        queryset = self.filter(is_visible=True).order_by('-views', 'pk')
+        found, offset, batch = [], 0, max(limit * 2, 20)
+        while len(found) < limit:
+            categories = list(queryset[offset:offset + batch])
+            shown = self.shown_pks([category.pk for category in categories])
+            found.extend(category for category in categories if category.pk in shown)
+            if len(categories) < batch:
+                break
+            offset += batch
+        return found[:limit]
+
+    def search(self, query, offset=0, limit=20):
+        """
+        Shown categories matching the words of the query, best matches first
+        """
+        from cmsplugin_media_center import search  # search imports this module
+        return search.in_order(self.all(), search.search(query, 'category', offset, limit, self.db))
+
+    @use_primary()
+    @retry_on_deadlock()
+    def reorder(self, parent, pks):
+        """
+        Puts the children of parent, or the roots with None, in the order of pks
+        which must list all of them. Instead of moving the categories one by one
+        the subtrees are shifted with one UPDATE, the roots are given each
+        other's tree_id. Returns the pks of the moved categories.
+        """
+        pks = [int(pk) for pk in pks]
+        if parent is None:
+            siblings = self.filter(parent=None)
+        else:
+            parent = self.select_for_update().get(pk=parent.pk)
+            siblings = self.filter(parent=parent)
+        nodes = dict((pk, (tree_id, lft, rght)) for pk, tree_id, lft, rght in siblings.select_for_update().order_by(
+            'tree_id', 'lft').values_list('pk', 'tree_id', 'lft', 'rght'))
+        if sorted(pks) != sorted(nodes):
+            raise ValueError('The order must list every sibling once')
+
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        if parent is None:
+            trees = sorted(tree_id for tree_id, lft, rght in nodes.values())
+            moved = [(nodes[pk][0], tree_id, pk) for pk, tree_id in zip(pks, trees) if nodes[pk][0] != tree_id]
+            if moved:
+                connection.cursor().execute('UPDATE %s SET tree_id = CASE tree_id %s END WHERE tree_id IN (%s)' % (
+                    table, ' '.join('WHEN %d THEN %d' % (old, new) for old, new, pk in moved),
+                    ', '.join('%d' % old for old, new, pk in moved)))
+        else:
+            start, moved = parent.lft + 1, []
+            for pk in pks:
+                tree_id, lft, rght = nodes[pk]
+                if start != lft:
+                    moved.append((lft, rght, start - lft, pk))
+                start += rght - lft + 1
+            if moved:
+                # Every bound is compared to the old value of its own column, which
+                # holds whether the backend assigns the columns in order (MySQL) or not
+                connection.cursor().execute(
+                    'UPDATE %s SET lft = CASE %s ELSE lft END, rght = CASE %s ELSE rght END '
+                    'WHERE tree_id = %%s AND lft > %%s AND rght < %%s' % (
+                        table,
+                        ' '.join('WHEN lft BETWEEN %d AND %d THEN lft + (%d)' % shift[:3] for shift in moved),
+                        ' '.join('WHEN rght BETWEEN %d AND %d THEN rght + (%d)' % shift[:3] for shift in moved)),
+                    [parent.tree_id, parent.lft, parent.rght])
+        moved = [shift[-1] for shift in moved]
+        Change.objects.record('category', moved)
+        return moved
+
+    @use_primary()
+    @retry_on_deadlock()
+    def bulk_add(self, categories):
+        """
+        Inserts many new categories. The parent of a category is an existing
+        category or one of the batch; the new categories come after the
+        existing children of their parent, in the order given.
+
+        The tree is not maintained for every insert: the categories are inserted
+        level by level, each touched tree is renumbered once at the end, then
+        the visibility of the new categories and their ancestors is computed once.
+        Returns the pks of the new categories.
+        """
+        categories = list(categories)
+        cache_name = self.model._meta.get_field('parent').get_cache_name()
+        parents = set(category.parent_id for category in categories
+                      if getattr(category, cache_name, None) is None and category.parent_id)
+        parents.update(getattr(category, cache_name).pk for category in categories
+                       if getattr(category, cache_name, None) is not None)
+        parents.discard(None)
+        tree_of = {}
+        for chunk in chunks(parents):
+            tree_of.update(self.filter(pk__in=chunk).values_list('pk', 'tree_id'))
+        # Lock the touched trees before breaking them
+        list(self.select_for_update().filter(tree_id__in=set(tree_of.values())).values_list('pk', flat=True))
+        next_tree = (self.aggregate(tree=Max('tree_id'))['tree'] or 0) + 1
+
+        pending = categories
+        while pending:
+            ready = [category for category in pending if getattr(category, cache_name, None) is None or
+                     getattr(category, cache_name).pk is not None]
+            if not ready:
+                raise ValueError('The parents must be saved categories or in the batch')
+            for category in ready:
+                parent = getattr(category, cache_name, None)
+                if parent is not None:
+                    category.parent_id = parent.pk
+                if category.parent_id is None:
+                    category.tree_id, next_tree = next_tree, next_tree + 1
+                elif category.parent_id in tree_of:
+                    category.tree_id = tree_of[category.parent_id]
+                else:
+                    raise ValueError('Category %s does not exist' % category.parent_id)
+                category.lft = category.rght = category.level = 0
+            for chunk in chunks(ready):
+                self.bulk_create(chunk)
+                pks = dict(self.filter(slug__in=[category.slug for category in chunk]).values_list('slug', 'pk'))
+                for category in chunk:
+                    category.pk = pks[category.slug]
+                    tree_of[category.pk] = category.tree_id
+            pending = [category for category in pending if category.pk is None]
+
+        pks = [category.pk for category in categories]
+        self.rebuild_trees(set(category.tree_id for category in categories), appended=pks)
+        self._tree_changed(pks, pks)
+        return pks
+
+    @use_primary()
+    @retry_on_deadlock()
+    def bulk_move(self, moves):
+        """
+        Moves many categories at once, moves is {pk: new parent pk, None for a root}.
+        A moved category comes after the existing children of its new parent.
+        Like bulk_add, each touched tree is renumbered once.
+        """
+        moves = dict((int(pk), parent) for pk, parent in moves.items())
+        nodes = {}
+        for chunk in chunks(set(moves) | set(parent for parent in moves.values() if parent is not None)):
+            nodes.update((pk, (parent, tree_id)) for pk, parent, tree_id in self.filter(
+                pk__in=chunk).values_list('pk', 'parent', 'tree_id'))
+        if len(nodes) != len(set(moves) | set(parent for parent in moves.values() if parent is not None)):
+            raise ValueError('Some of the categories do not exist')
+        trees = set(tree_id for parent, tree_id in nodes.values())
+        list(self.select_for_update().filter(tree_id__in=trees).values_list('pk', flat=True))
+
+        by_parent = {}
+        for pk in sorted(moves):
+            by_parent.setdefault(moves[pk], []).append(pk)
+        for parent, pks in by_parent.items():
+            for chunk in chunks(pks):
+                self.filter(pk__in=chunk).update(parent=parent)
+        self.rebuild_trees(trees, appended=sorted(moves))
+        old_parents = [nodes[pk][0] for pk in moves if nodes[pk][0] is not None]
+        self._tree_changed(list(moves) + old_parents, list(moves))
+
+    def _tree_changed(self, pks, changed):
+        """
+        Visibility, change feed and search index after bulk_add or bulk_move,
+        which do not send the save signals
+        """
+        if deferred_visibility():
+            DirtyCategory.objects.mark(pks)
+        else:
+            self.refresh_visibility(pks)
+        self.forget_shown(changed, descendants=True)
+        Change.objects.record('category', changed)
+        from cmsplugin_media_center import search  # search imports this module
+        for chunk in chunks(changed):
+            search.index_queryset('category', self.filter(pk__in=chunk))
+
+    def rebuild_trees(self, tree_ids, appended=()):
+        """
+        Renumbers tree_id, lft, rght and level of the categories of the given
+        trees from their parents, like mptt's rebuild but for these trees only.
+        Siblings keep their order, the categories of appended come after them.
+        A root found in the tree of another root gets a tree of its own.
+        Only the changed rows are written, with one UPDATE per 500 of them.
+        Returns the number of updated categories.
+        """
+        nodes = {}
+        for chunk in chunks(tree_ids, 100):
+            for row in self.filter(tree_id__in=chunk).values_list('pk', 'parent', 'tree_id', 'lft', 'rght', 'level'):
+                nodes[row[0]] = row[1:]
+        position = dict((pk, index) for index, pk in enumerate(appended))
+        children = {}
+        for pk, node in nodes.items():
+            children.setdefault(node[0], []).append(pk)
+
+        def order(pk):
+            return pk in position, position.get(pk, 0), nodes[pk][1], nodes[pk][2], pk
+
+        updates = []
+
+        def visit(pk, tree_id, lft, level):
+            rght = lft + 1
+            for child in sorted(children.get(pk, ()), key=order):
+                rght = visit(child, tree_id, rght, level + 1) + 1
+            if nodes[pk][1:] != (tree_id, lft, rght, level):
+                updates.append((pk, tree_id, lft, rght, level))
+            visited.add(pk)
+            return rght
+
+        visited, used = set(), set()
+        next_tree = (self.aggregate(tree=Max('tree_id'))['tree'] or 0) + 1
+        for root in sorted(children.get(None, ()), key=lambda pk: (nodes[pk][2], pk)):
+            tree_id = nodes[root][1]
+            if tree_id in used:
+                tree_id, next_tree = next_tree, next_tree + 1
+            used.add(tree_id)
+            visit(root, tree_id, 1, 0)
+        if len(visited) != len(nodes):
+            raise ValueError('A category can not be moved into its own subtree')
+
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        pk_column = qn(self.model._meta.pk.column)
+        for chunk in chunks(updates):
+            connection.cursor().execute('UPDATE %s SET %s WHERE %s IN (%s)' % (
+                qn(self.model._meta.db_table),
+                ', '.join('%s = CASE %s %s END' % (column, pk_column, ' '.join(
+                    'WHEN %d THEN %d' % (update[0], update[index]) for update in chunk))
+                    for index, column in enumerate(('tree_id', 'lft', 'rght', 'level'), 1)),
+                pk_column, ', '.join('%d' % update[0] for update in chunk)))
+        return len(updates)
+
     def show_subtree(self, include_self=True, from_node=None, depth=None):
         """
         If from_node argument is omitted we start from roots
@@ -35,8 +346,61 @@ class PictureCategoryManager(TreeManager):
         return reduce(lambda x, y: x | y, (
             node.get_visible_descendants(include_self=include_self, depth=depth) for node in nodes))
 
+    @use_primary()
+    @timed('refresh_visibility')
+    @retry_on_deadlock()
+    def refresh_visibility(self, pks):
+        """
+        Recomputes is_visible of the given categories and all their ancestors.
+
+        Instead of saving the categories one by one this runs a fixed number of
+        queries per tree level and one UPDATE for each visibility value.
+        The visibility of the untouched children is taken from the database.
+        Returns the pks of the categories whose visibility changed.
+        """
+        fields = ('id', 'parent', 'level', 'is_published', 'is_visible')
+        nodes, pending = {}, set(pks)
+        while pending:
+            for chunk in chunks(pending):
+                for node in self.filter(pk__in=chunk).values(*fields):
+                    nodes[node['id']] = node
+            pending = set(node['parent'] for node in nodes.values() if node['parent']) - set(nodes)
+
+        # Lock the rows root first, the same order update_ancestors_visibility uses
+        for chunk in chunks(nodes):
+            for node in self.filter(pk__in=chunk).select_for_update().order_by('tree_id', 'lft').values(*fields):
+                nodes[node['id']] = node
+
+        with_pictures, visible_children = set(), set()
+        for chunk in chunks(nodes):
+            with_pictures.update(
+                Picture.objects.filter(folder__in=chunk).values_list('folder', flat=True).order_by().distinct())
+            visible_children.update(
+                parent for pk, parent in self.filter(parent__in=chunk, is_visible=True).values_list('pk', 'parent')
+                if pk not in nodes)
+
+        changed = {}
+        for node in sorted(nodes.values(), key=lambda node: -node['level']):
+            pk = node['id']
+            visibility = node['is_published'] and (pk in with_pictures or pk in visible_children)
+            if visibility and node['parent']:
+                visible_children.add(node['parent'])
+            if visibility != node['is_visible']:
+                changed[pk] = visibility
+
+        for visibility in (True, False):
+            for chunk in chunks(pk for pk in changed if changed[pk] == visibility):
+                self.filter(pk__in=chunk).update(is_visible=visibility)
 
-class PictureCategory(OrderedMPTTModel):
+        self.forget_shown(Change.objects.record_subtrees(list(changed)))
+
+        levels = [node['level'] for node in nodes.values()]
+        current_span().incr('categories', len(nodes))
+        current_span().incr('depth', max(levels) - min(levels) + 1 if levels else 0)
+        return list(changed)
+
+
+class PictureCategory(TrackedFieldsMixin, OrderedMPTTModel):
 
     parent = TreeForeignKey('self', null=True, blank=True, related_name='children')
     title = models.CharField(_(u'Title'), max_length=255)
@@ -44,6 +408,10 @@ class PictureCategory(OrderedMPTTModel):
     slug = models.SlugField(unique=True, max_length=255, db_index=True)
     is_published = models.BooleanField(_(u'Published'), default=False, db_index=True)
     is_visible = models.BooleanField(_(u'Visible'), default=False)
+    # Written by cmsplugin_media_center.counters, never by save
+    views = models.PositiveIntegerField(_(u'Views'), default=0, editable=False, db_index=True)
+    # Last save, the lastmod of the sitemaps; null for categories not saved since it was added
+    modified_at = models.DateTimeField(_(u'Modified at'), auto_now=True, null=True)
     objects = PictureCategoryManager()
 
     class Meta:
@@ -72,19 +440,108 @@ class PictureCategory(OrderedMPTTModel):
         else:
             return self.is_published and (self.pictures.exists() or self.has_visible_children())
 
+    # Only a new category, or a change of these, of its pictures or of its
+    # children (save_visibility) can change the visibility
+    tracked_fields = ('is_published', 'parent_id')
+
+    @use_primary()
     def save(self, *args, **kwargs):
+        """
+        Saves the row and updates the visibility in one transaction. When the
+        transaction is retried after a deadlock it starts again from the
+        instance as it was before the first attempt.
+        """
+        skip_view_counts(self, kwargs)
+        initial, adding = dict(self.__dict__), self._state.adding
+
+        @retry_on_deadlock()
+        def save_with_visibility():
+            self.__dict__.update(initial)
+            self._state.adding = adding
+            self._save_with_visibility(*args, **kwargs)
+
+        save_with_visibility()
+
+    def _save_with_visibility(self, *args, **kwargs):
+        changed_fields = self.changed_fields()
+        old_parent = self.initial_value('parent_id') if 'parent_id' in changed_fields else None
+        refresh = self.__dict__.pop('_refresh_visibility', False)
+        moved = 'parent_id' in changed_fields and not self._state.adding
+        if not (self._state.adding or changed_fields or refresh):
+            super(PictureCategory, self).save(*args, **kwargs)
+            self.reset_tracked_fields()
+            return
+        if deferred_visibility():
+            super(PictureCategory, self).save(*args, **kwargs)
+            self.reset_tracked_fields()
+            if moved:
+                PictureCategory.objects.forget_shown([self.pk], descendants=True)
+            DirtyCategory.objects.mark([self.pk, old_parent])
+            return
         visibility = self.check_visibility()
         changed = False
         if visibility != self.is_visible:
             self.is_visible = visibility
             changed = True
         super(PictureCategory, self).save(*args, **kwargs)
-        if changed and self.parent and self.parent.is_visible != self.is_visible:
-            self.parent.save()
+        self.reset_tracked_fields()
+        if changed:
+            PictureCategory.objects.forget_shown(Change.objects.record_subtrees([self.pk]))
+        if moved:
+            # Under other ancestors the category and its descendants may be shown or not
+            PictureCategory.objects.forget_shown([self.pk], descendants=True)
+        # A moved category can make its new parent visible
+        if (changed or 'parent_id' in changed_fields) and self.parent_id:
+            self.update_ancestors_visibility()
+        if old_parent:
+            # The old parent may have been visible only because of this category
+            PictureCategory.objects.refresh_visibility([old_parent])
+
+    def save_visibility(self):
+        """
+        Saves the category and recomputes its visibility, after one of its
+        pictures or children was added, moved or deleted
+        """
+        self._refresh_visibility = True
+        self.save()
+
+    @use_primary()
+    @retry_on_deadlock()
+    def update_ancestors_visibility(self):
+        """
+        Propagates the visibility of self up to the root.
+
+        The ancestor rows are locked root first, which is the same order for every
+        writer in the tree, so two editors saving sibling categories can not both
+        decide the visibility of their common parent. Nothing outside the ancestor
+        chain is locked.
+        """
+        with span('visibility_cascade') as cascade:
+            ancestors = list(self.get_ancestors().select_for_update())
+            visibility, updated = self.is_visible, {}
+            for ancestor in reversed(ancestors):
+                if ancestor.is_visible == visibility:
+                    break
+                cascade.incr('depth')
+                visibility = ancestor.check_visibility()
+                if visibility == ancestor.is_visible:
+                    break
+                PictureCategory.objects.filter(pk=ancestor.pk).update(is_visible=visibility)
+                updated[ancestor.pk] = visibility
+            PictureCategory.objects.forget_shown(Change.objects.record_subtrees(list(updated)))
+
+        # Keep the parents we already have in memory in sync with the database
+        cache_name = self._meta.get_field('parent').get_cache_name()
+        node = getattr(self, cache_name, None)
+        while node is not None and node.pk in updated:
+            node.is_visible = updated[node.pk]
+            node = getattr(node, cache_name, None)
 
     def get_cover(self):
-        if self.pictures.exists():
-            return self.pictures.order_by('-is_cover', 'pk')[0]
+        if not hasattr(self, '_cover'):
+            covers = list(self.pictures.order_by('-is_cover', 'pk').select_related('image')[:1])
+            self._cover = covers[0] if covers else None
+        return self._cover
 
     def get_visible_descendants(self, include_self=True, depth=None):
         """
@@ -109,25 +566,154 @@ class PictureCategory(OrderedMPTTModel):
 
 
 @receiver(post_delete, sender=PictureCategory)
+@use_primary()
 def update_visibility_on_delete(sender, instance, **kwargs):
     """
     We must update is_visible of all parent categories in case they are
     visible because of this subcategory we are deleting at this very moment
     """
-    if instance.parent:
-        instance.parent.save()
+    if instance.parent_id and deferred_visibility():
+        DirtyCategory.objects.mark([instance.parent_id])
+    elif instance.parent:
+        instance.parent.save_visibility()
+
+
+def duplicate_distance(distance=None):
+    """
+    distance, MEDIA_CENTER_DUPLICATE_DISTANCE by default. The index of the hash
+    parts only finds hashes less than HASH_CHUNKS bits apart, a larger distance
+    would silently miss some of the near duplicates.
+    """
+    if distance is None:
+        distance = settings.DUPLICATE_DISTANCE
+        if not 0 <= distance < HASH_CHUNKS:
+            raise ImproperlyConfigured(
+                'MEDIA_CENTER_DUPLICATE_DISTANCE must be between 0 and %d.' % (HASH_CHUNKS - 1))
+    elif not 0 <= distance < HASH_CHUNKS:
+        raise ValueError('The distance must be between 0 and %d.' % (HASH_CHUNKS - 1))
+    return distance
 
 
-class Picture(models.Model):
+def phash_fields(value):
+    """
+    Values of the hash fields of Picture for an unsigned 64 bit hash
+    """
+    fields = dict(('phash_%d' % index, chunk) for index, chunk in enumerate(hash_chunks(value)))
+    fields['phash'] = value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+    return fields
+
+
+class PictureManager(models.Manager):
+    def search(self, query, offset=0, limit=20):
+        """
+        Pictures of shown categories matching the words of the query, best matches first
+        """
+        from cmsplugin_media_center import search  # search imports this module
+        return search.in_order(self.all(), search.search(query, 'picture', offset, limit, self.db))
+
+    def near_duplicates(self, phash, distance=None):
+        """
+        Pictures whose perceptual hash is at most distance bits away from phash, closest first.
+
+        The hash is also stored in HASH_CHUNKS indexed parts (multi-index hashing):
+        two hashes less than HASH_CHUNKS bits apart have at least one equal part,
+        so the candidates are the few pictures sharing a part, never the whole table.
+        """
+        return self.near_duplicates_in_bulk([phash], distance)[phash]
+
+    def near_duplicates_in_bulk(self, hashes, distance=None):
+        """
+        {phash: near_duplicates(phash)} of the given hashes, with one query per 100 of them
+        """
+        distance = duplicate_distance(distance)
+        found = dict((phash, []) for phash in hashes)
+        for chunk in chunks(sorted(found), 100):
+            parts = set((index, part) for phash in chunk for index, part in enumerate(hash_chunks(phash)))
+            lookup = reduce(lambda x, y: x | y, (Q(**{'phash_%d' % index: part}) for index, part in sorted(parts)))
+            candidates = list(self.filter(lookup).select_related('folder'))
+            for phash in chunk:
+                matches = [(hamming(phash, picture.phash_value), picture.pk, picture) for picture in candidates]
+                matches = sorted((match for match in matches if match[0] <= distance), key=lambda match: match[:2])
+                found[phash] = [picture for picture_distance, pk, picture in matches]
+        return found
+
+    def set_covers(self, categories):
+        """
+        Loads the covers of the categories, picked like PictureCategory.get_cover,
+        with two queries per 500 categories and one for the pictures
+        """
+        covers = {}
+        for chunk in chunks([category.pk for category in categories]):
+            pictures = self.filter(folder__in=chunk).values('folder').order_by()
+            covers.update(pictures.annotate(first=Min('pk')).values_list('folder', 'first'))
+            covers.update(pictures.filter(is_cover=True).annotate(first=Min('pk')).values_list('folder', 'first'))
+        pictures = {}
+        for chunk in chunks(covers.values()):
+            pictures.update((picture.pk, picture) for picture in self.filter(pk__in=chunk).select_related('image'))
+        for category in categories:
+            category._cover = pictures.get(covers.get(category.pk))
+        return categories
+
+    @use_primary()
+    @retry_on_deadlock()
+    def reorder(self, folder, pks):
+        """
+        Puts the pictures of the category in the order of pks, which must
+        list all of them, with one UPDATE. Returns the pks of the moved pictures.
+        """
+        pks = [int(pk) for pk in pks]
+        current = dict(self.select_for_update().filter(folder=folder).values_list('pk', 'order'))
+        if sorted(pks) != sorted(current):
+            raise ValueError('The order must list every picture of the category once')
+        moved = [(pk, order) for order, pk in enumerate(pks) if current[pk] != order]
+        if moved:
+            connection = connections[self.db]
+            qn = connection.ops.quote_name
+            pk_column = qn(self.model._meta.pk.column)
+            connection.cursor().execute('UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+                qn(self.model._meta.db_table), qn('order'), pk_column,
+                ' '.join('WHEN %d THEN %d' % move for move in moved),
+                pk_column, ', '.join('%d' % pk for pk, order in moved)))
+        moved = [pk for pk, order in moved]
+        Change.objects.record('picture', moved)
+        return moved
+
+
+class Picture(TrackedFieldsMixin, models.Model):
     folder = models.ForeignKey(PictureCategory, related_name='pictures')
     image = FilerImageField(related_name='+')
     title = models.CharField(verbose_name=_('Title'), max_length=255, blank=True, default='')
     description = models.TextField(verbose_name=_('Description'), blank=True, default='')
     is_cover = models.BooleanField(default=False, verbose_name=_('Use as cover'))
 
+    # Filled by the media_center_extract_metadata command, so we never open images while rendering
+    width = models.PositiveIntegerField(null=True, editable=False)
+    height = models.PositiveIntegerField(null=True, editable=False)
+    taken_at = models.DateTimeField(_('Taken at'), null=True, editable=False)
+    dominant_color = models.CharField(max_length=7, blank=True, default='', editable=False)
+    placeholder = models.TextField(blank=True, default='', editable=False)
+    metadata_updated_at = models.DateTimeField(null=True, editable=False, db_index=True)
+    # Perceptual hash of the image (signed, like the database column) and its parts for near_duplicates
+    phash = models.BigIntegerField(null=True, editable=False)
+    phash_0 = models.PositiveIntegerField(null=True, editable=False, db_index=True)
+    phash_1 = models.PositiveIntegerField(null=True, editable=False, db_index=True)
+    phash_2 = models.PositiveIntegerField(null=True, editable=False, db_index=True)
+    phash_3 = models.PositiveIntegerField(null=True, editable=False, db_index=True)
+    # Written by cmsplugin_media_center.counters, never by save
+    views = models.PositiveIntegerField(_('Views'), default=0, editable=False)
+    # Position in the category, set by PictureManager.reorder
+    order = models.PositiveIntegerField(_('Order'), default=0, editable=False)
+    # Last save, see PictureCategory.modified_at
+    modified_at = models.DateTimeField(_('Modified at'), auto_now=True, null=True)
+
+    objects = PictureManager()
+
     class Meta:
+        ordering = ['order', 'id']
         verbose_name = _('Picture')
         verbose_name_plural = _('Pictures')
+        # The popular and the editors' ordering of the pictures of a category
+        index_together = [('folder', 'views'), ('folder', 'order')]
 
     def __unicode__(self):
         if self.title:
@@ -135,40 +721,487 @@ class Picture(models.Model):
         else:
             return "Picture {}".format(self.pk)
 
-    def __init__(self, *args, **kwargs):
-        super(Picture, self).__init__(*args, **kwargs)
-        self._update_current_folder(self)
-
-    def _update_current_folder(self, instance):
-        instance._current_folder = self.folder_id
+    # Moving the picture changes the visibility of its categories, a new image its metadata
+    tracked_fields = ('folder_id', 'image_id')
 
     def save(self, *args, **kwargs):
-        if self._current_folder is None:
-            self._update_current_folder(self)
+        skip_view_counts(self, kwargs)
+        if 'image_id' in self.changed_fields() and not self._state.adding:
+            self.clear_metadata()
+        if self._state.adding and not self.order:
+            # New pictures come last
+            last = Picture.objects.filter(folder=self.folder_id).aggregate(last=Max('order'))['last']
+            self.order = 0 if last is None else last + 1
         super(Picture, self).save(*args, **kwargs)
+        # After the post_save receivers, which compare with the old folder
+        self.reset_tracked_fields()
+
+    def clear_metadata(self):
+        """
+        Queues the picture for media_center_extract_metadata again
+        """
+        self.width = self.height = self.taken_at = self.metadata_updated_at = None
+        self.dominant_color = self.placeholder = ''
+        self.phash = self.phash_0 = self.phash_1 = self.phash_2 = self.phash_3 = None
+
+    @property
+    def phash_value(self):
+        """
+        The perceptual hash as an unsigned 64 bit number
+        """
+        if self.phash is not None:
+            return self.phash & ((1 << HASH_BITS) - 1)
+
+    def update_phash(self):
+        """
+        Hashes the image right away instead of waiting for media_center_extract_metadata
+        """
+        f = self.image.file.storage.open(self.image.file.name, 'rb')
+        try:
+            fields = phash_fields(image_hash(f))
+        finally:
+            f.close()
+        Picture.objects.filter(pk=self.pk).update(**fields)
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def near_duplicates(self):
+        """
+        Other pictures of a near-identical image
+        """
+        if self.phash is None:
+            return []
+        return [picture for picture in Picture.objects.near_duplicates(self.phash_value) if picture.pk != self.pk]
+
+    @property
+    def image_url(self):
+        return self.image.url
+
+    @property
+    def thumbnail_size(self):
+        """
+        Width and height of the thumbnail in the templates, None until the metadata is extracted
+        """
+        if self.width and self.height:
+            return fit((self.width, self.height), THUMBNAIL_OPTIONS['size'])
 
 
 @receiver(post_save, sender=Picture)
-def set_category_visibility_on_save(sender, instance, **kwargs):
-    if instance._current_folder != instance.folder_id:
-        PictureCategory.objects.get(pk=instance._current_folder).save()
-        instance._update_current_folder(instance)
+@use_primary()
+def set_category_visibility_on_save(sender, instance, created=False, **kwargs):
+    old_folder = instance.initial_value('folder_id')
+    if not created and old_folder == instance.folder_id:
+        # Only adding or moving a picture changes the visibility
+        return
+    moved_from = old_folder if old_folder and old_folder != instance.folder_id else None
+    if deferred_visibility():
+        DirtyCategory.objects.mark([moved_from, instance.folder_id])
+        return
+    if moved_from:
+        PictureCategory.objects.get(pk=moved_from).save_visibility()
     if not instance.folder.is_visible and instance.folder.is_published:
-        instance.folder.save()
+        instance.folder.save_visibility()
 
 
 @receiver(post_delete, sender=Picture)
+@use_primary()
 def set_category_visibility_on_delete(sender, instance, **kwargs):
+    if deferred_visibility():
+        DirtyCategory.objects.mark([instance.folder_id])
+        return
     try:
         if instance.folder.is_published:
-            instance.folder.save()
+            instance.folder.save_visibility()
     except PictureCategory.DoesNotExist:
         pass
 
 
+class DirtyCategoryManager(models.Manager):
+    def mark(self, pks):
+        """
+        Queues the categories for a visibility recompute.
+        Marking a category that is already queued only refreshes marked_at.
+        """
+        pks = set(pk for pk in pks if pk)
+        now = timezone.now()
+        # Written by name like ThumbnailURL.objects.store, the queue is read on the primary
+        rows = self.using(settings.WRITE_DATABASE)
+        queued = set(rows.filter(pk__in=pks).values_list('pk', flat=True))
+        rows.filter(pk__in=queued).update(marked_at=now)
+        for pk in pks - queued:
+            try:
+                with atomic(using=settings.WRITE_DATABASE):
+                    rows.create(category_id=pk, marked_at=now)
+            except IntegrityError:
+                # Somebody else queued it in the meantime
+                pass
+
+    @use_primary()
+    def process(self, batch_size=500):
+        """
+        Recomputes the visibility of the oldest batch_size queued categories
+        and removes them from the queue. Returns the number of processed categories.
+        """
+        started = timezone.now()
+        pks = list(self.order_by('marked_at').values_list('pk', flat=True)[:batch_size])
+        if pks:
+            PictureCategory.objects.refresh_visibility(pks)
+            # Categories marked again while we were working stay in the queue
+            self.filter(pk__in=pks, marked_at__lte=started).delete()
+        return len(pks)
+
+
+class DirtyCategory(models.Model):
+    """
+    Categories waiting for a visibility recompute when
+    MEDIA_CENTER_VISIBILITY_UPDATES = 'deferred'. The queue is processed
+    by the media_center_worker management command.
+
+    category_id is not a foreign key on purpose: categories are queued from
+    delete signals too and may not exist anymore when the worker gets to them.
+    """
+    category_id = models.PositiveIntegerField(primary_key=True)
+    marked_at = models.DateTimeField(db_index=True)
+    objects = DirtyCategoryManager()
+
+
+class ThumbnailURLManager(models.Manager):
+    def for_images(self, images):
+        """
+        {(image pk, alias): url} of the stored thumbnails of the given filer images,
+        in one query. Rows of an older version of an image are left out.
+        """
+        modified = dict((image.pk, image.modified_at) for image in images if image is not None)
+        urls = {}
+        for chunk in chunks(modified):
+            for image_id, alias, source_modified, url in self.filter(image__in=chunk).values_list(
+                    'image', 'alias', 'source_modified', 'url'):
+                if source_modified == modified[image_id]:
+                    urls[(image_id, alias)] = url
+        return urls
+
+    def store(self, image, alias, url):
+        """
+        Writes to MEDIA_CENTER_WRITE_DATABASE by name, not through the router,
+        so a render storing a URL does not pin its client to the primary.
+        """
+        rows = self.using(settings.WRITE_DATABASE)
+        if rows.filter(image=image, alias=alias).update(source_modified=image.modified_at, url=url):
+            return
+        try:
+            with atomic(using=settings.WRITE_DATABASE):
+                rows.create(image=image, alias=alias, source_modified=image.modified_at, url=url)
+        except IntegrityError:
+            # Another render stored it in the meantime
+            pass
+
+
+class ThumbnailURL(models.Model):
+    """
+    URLs of the generated thumbnails, so the templates do not have to ask
+    the storage whether a thumbnail exists, which is a round trip per
+    thumbnail on remote storages. A row is only used while the modification
+    time of the image is the one the thumbnail was generated from.
+    """
+    image = models.ForeignKey('filer.Image', related_name='+')
+    alias = models.CharField(max_length=64)
+    source_modified = models.DateTimeField()
+    url = models.CharField(max_length=1024)
+    objects = ThumbnailURLManager()
+
+    class Meta:
+        unique_together = ('image', 'alias')
+
+
+@receiver(post_save, sender=Image)
+def forget_thumbnail_urls(sender, instance, **kwargs):
+    ThumbnailURL.objects.filter(image=instance).delete()
+
+
+class ChangeManager(models.Manager):
+    def record(self, kind, pks, deleted=False):
+        """
+        Adds a change of the given categories or pictures to the feed
+        """
+        now = timezone.now()
+        for chunk in chunks(pks):
+            self.bulk_create([Change(kind=kind, object_id=pk, deleted=deleted, created_at=now) for pk in chunk])
+
+    def record_queryset(self, kind, queryset, batch_size=1000):
+        """
+        Records the objects of the queryset in batches, for the ones created without signals (bulk_create)
+        """
+        pks = queryset.order_by('pk').values_list('pk', flat=True)
+        last_pk = 0
+        while True:
+            batch = list(pks.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1]
+            self.record(kind, batch)
+
+    def record_subtrees(self, pks):
+        """
+        Records the categories whose visibility changed with their visible
+        descendants and the pictures of all of them: whether those are shown
+        changed too, although their rows did not. Returns the recorded categories.
+        """
+        from cmsplugin_media_center.publish import descendant_pks  # publish imports this module
+        if not pks:
+            return []
+        categories = set(pks)
+        for chunk in chunks(descendant_pks(pks)):
+            categories.update(PictureCategory.objects.filter(pk__in=chunk, is_visible=True).values_list('pk', flat=True))
+        categories = sorted(categories)
+        self.record('category', categories)
+        for chunk in chunks(categories):
+            self.record_queryset('picture', Picture.objects.filter(folder__in=chunk))
+        return categories
+
+    def settled_before(self):
+        """
+        Time before which every change has committed or was rolled back:
+        CHANGES_GAP_TIMEOUT seconds ago, or earlier on PostgreSQL when a
+        transaction which has written to the primary is open for longer.
+        """
+        settled = timezone.now() - timedelta(seconds=settings.CHANGES_GAP_TIMEOUT)
+        connection = connections[settings.WRITE_DATABASE]
+        if connection.vendor != 'postgresql':
+            return settled
+        cursor = connection.cursor()
+        # Read-only transactions have no backend_xid, they never hold a sequence number
+        cursor.execute('SELECT MIN(xact_start) FROM pg_stat_activity WHERE datname = current_database() '
+                       'AND backend_xid IS NOT NULL AND pid <> pg_backend_pid()')
+        started = cursor.fetchone()[0]
+        if started is None:
+            return settled
+        if not django_settings.USE_TZ:
+            started = timezone.make_naive(started, timezone.get_default_timezone())
+        # The sequence number of a change is taken a little after its created_at
+        return min(settled, started - timedelta(seconds=settings.CHANGES_GAP_TIMEOUT))
+
+    def since(self, seq, limit=500):
+        """
+        At most limit changes after seq, oldest first.
+
+        Sequence numbers are taken when a change is written, not when its
+        transaction commits, so a missing number can still show up. The
+        result stops before such a gap unless it is older than
+        settled_before(), then the number belonged to a transaction that
+        was rolled back.
+        """
+        changes = list(self.filter(seq__gt=seq).order_by('seq')[:limit])
+        cutoff = self.settled_before()
+        expected = seq + 1
+        for index, change in enumerate(changes):
+            if change.seq != expected and change.created_at > cutoff:
+                return changes[:index]
+            expected = change.seq + 1
+        return changes
+
+    def compact(self, before):
+        """
+        Deletes the changes older than before which are followed by a newer
+        change of the same object, the newest one tells the whole story.
+        The last change of every object is kept, so since=0 is still the
+        complete gallery. Returns the number of deleted changes.
+        """
+        superseded = self.filter(created_at__lt=before).values('kind', 'object_id').annotate(
+            last=Max('seq'), changes=Count('seq')).filter(changes__gt=1).order_by()
+        deleted = 0
+        for chunk in chunks(superseded.iterator(), 100):
+            lookup = reduce(lambda x, y: x | y, (
+                Q(kind=row['kind'], object_id=row['object_id'], seq__lt=row['last']) for row in chunk))
+            queryset = self.filter(lookup)
+            deleted += queryset.count()
+            queryset.delete()
+        return deleted
+
+
+class Change(models.Model):
+    """
+    Feed of the changes of the categories and pictures for the clients that keep
+    a copy of the gallery, see cmsplugin_media_center.views.changes_view.
+    Every save and delete adds a row, so do the visibility updates of the cascade.
+    """
+    KINDS = (
+        ('category', _('Category')),
+        ('picture', _('Picture')),
+    )
+    seq = models.AutoField(primary_key=True)
+    kind = models.CharField(max_length=16, choices=KINDS)
+    object_id = models.PositiveIntegerField()
+    deleted = models.BooleanField(default=False)
+    created_at = models.DateTimeField(default=timezone.now)
+    objects = ChangeManager()
+
+
+@receiver(post_save, sender=PictureCategory)
+def record_category_change(sender, instance, **kwargs):
+    Change.objects.record('category', [instance.pk])
+
+
+@receiver(post_delete, sender=PictureCategory)
+def record_category_delete(sender, instance, **kwargs):
+    Change.objects.record('category', [instance.pk], deleted=True)
+
+
+@receiver(post_save, sender=Picture)
+def record_picture_change(sender, instance, **kwargs):
+    Change.objects.record('picture', [instance.pk])
+
+
+@receiver(post_delete, sender=Picture)
+def record_picture_delete(sender, instance, **kwargs):
+    Change.objects.record('picture', [instance.pk], deleted=True)
+
+
+@receiver(post_save, sender=PictureCategory)
+def index_category(sender, instance, using=None, **kwargs):
+    from cmsplugin_media_center import search  # search imports this module
+    search.index('category', [instance], using)
+
+
+@receiver(post_delete, sender=PictureCategory)
+def unindex_category(sender, instance, using=None, **kwargs):
+    from cmsplugin_media_center import search  # search imports this module
+    search.unindex('category', [instance.pk], using)
+
+
+@receiver(post_save, sender=Picture)
+def index_picture(sender, instance, using=None, **kwargs):
+    from cmsplugin_media_center import search  # search imports this module
+    search.index('picture', [instance], using)
+
+
+@receiver(post_delete, sender=Picture)
+def unindex_picture(sender, instance, using=None, **kwargs):
+    from cmsplugin_media_center import search  # search imports this module
+    search.unindex('picture', [instance.pk], using)
+
+
+@receiver(post_syncdb)
+def create_search_index(sender, db='default', **kwargs):
+    if sender.__name__ == __name__:
+        from cmsplugin_media_center import search  # search imports this module
+        search.create_index(db)
+
+
+class PublishedCategory(models.Model):
+    """
+    Flat copy of a shown category for the public pages, written by
+    cmsplugin_media_center.publish from the change feed. With
+    MEDIA_CENTER_PUBLISHED_READS the gallery plugin reads only the published
+    tables, so the public pages do not wait for the editors' transactions.
+
+    The primary key is the one of the category. tree_id, lft and level are
+    copied from the tree when categories are published or moved and only
+    their order is meaningful.
+    """
+    id = models.PositiveIntegerField(primary_key=True)
+    parent_id = models.PositiveIntegerField(null=True)
+    tree_id = models.PositiveIntegerField()
+    lft = models.PositiveIntegerField()
+    level = models.PositiveIntegerField()
+    slug = models.SlugField(max_length=255)
+    # Slugs from the root down to the category, separated by "/"
+    path = models.CharField(max_length=1024)
+    title = models.CharField(max_length=255)
+    description = models.TextField(blank=True, default='')
+    cover_id = models.PositiveIntegerField(null=True)
+    picture_count = models.PositiveIntegerField(default=0)
+    child_count = models.PositiveIntegerField(default=0)
+    views = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['tree_id', 'lft']
+        index_together = [('tree_id', 'lft')]
+
+    def __unicode__(self):
+        return unicode(self.title)
+
+    def get_cover(self):
+        if not hasattr(self, '_cover'):
+            covers = PublishedPicture.objects.filter(pk=self.cover_id).select_related('image')
+            covers = list(covers[:1]) if self.cover_id else []
+            self._cover = covers[0] if covers else None
+        return self._cover
+
+
+class PublishedPictureManager(models.Manager):
+    def set_covers(self, categories):
+        """
+        Loads the covers of the published categories in one query
+        """
+        covers = self.filter(pk__in=[category.cover_id for category in categories if category.cover_id])
+        covers = dict((cover.pk, cover) for cover in covers.select_related('image'))
+        for category in categories:
+            category._cover = covers.get(category.cover_id)
+        return categories
+
+
+class PublishedPicture(models.Model):
+    """
+    Flat copy of a picture of a shown category, see PublishedCategory
+    """
+    id = models.PositiveIntegerField(primary_key=True)
+    category_id = models.PositiveIntegerField()
+    image = models.ForeignKey('filer.Image', related_name='+')
+    image_url = models.CharField(max_length=1024)
+    title = models.CharField(max_length=255, blank=True, default='')
+    description = models.TextField(blank=True, default='')
+    is_cover = models.BooleanField(default=False)
+    width = models.PositiveIntegerField(null=True)
+    height = models.PositiveIntegerField(null=True)
+    dominant_color = models.CharField(max_length=7, blank=True, default='')
+    placeholder = models.TextField(blank=True, default='')
+    views = models.PositiveIntegerField(default=0)
+    order = models.PositiveIntegerField(default=0)
+    objects = PublishedPictureManager()
+
+    class Meta:
+        index_together = [('category_id', 'views'), ('category_id', 'order')]
+
+    def __unicode__(self):
+        if self.title:
+            return unicode(self.title)
+        else:
+            return "Picture {}".format(self.pk)
+
+    @property
+    def thumbnail_size(self):
+        if self.width and self.height:
+            return fit((self.width, self.height), THUMBNAIL_OPTIONS['size'])
+
+
+class PublishStateManager(models.Manager):
+    def lock(self):
+        """
+        The state row, locked until the end of the transaction so only one
+        publisher applies changes at a time
+        """
+        self.get_or_create(pk=1)
+        return self.select_for_update().get(pk=1)
+
+
+class PublishState(models.Model):
+    """
+    Sequence number of the last change applied to the published tables
+    """
+    last_seq = models.PositiveIntegerField(default=0)
+    published_at = models.DateTimeField(null=True)
+    objects = PublishStateManager()
+
+
 class MediaPlugin(CMSPlugin):
     MEDIA_SKINS = (
         ('list', _('List view')),
         ('thumbnails', _('Thumbnail view')),
     )
+    ORDERINGS = (
+        ('tree', _('Tree order')),
+        ('popular', _('Most viewed first')),
+    )
     template = models.CharField(choices=MEDIA_SKINS, max_length=20, default='list')
+    ordering = models.CharField(_('Ordering'), choices=ORDERINGS, max_length=20, default='tree')
+
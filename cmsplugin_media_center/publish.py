@@ -0,0 +1,235 @@
+"""
+Publishing of the shown categories and pictures to the read model
+(PublishedCategory and PublishedPicture) the public pages use with
+MEDIA_CENTER_PUBLISHED_READS.
+
+publish() applies the next changes of the change feed, rebuild() copies
+the whole gallery again. Either runs in one transaction, so readers see
+the read model before or after a batch, never in between.
+"""
+from functools import reduce
+
+from django.db import connections
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+
+from cmsplugin_media_center.conf import settings
+from cmsplugin_media_center.models import (
+    Change, Picture, PictureCategory, PublishedCategory, PublishedPicture, PublishState)
+from cmsplugin_media_center.routers import use_primary
+from cmsplugin_media_center.utils.db import atomic, chunks
+
+
+# Fields written when a published category is updated, the tree fields are
+# copied tree by tree by copy_tree_fields
+UPDATED_FIELDS = ('parent_id', 'slug', 'path', 'title', 'description', 'cover_id',
+                  'picture_count', 'child_count', 'views')
+
+
+def tree_lookup(nodes, relation):
+    """
+    Q matching the ancestors (relation 'ancestors') or the descendants
+    of nodes, (tree_id, lft, rght) tuples
+    """
+    if relation == 'ancestors':
+        lookups = (Q(tree_id=tree_id, lft__lt=lft, rght__gt=rght) for tree_id, lft, rght in nodes)
+    else:
+        lookups = (Q(tree_id=tree_id, lft__gt=lft, rght__lt=rght) for tree_id, lft, rght in nodes)
+    return reduce(lambda x, y: x | y, lookups)
+
+
+def descendant_pks(pks):
+    descendants = set()
+    for chunk in chunks(pks, 100):
+        nodes = list(PictureCategory.objects.filter(pk__in=chunk).values_list('tree_id', 'lft', 'rght'))
+        if nodes:
+            descendants.update(PictureCategory.objects.filter(
+                tree_lookup(nodes, 'descendants')).values_list('pk', flat=True))
+    return descendants
+
+
+def category_rows(pks):
+    """
+    {pk: PublishedCategory} of the shown categories among pks
+    """
+    rows = {}
+    for chunk in chunks(pks, 100):
+        shown = PictureCategory.objects.shown_pks(chunk)
+        categories = list(PictureCategory.objects.filter(pk__in=shown))
+        if not categories:
+            continue
+        ancestors = sorted(PictureCategory.objects.filter(tree_lookup(
+            [(category.tree_id, category.lft, category.rght) for category in categories], 'ancestors')).values_list(
+            'tree_id', 'lft', 'rght', 'slug'))
+        pictures = Picture.objects.filter(folder__in=shown).values('folder').order_by()
+        counts = dict(pictures.annotate(count=Count('pk')).values_list('folder', 'count'))
+        covers = dict(pictures.annotate(first=Min('pk')).values_list('folder', 'first'))
+        # Like PictureCategory.get_cover: the first picture marked as cover, else the first one
+        covers.update(pictures.filter(is_cover=True).annotate(first=Min('pk')).values_list('folder', 'first'))
+        children = dict(PictureCategory.objects.filter(parent__in=shown, is_visible=True).values(
+            'parent').order_by().annotate(count=Count('pk')).values_list('parent', 'count'))
+        for category in categories:
+            path = [slug for tree_id, lft, rght, slug in ancestors
+                    if tree_id == category.tree_id and lft < category.lft and rght > category.rght]
+            rows[category.pk] = PublishedCategory(
+                id=category.pk, parent_id=category.parent_id, tree_id=category.tree_id,
+                lft=category.lft, level=category.level, slug=category.slug,
+                path='/'.join(path + [category.slug]), title=category.title,
+                description=category.description, cover_id=covers.get(category.pk),
+                picture_count=counts.get(category.pk, 0), child_count=children.get(category.pk, 0),
+                views=category.views)
+    return rows
+
+
+def write_pictures(pks):
+    """
+    Publishes the pictures among pks whose category is published, removes the others
+    """
+    for chunk in chunks(pks):
+        pictures = list(Picture.objects.filter(pk__in=chunk).select_related('image'))
+        shown = set(PublishedCategory.objects.filter(
+            pk__in=set(picture.folder_id for picture in pictures)).values_list('pk', flat=True))
+        PublishedPicture.objects.filter(pk__in=chunk).delete()
+        PublishedPicture.objects.bulk_create([PublishedPicture(
+            id=picture.pk, category_id=picture.folder_id, image_id=picture.image_id,
+            image_url=picture.image.url, title=picture.title, description=picture.description,
+            is_cover=picture.is_cover, width=picture.width, height=picture.height,
+            dominant_color=picture.dominant_color, placeholder=picture.placeholder,
+            views=picture.views, order=picture.order) for picture in pictures if picture.folder_id in shown])
+
+
+def copy_tree_fields(trees):
+    """
+    Copies tree_id, lft and level of the published categories of the given
+    trees, one statement per chunk of trees. Inserting or moving a category
+    shifts the tree fields of others without a change of their own.
+    """
+    connection = connections[settings.WRITE_DATABASE]
+    qn = connection.ops.quote_name
+    published, live = qn(PublishedCategory._meta.db_table), qn(PictureCategory._meta.db_table)
+    join = '%s.%s = %s.%s' % (live, qn(PictureCategory._meta.pk.column),
+                              published, qn(PublishedCategory._meta.pk.column))
+    columns = ', '.join('%s = (SELECT %s FROM %s WHERE %s)' % (qn(column), qn(column), live, join)
+                        for column in ('tree_id', 'lft', 'level'))
+    # Filtered on the published tree_id: a row moved by an earlier chunk is only copied again
+    for chunk in chunks(sorted(trees)):
+        connection.cursor().execute('UPDATE %s SET %s WHERE %s IN (%s)' % (
+            published, columns, qn('tree_id'), ', '.join(['%s'] * len(chunk))), chunk)
+
+
+def values(model, pks, field):
+    found = set()
+    for chunk in chunks(pks):
+        found.update(model.objects.filter(pk__in=chunk).values_list(field, flat=True))
+    return found
+
+
+def apply(category_pks, picture_pks):
+    """
+    Brings the published rows of the given categories and pictures up to date,
+    with everything else they affect
+    """
+    # A picture changes the count and the cover of its old and new category,
+    # a category the child count of its old and new parent
+    dirty = set(category_pks)
+    dirty.update(values(PublishedPicture, picture_pks, 'category_id'))
+    dirty.update(values(Picture, picture_pks, 'folder'))
+    dirty.update(values(PublishedCategory, category_pks, 'parent_id'))
+    dirty.update(values(PictureCategory, category_pks, 'parent'))
+    dirty.discard(None)
+
+    rows = category_rows(dirty)
+    published = {}
+    for chunk in chunks(dirty):
+        published.update((pk, (path, tree_id, lft)) for pk, path, tree_id, lft in PublishedCategory.objects.filter(
+            pk__in=chunk).values_list('pk', 'path', 'tree_id', 'lft'))
+    # Showing, hiding or moving a category changes the paths of its descendants
+    # and maybe whether they are shown, without a change of their own
+    moved = [pk for pk in dirty if (published[pk][0] if pk in published else None) !=
+             (rows[pk].path if pk in rows else None)]
+    # Reordering siblings changes the tree fields of their descendants too
+    reordered = any(published[pk][1:] != (row.tree_id, row.lft) for pk, row in rows.items() if pk in published)
+    # The old and new trees of the changed categories. Moving a category to
+    # another tree renumbers the trees between the two (reordered roots).
+    trees = set(tree_id for path, tree_id, lft in published.values()) | set(row.tree_id for row in rows.values())
+    for pk, row in rows.items():
+        if pk in published and published[pk][1] != row.tree_id:
+            trees.update(range(min(published[pk][1], row.tree_id), max(published[pk][1], row.tree_id) + 1))
+    descendants = descendant_pks(moved) - dirty
+    rows.update(category_rows(descendants))
+    for chunk in chunks(descendants):
+        published.update((pk, None) for pk in PublishedCategory.objects.filter(
+            pk__in=chunk).values_list('pk', flat=True))
+
+    gone = [pk for pk in published if pk not in rows]
+    for chunk in chunks(gone):
+        PublishedPicture.objects.filter(category_id__in=chunk).delete()
+        PublishedCategory.objects.filter(pk__in=chunk).delete()
+    added = [row for pk, row in rows.items() if pk not in published]
+    for pk, row in rows.items():
+        if pk in published:
+            row.save(update_fields=UPDATED_FIELDS)
+    PublishedCategory.objects.bulk_create(added)
+
+    pictures = set(picture_pks)
+    for chunk in chunks([row.pk for row in added]):
+        pictures.update(Picture.objects.filter(folder__in=chunk).values_list('pk', flat=True))
+    write_pictures(pictures)
+    if added or moved or reordered:
+        copy_tree_fields(trees)
+
+
+@use_primary()
+def publish(batch_size=1000):
+    """
+    Applies the next batch_size changes of the change feed to the published
+    tables, returns the number of applied changes
+    """
+    with atomic(using=settings.WRITE_DATABASE):
+        state = PublishState.objects.lock()
+        changes = Change.objects.since(state.last_seq, batch_size)
+        if not changes:
+            return 0
+        apply(set(change.object_id for change in changes if change.kind == 'category'),
+              set(change.object_id for change in changes if change.kind == 'picture'))
+        state.last_seq = changes[-1].seq
+        state.published_at = timezone.now()
+        state.save()
+    return len(changes)
+
+
+@use_primary()
+def rebuild(batch_size=1000):
+    """
+    Publishes the whole gallery again, returns the number of published categories
+    """
+    with atomic(using=settings.WRITE_DATABASE):
+        state = PublishState.objects.lock()
+        # Later changes, and earlier ones which may still commit, are applied again
+        # by publish: applying a change twice does no harm
+        settled = Change.objects.settled_before()
+        last_seq = Change.objects.filter(created_at__lt=settled).order_by('-seq').values_list('seq', flat=True)[:1]
+        PublishedPicture.objects.all().delete()
+        PublishedCategory.objects.all().delete()
+        pks = PictureCategory.objects.filter(is_visible=True).order_by('pk').values_list('pk', flat=True)
+        last_pk, count = 0, 0
+        while True:
+            batch = list(pks.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1]
+            rows = category_rows(batch)
+            PublishedCategory.objects.bulk_create(list(rows.values()))
+            count += len(rows)
+        pictures = Picture.objects.order_by('pk').values_list('pk', flat=True)
+        last_pk = 0
+        while True:
+            batch = list(pictures.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1]
+            write_pictures(batch)
+        state.last_seq = last_seq[0] if last_seq else 0
+        state.published_at = timezone.now()
+        state.save()
+    return count
@@ -0,0 +1,86 @@
+import threading
+from functools import wraps
+
+from cmsplugin_media_center.conf import settings
+
+
+APP_LABEL = 'cmsplugin_media_center'
+
+_state = threading.local()
+
+
+class use_primary(object):
+    """
+    Sends all media center reads to the primary database while active.
+    Can be used both as a context manager and as a decorator.
+    """
+    def __enter__(self):
+        pin()
+
+    def __exit__(self, *exc_info):
+        unpin()
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def pin():
+    _state.pinned = getattr(_state, 'pinned', 0) + 1
+
+
+def unpin():
+    _state.pinned = max(getattr(_state, 'pinned', 0) - 1, 0)
+
+
+def is_pinned():
+    return getattr(_state, 'pinned', 0) > 0
+
+
+def has_written():
+    return getattr(_state, 'written', False)
+
+
+def reset_state():
+    _state.pinned = 0
+    _state.written = False
+
+
+class MediaCenterRouter(object):
+    """
+    Sends the reads of the media center models to MEDIA_CENTER_READ_DATABASE
+    and everything else (writes, reads while saving) to MEDIA_CENTER_WRITE_DATABASE.
+
+    Add it to DATABASE_ROUTERS:
+
+        DATABASE_ROUTERS = ['cmsplugin_media_center.routers.MediaCenterRouter']
+    """
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        if settings.READ_DATABASE is None or is_pinned():
+            return settings.WRITE_DATABASE
+        return settings.READ_DATABASE
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        _state.written = True
+        return settings.WRITE_DATABASE
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = (settings.WRITE_DATABASE, settings.READ_DATABASE)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, model):
+        if model._meta.app_label == APP_LABEL and db == settings.READ_DATABASE:
+            return False
+        return None
+
+    # Django < 1.7
+    allow_syncdb = allow_migrate
@@ -0,0 +1,253 @@
+"""
+Full text search over the titles and descriptions of the categories and pictures.
+
+The index is a SQLite FTS5 (or FTS4) virtual table or a PostgreSQL table with
+a tsvector column and a GIN index. It is kept up to date by the save and delete
+receivers of the models and can be rebuilt with the media_center_rebuild_search
+command. Other databases have no index and searches find nothing.
+
+Every document id encodes the kind and the primary key of the object,
+so updating or deleting a document is a primary key lookup.
+"""
+import re
+
+from django.db import DatabaseError, connections, router
+
+from cmsplugin_media_center.conf import settings
+from cmsplugin_media_center.models import Picture, PictureCategory
+from cmsplugin_media_center.utils.db import chunks
+
+
+TABLE = 'cmsplugin_media_center_search'
+KINDS = ('category', 'picture')
+
+_ready = set()
+_fts5 = {}
+
+
+def document_id(kind, pk):
+    return pk * len(KINDS) + KINDS.index(kind)
+
+
+def document_text(obj):
+    return '%s\n%s' % (obj.title, obj.description)
+
+
+def terms(query):
+    return re.findall(r'\w+', query, re.UNICODE)
+
+
+class SQLiteBackend(object):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def exists(self):
+        return TABLE in self.connection.introspection.table_names()
+
+    def create(self):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE %s USING fts5(text, tokenize='unicode61 remove_diacritics 1')"
+                           % TABLE)
+        except DatabaseError:
+            # SQLite older than 3.9 or built without FTS5
+            cursor.execute('CREATE VIRTUAL TABLE %s USING fts4(text)' % TABLE)
+
+    def drop(self):
+        self.connection.cursor().execute('DROP TABLE IF EXISTS %s' % TABLE)
+        _fts5.pop(self.connection.alias, None)
+
+    def is_fts5(self):
+        alias = self.connection.alias
+        if alias not in _fts5:
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT sql FROM sqlite_master WHERE name = %s', [TABLE])
+            _fts5[alias] = 'fts5' in cursor.fetchone()[0].lower()
+        return _fts5[alias]
+
+    def remove(self, ids):
+        cursor = self.connection.cursor()
+        for chunk in chunks(ids):
+            cursor.execute('DELETE FROM %s WHERE rowid IN (%s)' % (TABLE, ', '.join(['%s'] * len(chunk))), chunk)
+
+    def add(self, documents):
+        self.connection.cursor().executemany(
+            'INSERT INTO %s (rowid, text) VALUES (%%s, %%s)' % TABLE, list(documents))
+
+    def match(self, words, kind, offset, limit):
+        fts5 = self.is_fts5()
+        if fts5:
+            query = ' '.join('"%s"*' % word for word in words)
+            order = 'ORDER BY rank'
+        else:
+            query = ' '.join('%s*' % word for word in words)
+            order = ''
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT rowid FROM %s WHERE %s MATCH %%s AND rowid %% %d = %d %s LIMIT %%s OFFSET %%s' % (
+            TABLE, TABLE, len(KINDS), KINDS.index(kind), order), [query, limit, offset])
+        return [row[0] // len(KINDS) for row in cursor.fetchall()]
+
+
+class PostgreSQLBackend(object):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def exists(self):
+        return TABLE in self.connection.introspection.table_names()
+
+    def create(self):
+        cursor = self.connection.cursor()
+        cursor.execute('CREATE TABLE %s (id bigint PRIMARY KEY, document tsvector NOT NULL)' % TABLE)
+        cursor.execute('CREATE INDEX %s_document ON %s USING gin (document)' % (TABLE, TABLE))
+
+    def drop(self):
+        self.connection.cursor().execute('DROP TABLE IF EXISTS %s' % TABLE)
+
+    def remove(self, ids):
+        cursor = self.connection.cursor()
+        for chunk in chunks(ids):
+            cursor.execute('DELETE FROM %s WHERE id IN (%s)' % (TABLE, ', '.join(['%s'] * len(chunk))), chunk)
+
+    def add(self, documents):
+        self.connection.cursor().executemany(
+            'INSERT INTO %s (id, document) VALUES (%%s, to_tsvector(%%s::regconfig, %%s))' % TABLE,
+            [(pk, settings.SEARCH_CONFIG, text) for pk, text in documents])
+
+    def match(self, words, kind, offset, limit):
+        query = ' & '.join('%s:*' % word for word in words)
+        cursor = self.connection.cursor()
+        cursor.execute(
+            'SELECT id FROM %s, to_tsquery(%%s::regconfig, %%s) query '
+            'WHERE document @@ query AND mod(id, %d) = %d '
+            'ORDER BY ts_rank(document, query) DESC, id LIMIT %%s OFFSET %%s' % (
+                TABLE, len(KINDS), KINDS.index(kind)),
+            [settings.SEARCH_CONFIG, query, limit, offset])
+        return [row[0] // len(KINDS) for row in cursor.fetchall()]
+
+
+BACKENDS = {
+    'sqlite': SQLiteBackend,
+    'postgresql': PostgreSQLBackend,
+}
+
+
+def get_backend(using):
+    backend = BACKENDS.get(connections[using].vendor)
+    return backend(connections[using]) if backend is not None else None
+
+
+def get_index(using):
+    """
+    Backend of the database if its index table exists, None otherwise
+    """
+    backend = get_backend(using)
+    if backend is None:
+        return None
+    if using not in _ready:
+        if not backend.exists():
+            return None
+        _ready.add(using)
+    return backend
+
+
+def index(kind, objects, using=None):
+    """
+    Adds the objects to the index, replacing their old documents
+    """
+    backend = get_index(using or router.db_for_write(PictureCategory))
+    if backend is not None:
+        documents = [(document_id(kind, obj.pk), document_text(obj)) for obj in objects]
+        backend.remove([pk for pk, text in documents])
+        backend.add(documents)
+
+
+def unindex(kind, pks, using=None):
+    backend = get_index(using or router.db_for_write(PictureCategory))
+    if backend is not None:
+        backend.remove([document_id(kind, pk) for pk in pks])
+
+
+def rebuild(batch_size=1000, using=None):
+    """
+    Drops the index and indexes every category and picture again.
+    Returns the number of indexed documents.
+    """
+    using = using or router.db_for_write(PictureCategory)
+    backend = get_backend(using)
+    if backend is None:
+        return 0
+    backend.drop()
+    backend.create()
+    _ready.add(using)
+    return (index_queryset('category', PictureCategory.objects.using(using), batch_size, using) +
+            index_queryset('picture', Picture.objects.using(using), batch_size, using))
+
+
+def index_queryset(kind, queryset, batch_size=1000, using=None):
+    """
+    Indexes the categories or pictures of the queryset in batches,
+    for objects created without the save signals (bulk_create).
+    Returns the number of indexed documents.
+    """
+    backend = get_index(using or router.db_for_write(PictureCategory))
+    if backend is None:
+        return 0
+    rows = queryset.order_by('pk').values_list('pk', 'title', 'description')
+    last_pk, count = 0, 0
+    while True:
+        batch = list(rows.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+        documents = [(document_id(kind, pk), '%s\n%s' % (title, description)) for pk, title, description in batch]
+        backend.remove([pk for pk, text in documents])
+        backend.add(documents)
+        count += len(batch)
+    return count
+
+
+def search(query, kind, offset=0, limit=20, using=None):
+    """
+    Primary keys of the shown categories or pictures (kind) matching all the
+    words of the query, as prefixes, best matches first.
+    """
+    using = using or router.db_for_read(PictureCategory)
+    words = terms(query)
+    backend = get_index(using)
+    if backend is None or not words:
+        return []
+    found, start, batch = [], 0, max(offset + limit, 50)
+    while len(found) < offset + limit:
+        pks = backend.match(words, kind, start, batch)
+        start += batch
+        if kind == 'category':
+            folders = dict((pk, pk) for pk in pks)
+        else:
+            folders = dict(Picture.objects.using(using).filter(pk__in=pks).values_list('pk', 'folder'))
+        shown = PictureCategory.objects.db_manager(using).shown_pks(set(folders.values()))
+        found.extend(pk for pk in pks if folders.get(pk) in shown)
+        if len(pks) < batch:
+            break
+    return found[offset:offset + limit]
+
+
+def in_order(queryset, pks):
+    """
+    queryset restricted to pks and sorted like them
+    """
+    if not pks:
+        return queryset.none()
+    qn = connections[queryset.db].ops.quote_name
+    meta = queryset.model._meta
+    column = '%s.%s' % (qn(meta.db_table), qn(meta.pk.column))
+    rank = 'CASE %s %s END' % (column, ' '.join('WHEN %d THEN %d' % (int(pk), i) for i, pk in enumerate(pks)))
+    return queryset.filter(pk__in=pks).extra(select={'search_rank': rank}, order_by=['search_rank'])
+
+
+def create_index(db):
+    """
+    Creates the index with syncdb, the migrations create it when South is used
+    """
+    backend = get_backend(db)
+    if backend is not None and router.allow_syncdb(db, PictureCategory) and not backend.exists():
+        backend.create()
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+
+# Sent when an instrumentation span ends, see cmsplugin_media_center.instrumentation
+span_finished = Signal(providing_args=['span'])
@@ -0,0 +1,90 @@
+"""
+Sitemaps of the shown categories and pictures, for galleries too large for
+django.contrib.sitemaps which counts its querysets and slices them with OFFSET.
+
+Every sitemap covers a range of URLS_PER_SITEMAP primary keys, so the index
+only needs the largest pk and any sitemap is read without skipping rows. The
+rows are read in keyset batches and the XML is yielded as they are read; only
+the URLs of the shown categories are kept in memory.
+"""
+from xml.sax.saxutils import escape
+
+from django.core.urlresolvers import reverse
+from django.db.models import Max
+
+from cmsplugin_media_center.models import Picture, PictureCategory
+
+
+# The limit of the sitemap protocol
+URLS_PER_SITEMAP = 50000
+SECTIONS = {
+    'categories': PictureCategory,
+    'pictures': Picture,
+}
+
+
+def sitemap_count(section):
+    last = SECTIONS[section].objects.aggregate(last=Max('pk'))['last'] or 0
+    return max((last + URLS_PER_SITEMAP - 1) // URLS_PER_SITEMAP, 1)
+
+
+def shown_categories(batch_size=500):
+    """
+    {pk: (path, modified_at)} of the shown categories
+    """
+    categories = {}
+    rows = PictureCategory.objects.filter(is_visible=True).order_by('pk').values_list('pk', 'slug', 'modified_at')
+    last_pk = 0
+    while True:
+        batch = list(rows.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+        shown = PictureCategory.objects.shown_pks([pk for pk, slug, modified_at in batch])
+        categories.update((pk, (reverse('picture_category', args=(slug,)), modified_at))
+                          for pk, slug, modified_at in batch if pk in shown)
+    return categories
+
+
+def entries(section, number, categories, batch_size=1000):
+    """
+    (path, lastmod) of the shown categories, or of their pictures, whose pk is
+    in the range of sitemap number (from 1). categories is shown_categories().
+    """
+    first, last = (number - 1) * URLS_PER_SITEMAP, number * URLS_PER_SITEMAP
+    if section == 'categories':
+        for pk in sorted(pk for pk in categories if first < pk <= last):
+            yield categories[pk]
+        return
+    rows = Picture.objects.filter(pk__lte=last).order_by('pk').values_list('pk', 'folder', 'modified_at')
+    last_pk = first
+    while True:
+        count = 0
+        for pk, folder, modified_at in rows.filter(pk__gt=last_pk)[:batch_size].iterator():
+            count += 1
+            last_pk = pk
+            if folder in categories:
+                # The picture_detail URL is the one of its category followed by its pk
+                yield '%s%d/' % (categories[folder][0], pk), modified_at
+        if count < batch_size:
+            break
+
+
+def urlset(entries, base_url):
+    """
+    The XML of a sitemap, in pieces. base_url is the scheme and the host.
+    """
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    for path, lastmod in entries:
+        yield '<url><loc>%s</loc>%s</url>\n' % (
+            escape(base_url + path), '<lastmod>%s</lastmod>' % lastmod.date().isoformat() if lastmod else '')
+    yield '</urlset>\n'
+
+
+def sitemap_index(locations):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    for location in locations:
+        yield '<sitemap><loc>%s</loc></sitemap>\n' % escape(location)
+    yield '</sitemapindex>\n'
@@ -0,0 +1,83 @@
+/*
+ * Lazy category tree of the PictureCategory changelist with
+ * MEDIA_CENTER_ADMIN_LAZY_TREE: the children of a category are loaded
+ * from the tree view of the admin when it is expanded. ?expand=<pk>
+ * opens the tree down to a category.
+ */
+(function($) {
+    function collapse(id) {
+        $('tr[data-parent-id="' + id + '"]').each(function() {
+            collapse($(this).attr('data-id'));
+            $(this).remove();
+        });
+    }
+
+    function expand(toggle, done) {
+        var id = toggle.attr('data-id'), url = toggle.attr('data-url'), row = toggle.closest('tr');
+        var columns = row.children().length;
+        $.getJSON(url, {parent: id}, function(data) {
+            var last = row;
+            $.each(data.children, function(index, node) {
+                var cell = $('<td>').attr('colspan', columns - 1).css('padding-left', (node.level * 20) + 'px');
+                if (node.has_children) {
+                    cell.append($('<a href="#" class="media-center-tree-toggle">+</a>')
+                        .attr({'data-id': node.id, 'data-url': url}), ' ');
+                }
+                cell.append($('<a>').attr('href', node.url).text(node.title));
+                cell.append($('<span class="quiet">').text(' ' + node.pictures + ', ' + node.status));
+                var child = $('<tr>').attr({'data-id': node.id, 'data-parent-id': id}).append('<td></td>', cell);
+                last.after(child);
+                last = child;
+            });
+            toggle.text('-').addClass('open');
+            if (done) {
+                done();
+            }
+        });
+    }
+
+    function toggle(link, done) {
+        if (link.hasClass('open')) {
+            collapse(link.attr('data-id'));
+            link.text('+').removeClass('open');
+        } else {
+            expand(link, done);
+        }
+    }
+
+    function findToggle(id) {
+        return $('a.media-center-tree-toggle[data-id="' + id + '"]');
+    }
+
+    function expandPath(ancestors, id) {
+        if (!ancestors.length) {
+            var row = $('tr[data-id="' + id + '"]');
+            (row.length ? row : findToggle(id).closest('tr')).addClass('selected');
+            return;
+        }
+        var link = findToggle(ancestors[0]);
+        if (!link.length) {
+            return;
+        }
+        var next = function() { expandPath(ancestors.slice(1), id); };
+        if (link.hasClass('open')) {
+            next();
+        } else {
+            expand(link, next);
+        }
+    }
+
+    $(function() {
+        $('#result_list').delegate('a.media-center-tree-toggle', 'click', function(event) {
+            event.preventDefault();
+            toggle($(this));
+        });
+        var match = /[?&]expand=(\d+)/.exec(window.location.search);
+        var any = $('a.media-center-tree-toggle').first();
+        if (match && any.length) {
+            $.getJSON(any.attr('data-url'), {ancestors: match[1]}, function(data) {
+                expandPath(data.ancestors, match[1]);
+            });
+        }
+    });
+})(django.jQuery);
@@ -0,0 +1,44 @@
+/*
+ * Drag and drop ordering of the reorder page of the PictureCategory admin.
+ * Items only move within their own list; on submit the complete order of
+ * every list is written to its hidden input as comma separated pks.
+ */
+(function($) {
+    var dragged = null;
+
+    $(function() {
+        var lists = $('.media-center-sortable');
+        lists.delegate('li', 'dragstart', function(event) {
+            dragged = this;
+            event.originalEvent.dataTransfer.effectAllowed = 'move';
+            // Firefox does not start dragging without data
+            event.originalEvent.dataTransfer.setData('text', $(this).attr('data-id'));
+        });
+        lists.delegate('li', 'dragover', function(event) {
+            if (!dragged || dragged === this || dragged.parentNode !== this.parentNode) {
+                return;
+            }
+            event.preventDefault();
+            var offset = $(this).offset().top, height = $(this).outerHeight();
+            if (event.originalEvent.pageY < offset + height / 2) {
+                $(this).before(dragged);
+            } else {
+                $(this).after(dragged);
+            }
+        });
+        lists.delegate('li', 'drop', function(event) {
+            event.preventDefault();
+        });
+        lists.delegate('li', 'dragend', function() {
+            dragged = null;
+        });
+        $('#media-center-reorder').submit(function() {
+            lists.each(function() {
+                var pks = $(this).children('li').map(function() {
+                    return $(this).attr('data-id');
+                }).get();
+                $('#' + $(this).attr('data-input')).val(pks.join(','));
+            });
+        });
+    });
+})(django.jQuery);
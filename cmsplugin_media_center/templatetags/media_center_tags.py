@@ -0,0 +1,87 @@
+import logging
+
+from django import template
+from easy_thumbnails.conf import settings as thumbnail_settings
+
+from cmsplugin_media_center import metrics
+from cmsplugin_media_center.thumbnails import MIME_TYPES, THUMBNAIL_OPTIONS, thumbnail_urls, variant_alias
+
+
+logger = logging.getLogger(__name__)
+
+register = template.Library()
+
+
+@register.inclusion_tag('cmsplugin_media_center/picture.html', takes_context=True)
+def picture_thumbnail(context, picture, alt=''):
+    """
+    <picture> with a source for every THUMBNAIL_FORMATS and an <img> with the
+    JPEG/PNG fallback, each of them with a srcset of THUMBNAIL_SCALES.
+    The browser picks the first format it supports.
+
+        {% picture_thumbnail photo alt=photo.title %}
+
+    The URLs come from the thumbnail_urls of the context when the plugin
+    loaded them for the whole page, otherwise they are looked up for this
+    picture alone. Missing thumbnails are generated, media_center_thumbnails
+    generates them ahead of time.
+    """
+    if picture is None:
+        # A category without pictures has no cover
+        return {}
+    urls = context.get('thumbnail_urls')
+    if urls is not None and picture.image_id is not None:
+        found = (picture.image_id, variant_alias(None, THUMBNAIL_OPTIONS)) in urls
+        metrics.inc('media_center_cache_requests_total', cache='thumbnail_url', result='hit' if found else 'miss')
+    try:
+        variants = thumbnail_urls(picture.image, urls)
+    except Exception:
+        # Like {% thumbnail %}, a broken image must not break the page
+        if thumbnail_settings.THUMBNAIL_DEBUG:
+            raise
+        logger.exception('Can not generate the thumbnails of picture %s', picture.pk)
+        return {}
+
+    extensions, srcsets = [], {}
+    for extension, scale, url in variants:
+        if extension not in srcsets:
+            extensions.append(extension)
+            srcsets[extension] = []
+        srcsets[extension].append((url, scale))
+    return {
+        'picture': picture,
+        'alt': alt,
+        'size': picture.thumbnail_size,
+        'src': srcsets[None][0][0],
+        'srcset': srcset(srcsets[None]),
+        'sources': [{'type': MIME_TYPES.get(extension, 'image/%s' % extension), 'srcset': srcset(srcsets[extension])}
+                    for extension in extensions if extension is not None],
+    }
+
+
+def srcset(urls):
+    return ', '.join('%s %sx' % (url, scale) for url, scale in urls)
+
+
+@register.filter
+def category_tree(categories):
+    """
+    (category, has_children, closes) of categories in tree order, for nested lists:
+
+        {% for node, has_children, closes in category_list|category_tree %}
+          <li>{{ node }}
+          {% if has_children %}<ul>{% else %}</li>{% for level in closes %}</ul></li>{% endfor %}{% endif %}
+        {% endfor %}
+
+    Only the level of the categories is used, so it works with the
+    published categories as well as with the tree.
+    """
+    categories = list(categories)
+    if not categories:
+        return []
+    base = categories[0].level
+    result = []
+    for index, category in enumerate(categories):
+        following = categories[index + 1].level if index + 1 < len(categories) else base
+        result.append((category, following > category.level, range(max(category.level - following, 0))))
+    return result
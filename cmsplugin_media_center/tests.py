@@ -1,4 +1,6 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.test.utils import override_settings
+from django.utils.six import StringIO
 
 from cmsplugin_media_center.models import PictureCategory, Picture
 
@@ -683,3 +685,1265 @@ class CMSPluginMediaCenterManagerTests(TestCase):
 
         with self.assertRaises(PictureCategory.DoesNotExist):
             PictureCategory.objects.get_visible(slug=self.inner_root_1.slug)
+
+
+class CMSPluginMediaCenterVisibilityLockingTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def test_ancestors_in_memory_are_updated_by_propagation(self):
+        """
+        Ancestors are updated with a queryset update, the instances that
+        we hold in memory must still reflect the new visibility
+        """
+        test = PictureCategory.objects.create(title="test",
+                                              is_published=True,
+                                              slug="test")
+        inner_category = PictureCategory.objects.create(title="inner_category",
+                                                        is_published=True,
+                                                        slug="inner-category",
+                                                        parent=test)
+        inner_inner_category = PictureCategory.objects.create(title="inner_inner_category",
+                                                              is_published=True,
+                                                              slug="inner-inner-category",
+                                                              parent=inner_category)
+        some_picture = Picture.objects.get(pk=1)
+        some_picture.folder = inner_inner_category
+        some_picture.save()
+        self.assertTrue(test.is_visible and inner_category.is_visible)
+        self.assertTrue(PictureCategory.objects.get(pk=test.pk).is_visible)
+
+
+class CMSPluginMediaCenterTransactionTests(TransactionTestCase):
+    """
+    Outside the transaction of TestCase, like a request or a command
+    """
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def test_retry_on_deadlock_retries_only_deadlocks(self):
+        from django.db import DatabaseError
+        from cmsplugin_media_center.utils.db import retry_on_deadlock
+        calls = []
+
+        @retry_on_deadlock(delay=0)
+        def deadlocking():
+            calls.append(1)
+            if len(calls) == 1:
+                raise DatabaseError('deadlock detected')
+            return len(calls)
+
+        @retry_on_deadlock(delay=0)
+        def failing():
+            calls.append(1)
+            raise DatabaseError('no such table')
+
+        self.assertEqual(deadlocking(), 2)
+        del calls[:]
+        with self.assertRaises(DatabaseError):
+            failing()
+        self.assertEqual(len(calls), 1)
+
+    @skipUnlessDBFeature('uses_savepoints')
+    def test_failing_nested_block_keeps_the_outer_transaction(self):
+        from cmsplugin_media_center.utils.db import atomic
+
+        with atomic(using='default'):
+            PictureCategory.objects.create(title="outer", slug="outer", is_published=True)
+            try:
+                with atomic(using='default'):
+                    PictureCategory.objects.create(title="inner", slug="inner", is_published=True)
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(list(PictureCategory.objects.filter(
+            slug__in=['outer', 'inner']).values_list('slug', flat=True)), ['outer'])
+
+    def test_deadlocked_save_is_run_again_from_the_start(self):
+        from django.db import DatabaseError
+        from django.db.models.signals import post_save
+
+        test = PictureCategory.objects.create(title="test", is_published=True, slug="test")
+        inner_category = PictureCategory.objects.create(title="inner_category", is_published=True,
+                                                        slug="inner-category", parent=test)
+        Picture.objects.filter(pk=1).update(folder=inner_category)
+        calls = []
+
+        def deadlock_once(sender, instance, **kwargs):
+            # After the row is written and before the cascade
+            calls.append(instance.pk)
+            if len(calls) == 1:
+                raise DatabaseError('deadlock detected')
+
+        post_save.connect(deadlock_once, sender=PictureCategory)
+        try:
+            inner_category.save_visibility()
+        finally:
+            post_save.disconnect(deadlock_once, sender=PictureCategory)
+        self.assertEqual(calls, [inner_category.pk, inner_category.pk])
+        self.assertTrue(PictureCategory.objects.get(pk=inner_category.pk).is_visible)
+        self.assertTrue(PictureCategory.objects.get(pk=test.pk).is_visible)
+
+
+class CMSPluginMediaCenterRouterTests(TestCase):
+
+    def setUp(self):
+        from cmsplugin_media_center.routers import MediaCenterRouter
+        self.router = MediaCenterRouter()
+
+    def test_reads_stay_on_primary_without_replica(self):
+        self.assertEqual(self.router.db_for_read(PictureCategory), 'default')
+
+    def test_reads_go_to_replica_unless_pinned(self):
+        from django.contrib.auth.models import User
+        from django.test.utils import override_settings
+        from cmsplugin_media_center.routers import use_primary
+
+        with override_settings(MEDIA_CENTER_READ_DATABASE='replica'):
+            self.assertEqual(self.router.db_for_read(Picture), 'replica')
+            self.assertEqual(self.router.db_for_write(Picture), 'default')
+            self.assertIsNone(self.router.db_for_read(User))
+            with use_primary():
+                self.assertEqual(self.router.db_for_read(Picture), 'default')
+            self.assertEqual(self.router.db_for_read(Picture), 'replica')
+
+
+class CMSPluginMediaCenterDeferredVisibilityTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def test_refresh_visibility_updates_category_and_ancestors(self):
+        test = PictureCategory.objects.create(title="test",
+                                              is_published=True,
+                                              slug="test")
+        inner_category = PictureCategory.objects.create(title="inner_category",
+                                                        is_published=True,
+                                                        slug="inner-category",
+                                                        parent=test)
+        Picture.objects.filter(pk=1).update(folder=inner_category)
+
+        changed = PictureCategory.objects.refresh_visibility([inner_category.pk])
+        self.assertEqual(set([test.pk, inner_category.pk]), set(changed))
+        self.assertTrue(PictureCategory.objects.get(pk=test.pk).is_visible)
+        self.assertTrue(PictureCategory.objects.get(pk=inner_category.pk).is_visible)
+
+    def test_deferred_mode_queues_categories_for_the_worker(self):
+        from django.core.management import call_command
+        from django.test.utils import override_settings
+        from cmsplugin_media_center.models import DirtyCategory
+
+        with override_settings(MEDIA_CENTER_VISIBILITY_UPDATES='deferred'):
+            test = PictureCategory.objects.create(title="test",
+                                                  is_published=True,
+                                                  slug="test")
+            inner_category = PictureCategory.objects.create(title="inner_category",
+                                                            is_published=True,
+                                                            slug="inner-category",
+                                                            parent=test)
+            some_picture = Picture.objects.get(pk=1)
+            some_picture.folder = inner_category
+            some_picture.save()
+            some_picture.save()
+
+            self.assertFalse(PictureCategory.objects.get(pk=inner_category.pk).is_visible)
+            self.assertTrue(DirtyCategory.objects.filter(pk=inner_category.pk).exists())
+
+            call_command('media_center_worker', once=True)
+
+        self.assertFalse(DirtyCategory.objects.exists())
+        self.assertTrue(PictureCategory.objects.get(pk=test.pk).is_visible)
+        self.assertTrue(PictureCategory.objects.get(pk=inner_category.pk).is_visible)
+
+
+class CMSPluginMediaCenterCommandsTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures']
+
+    def test_generate_builds_a_valid_visible_tree(self):
+        from django.core.management import call_command
+        call_command('media_center_generate', depth=3, branching=2, pictures=2, images=1,
+                     published_ratio=1, seed=1, thumbnails=False, stdout=StringIO())
+
+        categories = PictureCategory.objects.filter(slug__startswith='generated-1-')
+        self.assertEqual(categories.count(), 7)
+        self.assertEqual(Picture.objects.count(), 8)
+        self.assertFalse(categories.filter(is_visible=False).exists())
+
+        root = categories.get(level=0)
+        self.assertEqual([node.pk for node in root.get_descendants(include_self=True)],
+                         [node.pk for node in categories])
+        self.assertEqual(list(PictureCategory.objects.whole_tree()), list(categories))
+        # Inserted in bulk, without the signals, and still found
+        self.assertEqual(set(PictureCategory.objects.search('generated')), set(categories))
+        self.assertEqual(len(Picture.objects.search('picture')), 8)
+
+
+class CMSPluginMediaCenterInstrumentationTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def test_span_is_noop_when_disabled(self):
+        from cmsplugin_media_center.instrumentation import NULL_SPAN, span
+        self.assertIs(span('render'), NULL_SPAN)
+
+    def test_visibility_cascade_emits_span(self):
+        from django.test.utils import override_settings
+        from cmsplugin_media_center.signals import span_finished
+
+        spans = []
+
+        def receiver(sender, span, **kwargs):
+            spans.append(span)
+        span_finished.connect(receiver)
+        try:
+            with override_settings(MEDIA_CENTER_INSTRUMENTATION=True):
+                test = PictureCategory.objects.create(title="test",
+                                                      is_published=True,
+                                                      slug="test")
+                inner_category = PictureCategory.objects.create(title="inner_category",
+                                                                is_published=True,
+                                                                slug="inner-category",
+                                                                parent=test)
+                some_picture = Picture.objects.get(pk=1)
+                some_picture.folder = inner_category
+                some_picture.save()
+        finally:
+            span_finished.disconnect(receiver)
+
+        cascade = [span for span in spans if span.name == 'visibility_cascade'][-1]
+        self.assertEqual(cascade.counters['depth'], 1)
+        self.assertTrue(cascade.queries > 0)
+
+    def test_span_does_not_keep_the_queries(self):
+        from django.db import connection
+        from django.test.utils import override_settings
+        from cmsplugin_media_center.instrumentation import span
+
+        with override_settings(MEDIA_CENTER_METRICS=True, DEBUG=False):
+            logged = len(connection.queries)
+            with span('outer') as outer:
+                with span('inner') as inner:
+                    list(PictureCategory.objects.all())
+                list(Picture.objects.all())
+            self.assertEqual((inner.queries, outer.queries), (1, 2))
+            self.assertEqual(len(connection.queries), logged)
+
+
+class CMSPluginMediaCenterMetricsTests(TestCase):
+
+    def test_prometheus_rendering(self):
+        from cmsplugin_media_center import metrics
+
+        registry, metrics.registry = metrics.registry, metrics.Registry()
+        try:
+            metrics.registry.inc('media_center_renders_total', skin='list')
+            metrics.registry.inc('media_center_renders_total', skin='list')
+            metrics.registry.observe('media_center_cascade_depth', 2)
+            output = metrics.render()
+        finally:
+            metrics.registry = registry
+
+        self.assertIn('media_center_renders_total{skin="list"} 2', output)
+        self.assertIn('media_center_cascade_depth_bucket{le="1"} 0', output)
+        self.assertIn('media_center_cascade_depth_bucket{le="2"} 1', output)
+        self.assertIn('media_center_cascade_depth_count 1', output)
+
+    def test_files_of_exited_processes_are_folded(self):
+        import json
+        import os
+        import tempfile
+        import time
+        from django.test.utils import override_settings
+        from cmsplugin_media_center import metrics
+
+        directory = tempfile.mkdtemp()
+        exited = os.path.join(directory, 'metrics-1.json')
+        with open(exited, 'w') as f:
+            json.dump({'counters': [['media_center_renders_total', {'skin': 'list'}, 5]], 'histograms': []}, f)
+        os.utime(exited, (time.time() - 3600, time.time() - 3600))
+        registry, metrics.registry = metrics.registry, metrics.Registry()
+        try:
+            with override_settings(MEDIA_CENTER_METRICS_DIR=directory):
+                self.assertIn('media_center_renders_total{skin="list"} 5', metrics.render())
+                # The next exited process adds to the values of the first one
+                with open(exited, 'w') as f:
+                    json.dump({'counters': [['media_center_renders_total', {'skin': 'list'}, 2]],
+                               'histograms': []}, f)
+                os.utime(exited, (time.time() - 3600, time.time() - 3600))
+                self.assertIn('media_center_renders_total{skin="list"} 7', metrics.render())
+        finally:
+            metrics.registry = registry
+        self.assertFalse(os.path.exists(exited))
+        self.assertEqual(sorted(name for name in os.listdir(directory) if name.startswith('metrics-')),
+                         sorted(['metrics-%d.json' % os.getpid(), metrics.DEAD_FILE]))
+
+    def test_metrics_view_is_disabled_by_default(self):
+        from django.http import Http404
+        from django.test.client import RequestFactory
+        from cmsplugin_media_center.views import metrics_view
+
+        with self.assertRaises(Http404):
+            metrics_view(RequestFactory().get('/'))
+
+
+class CMSPluginMediaCenterProfileCommandTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def test_profile_renders_every_visible_category_with_every_skin(self):
+        from django.core.management import call_command
+        from cmsplugin_media_center.models import MediaPlugin
+
+        out = StringIO()
+        call_command('media_center_profile', stdout=out)
+        renders = PictureCategory.objects.whole_tree().count() * len(MediaPlugin.MEDIA_SKINS)
+        self.assertIn('%d renders in' % renders, out.getvalue())
+
+
+class CMSPluginMediaCenterZipStreamTests(TestCase):
+
+    def test_streamed_archive_is_valid_and_has_the_announced_size(self):
+        import datetime
+        import zipfile
+        from io import BytesIO
+        from cmsplugin_media_center.utils.zipstream import ZipMember, ZipStream
+
+        contents = [b'', b'muffin', b'x' * 100000]
+        members = [ZipMember(u'album/picture-%d.jpg' % index, len(content), datetime.datetime(2014, 7, 9),
+                             lambda content=content: BytesIO(content))
+                   for index, content in enumerate(contents)]
+        archive = ZipStream(members, chunk_size=1024)
+        data = b''.join(archive)
+
+        self.assertEqual(len(data), archive.size)
+        parsed = zipfile.ZipFile(BytesIO(data))
+        self.assertIsNone(parsed.testzip())
+        for index, content in enumerate(contents):
+            self.assertEqual(parsed.read('album/picture-%d.jpg' % index), content)
+
+    def test_download_of_hidden_category_is_not_found(self):
+        from django.http import Http404
+        from django.test.client import RequestFactory
+        from cmsplugin_media_center.views import category_zip_view
+
+        PictureCategory.objects.create(title="test", is_published=False, slug="test")
+        with self.assertRaises(Http404):
+            category_zip_view(RequestFactory().get('/'), category='test')
+
+
+class CMSPluginMediaCenterMetadataTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def test_extract_metadata(self):
+        from io import BytesIO
+        from cmsplugin_media_center.utils.images import PILImage, extract_metadata
+
+        buf = BytesIO()
+        PILImage.new('RGB', (400, 100), (255, 0, 0)).save(buf, 'JPEG')
+        buf.seek(0)
+        metadata = extract_metadata(buf)
+        self.assertEqual((metadata['width'], metadata['height']), (400, 100))
+        self.assertIsNone(metadata['taken_at'])
+        self.assertEqual(len(metadata['dominant_color']), 7)
+        self.assertTrue(metadata['placeholder'].startswith('data:image/jpeg;base64,'))
+
+    def test_thumbnail_size_keeps_aspect_ratio(self):
+        picture = Picture(width=400, height=100)
+        self.assertEqual(picture.thumbnail_size, (200, 50))
+        self.assertIsNone(Picture().thumbnail_size)
+
+    def test_changing_image_clears_metadata(self):
+        from django.utils import timezone
+
+        Picture.objects.filter(pk=1).update(width=400, height=100, dominant_color='#ff0000',
+                                            metadata_updated_at=timezone.now())
+        picture = Picture.objects.get(pk=1)
+        picture.title = 'renamed'
+        picture.save()
+        self.assertEqual(Picture.objects.get(pk=1).width, 400)
+
+        picture.image_id = 2
+        picture.save()
+        picture = Picture.objects.get(pk=1)
+        self.assertIsNone(picture.width)
+        self.assertIsNone(picture.metadata_updated_at)
+        self.assertEqual(picture.dominant_color, '')
+
+
+class CMSPluginMediaCenterThumbnailVariantsTests(TestCase):
+
+    def test_variants_skip_formats_pil_can_not_write(self):
+        from django.test.utils import override_settings
+        from cmsplugin_media_center.thumbnails import variants
+
+        with override_settings(MEDIA_CENTER_THUMBNAIL_FORMATS=('no-such-format',), MEDIA_CENTER_THUMBNAIL_SCALES=(1, 2)):
+            self.assertEqual([(extension, scale, options['size']) for extension, scale, options in variants()],
+                             [(None, 1, (200, 200)), (None, 2, (400, 400))])
+
+    def test_category_without_cover_renders_nothing(self):
+        from django.template import Context, Template
+
+        rendered = Template('{% load media_center_tags %}{% picture_thumbnail cover %}').render(Context({'cover': None}))
+        self.assertEqual(rendered.strip(), '')
+
+
+class CMSPluginMediaCenterThumbnailURLTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def test_urls_of_older_image_versions_are_not_used(self):
+        import datetime
+        from filer.models import Image
+        from cmsplugin_media_center.models import ThumbnailURL
+
+        image = Image.objects.get(pk=1)
+        ThumbnailURL.objects.store(image, 'default-200x200', '/media/thumb.jpg')
+        self.assertEqual(ThumbnailURL.objects.for_images([image]), {(1, 'default-200x200'): '/media/thumb.jpg'})
+
+        image.modified_at += datetime.timedelta(seconds=1)
+        self.assertEqual(ThumbnailURL.objects.for_images([image]), {})
+
+    def test_saving_the_image_forgets_its_urls(self):
+        from filer.models import Image
+        from cmsplugin_media_center.models import ThumbnailURL
+
+        image = Image.objects.get(pk=1)
+        ThumbnailURL.objects.store(image, 'default-200x200', '/media/thumb.jpg')
+        image.save()
+        self.assertFalse(ThumbnailURL.objects.filter(image=image).exists())
+
+    def test_storing_a_url_does_not_pin_the_client_to_the_primary(self):
+        from django.db import router
+        from filer.models import Image
+        from cmsplugin_media_center import routers
+        from cmsplugin_media_center.models import ThumbnailURL
+
+        image = Image.objects.get(pk=1)
+        saved, router.routers = router.routers, [routers.MediaCenterRouter()]
+        routers.reset_state()
+        try:
+            ThumbnailURL.objects.store(image, 'default-200x200', '/media/thumb.jpg')
+        finally:
+            router.routers = saved
+        self.assertFalse(routers.has_written())
+        self.assertTrue(ThumbnailURL.objects.filter(image=1, alias='default-200x200').exists())
+
+    def test_covers_are_loaded_in_a_fixed_number_of_queries(self):
+        first = PictureCategory.objects.create(title="first", slug="first", is_published=True)
+        second = PictureCategory.objects.create(title="second", slug="second", is_published=True)
+        empty = PictureCategory.objects.create(title="empty", slug="empty", is_published=True)
+        Picture.objects.filter(pk__in=[1, 2]).update(folder=first, is_cover=False)
+        Picture.objects.filter(pk=3).update(folder=second, is_cover=True)
+
+        categories = [first, second, empty]
+        with self.assertNumQueries(3):
+            Picture.objects.set_covers(categories)
+        with self.assertNumQueries(0):
+            covers = [category.get_cover() for category in categories]
+        self.assertEqual([cover and cover.pk for cover in covers], [1, 3, None])
+
+
+class CMSPluginMediaCenterSearchTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def setUp(self):
+        self.root = PictureCategory.objects.create(title="Holidays", slug="holidays", is_published=True)
+        self.category = PictureCategory.objects.create(title="Summer at the seaside", slug="summer",
+                                                       is_published=True, parent=self.root)
+        self.picture = Picture.objects.create(folder=self.category, image_id=1, title="Sunset",
+                                              description="Sunset over the lighthouse")
+
+    def test_search_path_leaves_every_slug_to_the_categories(self):
+        from django.core.urlresolvers import resolve
+
+        self.assertEqual(resolve('/search/', urlconf='cmsplugin_media_center.urls').url_name, 'picture_category')
+        self.assertEqual(resolve('/+search/', urlconf='cmsplugin_media_center.urls').url_name, 'picture_search')
+
+    def test_search_finds_shown_categories_and_pictures_by_prefix(self):
+        self.assertEqual(list(PictureCategory.objects.search('seasi')), [self.category])
+        self.assertEqual(list(Picture.objects.search('lightho sun')), [self.picture])
+        self.assertEqual(list(Picture.objects.search('sunrise')), [])
+
+    def test_search_skips_content_of_hidden_categories(self):
+        self.root.is_published = False
+        self.root.save()
+        self.assertEqual(list(PictureCategory.objects.search('seaside')), [])
+        self.assertEqual(list(Picture.objects.search('lighthouse')), [])
+
+    def test_deleted_and_renamed_content_is_not_found(self):
+        self.picture.title = self.picture.description = 'Moonrise'
+        self.picture.save()
+        self.assertEqual(list(Picture.objects.search('sunset')), [])
+        self.assertEqual(list(Picture.objects.search('moon')), [self.picture])
+        self.picture.delete()
+        self.assertEqual(list(Picture.objects.search('moon')), [])
+
+    def test_rebuild_command_indexes_everything(self):
+        from django.core.management import call_command
+
+        out = StringIO()
+        call_command('media_center_rebuild_search', stdout=out)
+        self.assertIn('Indexed %d categories and pictures' % (
+            PictureCategory.objects.count() + Picture.objects.count()), out.getvalue())
+        self.assertEqual(list(Picture.objects.search('sunset')), [self.picture])
+
+
+class CMSPluginMediaCenterDuplicatesTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def set_hash(self, pk, value):
+        from cmsplugin_media_center.models import phash_fields
+        Picture.objects.filter(pk=pk).update(**phash_fields(value))
+
+    def test_near_duplicates_within_the_distance(self):
+        value = 0xF0F0F0F0F0F0F0F0
+        self.set_hash(1, value)
+        self.set_hash(2, value ^ 0b111)  # 3 bits in the last part
+        self.set_hash(3, value ^ (1 << 63) ^ (1 << 40) ^ (1 << 20) ^ 1)  # 4 bits, one in every part
+
+        self.assertEqual([picture.pk for picture in Picture.objects.near_duplicates(value)], [1, 2])
+        self.assertEqual([picture.pk for picture in Picture.objects.get(pk=1).near_duplicates()], [2])
+        self.assertEqual(Picture.objects.get(pk=1).phash_value, value)
+
+    def test_near_duplicates_of_a_page_in_one_query(self):
+        from cmsplugin_media_center.admin import set_near_duplicates
+
+        value, other = 0xF0F0F0F0F0F0F0F0, 0x0F0F0F0F0F0F0F0F
+        self.set_hash(1, value)
+        self.set_hash(2, value ^ 0b111)
+        self.set_hash(3, other)
+        pictures = list(Picture.objects.filter(pk__in=[1, 2, 3]).order_by('pk'))
+        with self.assertNumQueries(1):
+            set_near_duplicates(pictures)
+        self.assertEqual([[duplicate.pk for duplicate in picture._near_duplicates] for picture in pictures],
+                         [[2], [1], []])
+
+    def test_distance_the_index_can_not_find_is_refused(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from django.test.utils import override_settings
+
+        with override_settings(MEDIA_CENTER_DUPLICATE_DISTANCE=4):
+            self.assertRaises(ImproperlyConfigured, Picture.objects.near_duplicates, 0)
+        self.assertRaises(ValueError, Picture.objects.near_duplicates, 0, 4)
+
+    def test_resized_copy_has_a_close_hash(self):
+        from cmsplugin_media_center.utils.images import PILImage, dhash, hamming
+
+        image = PILImage.new('RGB', (320, 240))
+        for x in range(320):
+            for y in range(240):
+                image.putpixel((x, y), (x % 256, y, (x * y) % 256))
+        self.assertLessEqual(hamming(dhash(image), dhash(image.resize((160, 120)))), 3)
+
+
+class CMSPluginMediaCenterExportImportTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def snapshot(self):
+        categories = PictureCategory.objects.exclude(slug__startswith='old-')
+        return (list(categories.order_by('tree_id', 'lft').values_list(
+                    'slug', 'parent__slug', 'level', 'lft', 'rght', 'is_visible')),
+                sorted(Picture.objects.filter(folder__in=categories).values_list('folder__slug', 'image', 'title')))
+
+    def rename_existing(self):
+        for pk, slug in PictureCategory.objects.values_list('pk', 'slug'):
+            PictureCategory.objects.filter(pk=pk).update(slug='old-%s' % slug)
+
+    def test_export_and_import_restore_the_gallery(self):
+        import os
+        import tempfile
+        from django.core.management import call_command
+
+        before = self.snapshot()
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'gallery.jsonl')
+        checkpoint = os.path.join(directory, 'checkpoint.json')
+        call_command('media_center_export', output=path, stderr=StringIO())
+        self.rename_existing()
+
+        call_command('media_center_import', path, checkpoint=checkpoint, batch_size=2, stdout=StringIO())
+        self.assertEqual(self.snapshot(), before)
+        self.assertTrue(os.path.exists(checkpoint))
+
+        # Running it again with the finished checkpoint imports nothing more
+        call_command('media_center_import', path, checkpoint=checkpoint, stdout=StringIO())
+        self.assertEqual(self.snapshot(), before)
+
+    def test_resume_after_a_batch_committed_without_its_checkpoint(self):
+        import io
+        import json
+        import os
+        import tempfile
+        from django.core.management import call_command
+
+        before = self.snapshot()
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'gallery.jsonl')
+        checkpoint = os.path.join(directory, 'checkpoint.json')
+        call_command('media_center_export', output=path, stderr=StringIO())
+        self.rename_existing()
+        call_command('media_center_import', path, checkpoint=checkpoint, stdout=StringIO())
+
+        # Interrupted between the commit of the only batch and the write of the checkpoint
+        with io.open(checkpoint, encoding='utf-8') as f:
+            state = json.load(f)
+        with io.open(checkpoint, 'w', encoding='utf-8') as f:
+            f.write(u'%s' % json.dumps(dict(state, line=1, skipped=0)))
+        call_command('media_center_import', path, checkpoint=checkpoint, stdout=StringIO())
+        self.assertEqual(self.snapshot(), before)
+
+    def test_import_refuses_existing_categories(self):
+        import os
+        import tempfile
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+
+        path = os.path.join(tempfile.mkdtemp(), 'gallery.jsonl')
+        call_command('media_center_export', output=path, stderr=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('media_center_import', path, stdout=StringIO())
+
+    def test_import_refuses_unknown_parents(self):
+        import io
+        import json
+        import os
+        import tempfile
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from cmsplugin_media_center.management.commands.media_center_export import FORMAT, VERSION
+
+        path = os.path.join(tempfile.mkdtemp(), 'gallery.jsonl')
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(u'%s\n' % json.dumps({'format': FORMAT, 'version': VERSION}))
+            f.write(u'%s\n' % json.dumps({'model': 'category', 'slug': 'orphan', 'parent': 'missing',
+                                           'title': 'Orphan', 'level': 1, 'lft': 2, 'rght': 3, 'tree_id': 1}))
+        with self.assertRaises(CommandError):
+            call_command('media_center_import', path, stdout=StringIO())
+
+    def test_skip_duplicates_within_the_file(self):
+        import os
+        import tempfile
+        from django.core.management import call_command
+        from cmsplugin_media_center.models import phash_fields
+
+        value = 0xF0F0F0F0F0F0F0F0
+        Picture.objects.filter(pk=1).update(**phash_fields(value))
+        Picture.objects.filter(pk=2).update(**phash_fields(value ^ 1))
+        path = os.path.join(tempfile.mkdtemp(), 'gallery.jsonl')
+        call_command('media_center_export', output=path, stderr=StringIO())
+        Picture.objects.all().delete()
+        self.rename_existing()
+
+        out = StringIO()
+        call_command('media_center_import', path, skip_duplicates=True, stdout=out)
+        self.assertIn('Imported 1 categories and 4 pictures, skipped 1 pictures', out.getvalue())
+
+
+class CMSPluginMediaCenterChangeFeedTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def setUp(self):
+        from cmsplugin_media_center.models import Change
+
+        self.since = Change.objects.order_by('-seq').values_list('seq', flat=True)[:1]
+        self.since = self.since[0] if self.since else 0
+        self.root = PictureCategory.objects.create(title="Holidays", slug="holidays", is_published=True)
+        self.category = PictureCategory.objects.create(title="Summer", slug="summer",
+                                                       is_published=True, parent=self.root)
+        self.picture = Picture.objects.create(folder=self.category, image_id=1, title="Sunset")
+
+    def changes(self, since, limit=500):
+        import json
+        from django.test.client import RequestFactory
+        from cmsplugin_media_center.views import changes_view
+
+        response = changes_view(RequestFactory().get('/', {'since': since, 'limit': limit}))
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_changes_are_compacted_per_object(self):
+        feed = self.changes(self.since)
+        self.assertFalse(feed['has_more'])
+        items = dict(((item['kind'], item['id']), item) for item in feed['changes'])
+        self.assertEqual(len(feed['changes']), 3)
+        self.assertEqual(set(items), set([
+            ('category', self.root.pk), ('category', self.category.pk), ('picture', self.picture.pk)]))
+        self.assertEqual(items['picture', self.picture.pk]['title'], 'Sunset')
+        self.assertEqual(items['category', self.category.pk]['parent'], self.root.pk)
+        self.assertEqual(self.changes(feed['last_seq'])['changes'], [])
+
+    def test_visibility_cascade_and_deletes_are_in_the_feed(self):
+        since = self.changes(self.since)['last_seq']
+        self.picture.delete()
+        feed = self.changes(since)
+        removed = set((item['kind'], item['id']) for item in feed['changes'] if item.get('removed'))
+        # Without pictures the categories are hidden, their content leaves the feed
+        self.assertEqual(removed, set([
+            ('picture', self.picture.pk), ('category', self.category.pk), ('category', self.root.pk)]))
+
+    def test_hiding_and_showing_an_ancestor_records_its_subtree(self):
+        since = self.changes(self.since)['last_seq']
+        self.root.is_published = False
+        self.root.save()
+        feed = self.changes(since)
+        removed = set((item['kind'], item['id']) for item in feed['changes'] if item.get('removed'))
+        self.assertEqual(removed, set([
+            ('picture', self.picture.pk), ('category', self.category.pk), ('category', self.root.pk)]))
+
+        self.root.is_published = True
+        self.root.save()
+        items = dict(((item['kind'], item['id']), item) for item in self.changes(feed['last_seq'])['changes'])
+        self.assertEqual(items['picture', self.picture.pk]['title'], 'Sunset')
+        self.assertNotIn('removed', items['category', self.category.pk])
+
+    def test_limit_and_gaps(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from cmsplugin_media_center.models import Change
+
+        feed = self.changes(self.since, limit=1)
+        self.assertTrue(feed['has_more'])
+        self.assertEqual(len(feed['changes']), 1)
+
+        # A young hole may still be filled by a running transaction
+        last = Change.objects.order_by('-seq')[0]
+        Change.objects.filter(seq=last.seq - 1).delete()
+        self.assertEqual([change.seq for change in Change.objects.since(last.seq - 2)], [])
+        # The client is told to come back for the changes behind the hole
+        feed = self.changes(last.seq - 2)
+        self.assertEqual(feed['changes'], [])
+        self.assertEqual(feed['last_seq'], last.seq - 2)
+        self.assertTrue(feed['has_more'])
+        Change.objects.filter(seq=last.seq).update(created_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual([change.seq for change in Change.objects.since(last.seq - 2)], [last.seq])
+
+    def test_compact_keeps_the_last_change_of_every_object(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from cmsplugin_media_center.models import Change
+
+        self.picture.save()
+        self.picture.save()
+        Change.objects.compact(timezone.now() + timedelta(seconds=1))
+        self.assertEqual(Change.objects.filter(kind='picture', object_id=self.picture.pk).count(), 1)
+        self.assertIn(self.picture.pk, [item['id'] for item in self.changes(0)['changes'] if item['kind'] == 'picture'])
+
+
+@override_settings(MEDIA_CENTER_VIEW_COUNTS=True)
+class CMSPluginMediaCenterViewCountsTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def setUp(self):
+        from cmsplugin_media_center import counters
+
+        counters.flush()
+        self.root = PictureCategory.objects.create(title="Holidays", slug="holidays", is_published=True)
+        self.first = Picture.objects.create(folder=self.root, image_id=1, title="First")
+        self.second = Picture.objects.create(folder=self.root, image_id=1, title="Second")
+
+    def test_views_are_written_in_batches(self):
+        from cmsplugin_media_center import counters
+
+        for picture in (self.first, self.second, self.second):
+            counters.count('picture', picture.pk)
+        counters.count('category', self.root.pk)
+        self.assertEqual(Picture.objects.get(pk=self.second.pk).views, 0)
+
+        self.assertEqual(counters.flush(), 4)
+        self.assertEqual(Picture.objects.get(pk=self.first.pk).views, 1)
+        self.assertEqual(Picture.objects.get(pk=self.second.pk).views, 2)
+        self.assertEqual(PictureCategory.objects.get(pk=self.root.pk).views, 1)
+        self.assertEqual(counters.flush(), 0)
+
+    def test_save_keeps_the_counted_views(self):
+        from cmsplugin_media_center import counters
+
+        counters.count('picture', self.first.pk)
+        counters.flush()
+        self.first.title = 'Renamed'
+        self.first.save()
+        self.assertEqual(Picture.objects.get(pk=self.first.pk).views, 1)
+
+    def test_most_viewed_and_popular_ordering(self):
+        from cmsplugin_media_center.cms_plugins import categories_queryset
+
+        hidden = PictureCategory.objects.create(title="Drafts", slug="drafts", is_published=False)
+        PictureCategory.objects.filter(pk=hidden.pk).update(views=100)
+        PictureCategory.objects.filter(pk=self.root.pk).update(views=10)
+        self.assertEqual(PictureCategory.objects.most_viewed(1), [PictureCategory.objects.get(pk=self.root.pk)])
+        self.assertEqual(list(categories_queryset('thumbnails', ordering='popular'))[0].pk, self.root.pk)
+
+    def test_seen_view_counts_shown_pictures_only(self):
+        from django.http import Http404
+        from django.test.client import RequestFactory
+        from cmsplugin_media_center import counters
+        from cmsplugin_media_center.views import picture_seen_view
+
+        request = RequestFactory().post('/')
+        self.assertEqual(picture_seen_view(request, 'holidays', str(self.first.pk)).status_code, 204)
+        with self.assertRaises(Http404):
+            picture_seen_view(request, 'other', str(self.first.pk))
+        counters.flush()
+        self.assertEqual(Picture.objects.get(pk=self.first.pk).views, 1)
+
+    def test_counting_is_off_by_default(self):
+        from django.http import Http404
+        from django.test.client import RequestFactory
+        from cmsplugin_media_center import counters
+        from cmsplugin_media_center.views import picture_seen_view
+
+        with override_settings(MEDIA_CENTER_VIEW_COUNTS=False):
+            counters.count('picture', self.first.pk)
+            with self.assertRaises(Http404):
+                picture_seen_view(RequestFactory().post('/'), 'holidays', str(self.first.pk))
+        self.assertEqual(counters.flush(), 0)
+
+
+class CMSPluginMediaCenterPublishTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def setUp(self):
+        from cmsplugin_media_center import publish
+
+        self.root = PictureCategory.objects.create(title="Holidays", slug="holidays", is_published=True)
+        self.category = PictureCategory.objects.create(title="Summer", slug="summer",
+                                                       is_published=True, parent=self.root)
+        self.picture = Picture.objects.create(folder=self.category, image_id=1, title="Sunset")
+        publish.rebuild()
+        while publish.publish():
+            pass
+
+    def published(self, slug):
+        from cmsplugin_media_center.models import PublishedCategory
+
+        categories = list(PublishedCategory.objects.filter(slug=slug))
+        return categories[0] if categories else None
+
+    def test_rebuild_publishes_shown_categories(self):
+        from cmsplugin_media_center.models import PublishedPicture
+
+        category = self.published('summer')
+        self.assertEqual(category.path, 'holidays/summer')
+        self.assertEqual((category.picture_count, category.cover_id), (1, self.picture.pk))
+        self.assertEqual(self.published('holidays').child_count, 1)
+        self.assertEqual(list(PublishedPicture.objects.filter(category_id=category.pk).values_list(
+            'pk', flat=True)), [self.picture.pk])
+
+    def test_changes_are_published_incrementally(self):
+        from cmsplugin_media_center import publish
+
+        self.root.slug = 'travels'
+        self.root.save()
+        publish.publish()
+        self.assertEqual(self.published('summer').path, 'travels/summer')
+
+        self.root.is_published = False
+        self.root.save()
+        publish.publish()
+        self.assertIsNone(self.published('travels'))
+        self.assertIsNone(self.published('summer'))
+
+        self.root.is_published = True
+        self.root.save()
+        publish.publish()
+        self.assertEqual(self.published('summer').picture_count, 1)
+
+    def test_tree_fields_are_copied_for_the_changed_trees_only(self):
+        from cmsplugin_media_center import publish
+        from cmsplugin_media_center.models import PublishedCategory
+
+        other = PictureCategory.objects.create(title="Work", slug="work", is_published=True)
+        Picture.objects.create(folder=other, image_id=1, title="Desk")
+        publish.publish()
+        PublishedCategory.objects.filter(pk=other.pk).update(lft=100)
+
+        autumn = PictureCategory.objects.create(title="Autumn", slug="autumn", is_published=True, parent=self.root)
+        Picture.objects.create(folder=autumn, image_id=1, title="Leaves")
+        publish.publish()
+        for category in (self.root, self.category, autumn):
+            live = PictureCategory.objects.get(pk=category.pk)
+            self.assertEqual((self.published(category.slug).tree_id, self.published(category.slug).lft),
+                             (live.tree_id, live.lft))
+        self.assertEqual(self.published('work').lft, 100)
+
+    def test_plugin_reads_the_published_tables(self):
+        from django.test.utils import override_settings
+        from cmsplugin_media_center.cms_plugins import categories_queryset, get_category, pictures_queryset
+        from cmsplugin_media_center.models import PublishedCategory
+
+        PictureCategory.objects.filter(pk=self.category.pk).update(title='Unpublished title')
+        with override_settings(MEDIA_CENTER_PUBLISHED_READS=True):
+            category = get_category('summer')
+            self.assertIsInstance(category, PublishedCategory)
+            self.assertEqual(category.title, 'Summer')
+            self.assertEqual([photo.pk for photo in pictures_queryset(category)], [self.picture.pk])
+            covers = [node.get_cover() for node in categories_queryset('thumbnails', category)]
+            self.assertEqual([cover.pk for cover in covers], [self.picture.pk])
+
+    def test_category_tree_filter(self):
+        from cmsplugin_media_center.templatetags.media_center_tags import category_tree
+
+        rows = category_tree([self.root, self.category])
+        self.assertEqual([(node, has_children, len(closes)) for node, has_children, closes in rows],
+                         [(self.root, True, 0), (self.category, False, 1)])
+
+
+class CMSPluginMediaCenterLazyTreeAdminTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def setUp(self):
+        from django.contrib import admin
+        from django.contrib.auth.models import User
+        from cmsplugin_media_center.admin import PictureCategoryAdmin
+
+        self.admin = PictureCategoryAdmin(PictureCategory, admin.site)
+        self.user = User.objects.get(username='admin')
+        self.root = PictureCategory.objects.create(title="Holidays", slug="holidays", is_published=True)
+        self.category = PictureCategory.objects.create(title="Summer", slug="summer",
+                                                       is_published=True, parent=self.root)
+        self.leaf = PictureCategory.objects.create(title="Beach", slug="beach",
+                                                   is_published=True, parent=self.category)
+        Picture.objects.create(folder=self.leaf, image_id=1)
+
+    def tree(self, **params):
+        import json
+        from django.test.client import RequestFactory
+
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        return json.loads(self.admin.tree_view(request).content.decode('utf-8'))
+
+    def test_children_with_picture_counts(self):
+        children = self.tree(parent=self.category.pk)['children']
+        self.assertEqual([(child['id'], child['pictures'], child['has_children']) for child in children],
+                         [(self.leaf.pk, 1, False)])
+        self.assertTrue(self.tree(parent=self.root.pk)['children'][0]['has_children'])
+
+    def test_ancestors_and_search_path(self):
+        from cmsplugin_media_center.admin import set_ancestors
+
+        self.assertEqual(self.tree(ancestors=self.leaf.pk)['ancestors'], [self.root.pk, self.category.pk])
+        leaf = PictureCategory.objects.get(pk=self.leaf.pk)
+        set_ancestors([leaf])
+        self.assertIn('Holidays / Summer / Beach', self.admin.tree_path(leaf))
+
+    def test_title_links_to_the_category(self):
+        from django.test.client import RequestFactory
+        from django.test.utils import override_settings
+
+        request = RequestFactory().get('/')
+        request.user = self.user
+        with override_settings(MEDIA_CENTER_ADMIN_LAZY_TREE=True):
+            list_display = self.admin.get_list_display(request)
+            self.assertEqual(list_display[0], 'tree_toggle')
+            self.assertEqual(self.admin.get_list_display_links(request, list_display), ('title',))
+
+
+class CMSPluginMediaCenterPicturePagesAdminTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def setUp(self):
+        from django.contrib import admin
+        from django.contrib.auth.models import User
+        from cmsplugin_media_center.admin import PictureInline, PICTURES_PER_PAGE
+
+        self.inline = PictureInline(PictureCategory, admin.site)
+        self.user = User.objects.get(username='admin')
+        self.category = PictureCategory.objects.create(title="Summer", slug="summer", is_published=True)
+        Picture.objects.bulk_create([Picture(folder=self.category, image_id=1, title='%d' % i)
+                                     for i in range(PICTURES_PER_PAGE + 5)])
+
+    def request(self, **params):
+        from django.test.client import RequestFactory
+
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        return request
+
+    def page(self, **params):
+        formset = self.inline.get_formset(self.request(**params), self.category)
+        return [picture.title for picture in formset(instance=self.category).get_queryset()]
+
+    def test_one_page_of_pictures(self):
+        from cmsplugin_media_center.admin import PICTURES_PER_PAGE
+
+        self.assertEqual(self.page(), ['%d' % i for i in range(PICTURES_PER_PAGE)])
+        self.assertEqual(self.page(pictures_page=2),
+                         ['%d' % i for i in range(PICTURES_PER_PAGE, PICTURES_PER_PAGE + 5)])
+        self.assertEqual(self.page(pictures_page='x'), self.page())
+
+    def test_thumbnail_of_missing_picture(self):
+        from django.contrib import admin
+        from django.http import Http404
+        from cmsplugin_media_center.admin import PictureCategoryAdmin
+
+        category_admin = PictureCategoryAdmin(PictureCategory, admin.site)
+        self.assertRaises(Http404, category_admin.thumbnail_view, self.request(), 0)
+
+    def test_page_links_keep_the_query_string(self):
+        from django.contrib import admin
+        from django.http import Http404
+        from cmsplugin_media_center.admin import PictureCategoryAdmin
+
+        category_admin = PictureCategoryAdmin(PictureCategory, admin.site)
+        self.assertRaises(Http404, category_admin.change_view, self.request(), 'summer')
+        response = category_admin.change_view(
+            self.request(pictures_page=2, _changelist_filters='q=sum'), str(self.category.pk))
+        self.assertEqual(response.context_data['pictures_page'], 2)
+        self.assertEqual([page for page, query in response.context_data['pictures_pages']], [1, 2])
+        self.assertIn('_changelist_filters=q%3Dsum', response.context_data['pictures_pages'][0][1])
+
+
+class CMSPluginMediaCenterReorderTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def setUp(self):
+        self.root = PictureCategory.objects.create(title="Holidays", slug="holidays", is_published=True)
+        self.children = [PictureCategory.objects.create(title=slug, slug=slug, is_published=True, parent=self.root)
+                         for slug in ('spring', 'summer', 'autumn')]
+        self.leaf = PictureCategory.objects.create(title="Beach", slug="beach", is_published=True,
+                                                   parent=self.children[1])
+        self.pictures = [Picture.objects.create(folder=self.leaf, image_id=1, title='%d' % i) for i in range(3)]
+
+    def tree(self):
+        tree_id = PictureCategory.objects.get(pk=self.root.pk).tree_id
+        return list(PictureCategory.objects.filter(tree_id=tree_id).order_by('lft').values_list('slug', 'level'))
+
+    def test_reorder_children_shifts_subtrees(self):
+        spring, summer, autumn = self.children
+        moved = PictureCategory.objects.reorder(self.root, [autumn.pk, summer.pk, spring.pk])
+        self.assertEqual(sorted(moved), sorted([autumn.pk, spring.pk]))
+        self.assertEqual(self.tree(), [('holidays', 0), ('autumn', 1), ('summer', 1), ('beach', 2), ('spring', 1)])
+        beach = PictureCategory.objects.get(pk=self.leaf.pk)
+        self.assertEqual([category.slug for category in beach.get_ancestors()], ['holidays', 'summer'])
+        self.assertRaises(ValueError, PictureCategory.objects.reorder, self.root, [autumn.pk, summer.pk])
+
+    def test_reorder_roots(self):
+        other = PictureCategory.objects.create(title="Work", slug="work", is_published=True)
+        PictureCategory.objects.reorder(None, [other.pk, self.root.pk])
+        self.assertEqual(list(PictureCategory.objects.filter(parent=None).values_list('slug', flat=True)),
+                         ['work', 'holidays'])
+        self.assertEqual(self.tree()[0], ('holidays', 0))
+
+    def test_reorder_pictures(self):
+        first, second, third = self.pictures
+        self.assertEqual(Picture.objects.reorder(self.leaf, [third.pk, first.pk, second.pk]),
+                         [third.pk, first.pk, second.pk])
+        self.assertEqual([picture.title for picture in self.leaf.pictures.all()], ['2', '0', '1'])
+        new = Picture.objects.create(folder=self.leaf, image_id=1, title='3')
+        self.assertEqual(list(self.leaf.pictures.all())[-1], new)
+        self.assertRaises(ValueError, Picture.objects.reorder, self.leaf, [first.pk])
+
+    def test_reorder_is_published(self):
+        from cmsplugin_media_center import publish
+        from cmsplugin_media_center.models import PublishedCategory
+
+        publish.rebuild()
+        while publish.publish():
+            pass
+        spring, summer, autumn = self.children
+        PictureCategory.objects.reorder(self.root, [summer.pk, spring.pk, autumn.pk])
+        while publish.publish():
+            pass
+        self.assertEqual(list(PublishedCategory.objects.values_list('slug', flat=True)),
+                         ['holidays', 'summer', 'beach'])
+        self.assertEqual(list(PublishedCategory.objects.values_list('lft', flat=True)),
+                         list(PictureCategory.objects.filter(slug__in=['holidays', 'summer', 'beach']).values_list(
+                             'lft', flat=True)))
+
+
+class CMSPluginMediaCenterBulkTreeTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def setUp(self):
+        self.root = PictureCategory.objects.create(title="Holidays", slug="holidays", is_published=True)
+        self.summer = PictureCategory.objects.create(title="Summer", slug="summer", is_published=True,
+                                                     parent=self.root)
+        Picture.objects.create(folder=self.summer, image_id=1)
+
+    def assertValidTree(self):
+        for category in PictureCategory.objects.all():
+            descendants = PictureCategory.objects.filter(tree_id=category.tree_id, lft__gt=category.lft,
+                                                         rght__lt=category.rght).count()
+            self.assertEqual(category.rght - category.lft, 2 * descendants + 1)
+            if category.parent_id:
+                parent = PictureCategory.objects.get(pk=category.parent_id)
+                self.assertEqual((category.tree_id, category.level), (parent.tree_id, parent.level + 1))
+                self.assertTrue(parent.lft < category.lft < category.rght < parent.rght)
+
+    def test_bulk_add(self):
+        winter = PictureCategory(title="Winter", slug="winter", is_published=True, parent=self.root)
+        snow = PictureCategory(title="Snow", slug="snow", is_published=True, parent=winter)
+        work = PictureCategory(title="Work", slug="work", is_published=True)
+        pks = PictureCategory.objects.bulk_add([winter, snow, work])
+        self.assertEqual(pks, [winter.pk, snow.pk, work.pk])
+        self.assertValidTree()
+        root = PictureCategory.objects.get(pk=self.root.pk)
+        self.assertEqual([category.slug for category in root.get_descendants()], ['summer', 'winter', 'snow'])
+        self.assertNotEqual(PictureCategory.objects.get(pk=work.pk).tree_id, root.tree_id)
+
+        Picture.objects.create(folder_id=snow.pk, image_id=1)
+        self.assertTrue(PictureCategory.objects.get(pk=winter.pk).is_visible)
+
+    def test_bulk_move(self):
+        winter = PictureCategory.objects.create(title="Winter", slug="winter", is_published=True)
+        PictureCategory.objects.bulk_move({self.summer.pk: winter.pk})
+        self.assertValidTree()
+        self.assertTrue(PictureCategory.objects.get(pk=winter.pk).is_visible)
+        self.assertFalse(PictureCategory.objects.get(pk=self.root.pk).is_visible)
+
+        PictureCategory.objects.bulk_move({self.summer.pk: None})
+        self.assertValidTree()
+        self.assertEqual(PictureCategory.objects.filter(parent=None).count(), 3)
+
+        self.assertRaises(ValueError, PictureCategory.objects.bulk_move, {winter.pk: winter.pk})
+
+
+class CMSPluginMediaCenterPictureDetailTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def setUp(self):
+        self.category = PictureCategory.objects.create(title="Summer", slug="summer", is_published=True)
+        self.pictures = [Picture.objects.create(folder=self.category, image_id=1, title='%d' % i) for i in range(3)]
+
+    def adjacent(self, picture, ordering='tree'):
+        from cmsplugin_media_center.cms_plugins import adjacent_pictures, pictures_queryset
+
+        pictures = pictures_queryset(self.category, ordering)
+        return tuple(adjacent.pk if adjacent else None for adjacent in adjacent_pictures(
+            pictures, pictures.get(pk=picture.pk), ordering))
+
+    def test_previous_and_next_in_tree_order(self):
+        first, second, third = self.pictures
+        self.assertEqual(self.adjacent(first), (None, second.pk))
+        self.assertEqual(self.adjacent(second), (first.pk, third.pk))
+        Picture.objects.reorder(self.category, [third.pk, first.pk, second.pk])
+        self.assertEqual(self.adjacent(third), (None, first.pk))
+        self.assertEqual(self.adjacent(second), (first.pk, None))
+
+    def test_previous_and_next_in_popular_order(self):
+        first, second, third = self.pictures
+        Picture.objects.filter(pk=second.pk).update(views=5)
+        self.assertEqual(self.adjacent(second, 'popular'), (None, first.pk))
+        self.assertEqual(self.adjacent(first, 'popular'), (second.pk, third.pk))
+
+    def test_shown_category_is_cached(self):
+        from django.core.cache import cache
+
+        cache.delete('cmsplugin_media_center:shown:summer')
+        self.assertEqual(PictureCategory.objects.get_shown('summer'), self.category)
+        with self.assertNumQueries(1):
+            PictureCategory.objects.get_shown('summer')
+        PictureCategory.objects.filter(pk=self.category.pk).update(slug='winter')
+        self.assertRaises(PictureCategory.DoesNotExist, PictureCategory.objects.get_shown, 'summer')
+
+    def test_hidden_and_moved_categories_are_forgotten(self):
+        from django.core.cache import cache
+
+        cache.delete('cmsplugin_media_center:shown:summer')
+        hidden = PictureCategory.objects.create(title="Drafts", slug="drafts", is_published=False)
+        PictureCategory.objects.get_shown('summer')
+        self.category.parent = hidden
+        self.category.save()
+        self.assertRaises(PictureCategory.DoesNotExist, PictureCategory.objects.get_shown, 'summer')
+
+        self.category.parent = None
+        self.category.save()
+        self.assertEqual(PictureCategory.objects.get_shown('summer'), self.category)
+        self.category.is_published = False
+        self.category.save()
+        self.assertRaises(PictureCategory.DoesNotExist, PictureCategory.objects.get_shown, 'summer')
+
+
+class CMSPluginMediaCenterSitemapTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+    urls = 'cmsplugin_media_center.urls'
+
+    def setUp(self):
+        self.category = PictureCategory.objects.create(title="Holidays", slug="holidays", is_published=True)
+        self.picture = Picture.objects.create(folder=self.category, image_id=1)
+        hidden = PictureCategory.objects.create(title="Drafts", slug="drafts")
+        Picture.objects.create(folder=hidden, image_id=1)
+
+    def test_entries_of_shown_categories_and_pictures(self):
+        from cmsplugin_media_center import sitemaps
+
+        categories = sitemaps.shown_categories()
+        self.assertEqual([path for path, lastmod in sitemaps.entries('categories', 1, categories)], ['/holidays/'])
+        pictures = list(sitemaps.entries('pictures', 1, categories))
+        self.assertEqual([path for path, lastmod in pictures], ['/holidays/%d/' % self.picture.pk])
+        self.assertIsNotNone(pictures[0][1])
+        self.assertEqual(list(sitemaps.entries('pictures', 2, categories)), [])
+
+    def test_command_writes_the_sitemaps_and_their_index(self):
+        import io
+        import os
+        import shutil
+        import tempfile
+        from django.core.management import call_command
+
+        directory = tempfile.mkdtemp()
+        try:
+            call_command('media_center_sitemap', output_dir=directory, base_url='http://example.com/',
+                         stdout=StringIO())
+            with io.open(os.path.join(directory, 'sitemap.xml'), encoding='utf-8') as f:
+                self.assertIn('<loc>http://example.com/sitemap-pictures-1.xml</loc>', f.read())
+            with io.open(os.path.join(directory, 'sitemap-pictures-1.xml'), encoding='utf-8') as f:
+                self.assertIn('<loc>http://example.com/holidays/%d/</loc>' % self.picture.pk, f.read())
+        finally:
+            shutil.rmtree(directory)
+
+
+class CMSPluginMediaCenterTrackedFieldsTests(TestCase):
+
+    fixtures = ['auth_fixtures', 'filer_fixtures', 'media_center_fixtures']
+
+    def setUp(self):
+        self.root = PictureCategory.objects.create(title="Holidays", slug="holidays", is_published=True)
+        self.category = PictureCategory.objects.create(title="Summer", slug="summer", is_published=True,
+                                                       parent=self.root)
+        self.picture = Picture.objects.create(folder=self.category, image_id=1)
+
+    def fail_visibility(self):
+        self.fail('The visibility must not be computed')
+
+    def test_editorial_save_skips_visibility(self):
+        category = PictureCategory.objects.get(pk=self.category.pk)
+        self.assertEqual(category.changed_fields(), [])
+        category.check_visibility = self.fail_visibility
+        category.title = 'Summer 2014'
+        category.save()
+
+        del category.check_visibility
+        category.is_published = False
+        self.assertEqual(category.changed_fields(), ['is_published'])
+        category.save()
+        self.assertFalse(PictureCategory.objects.get(pk=self.category.pk).is_visible)
+        self.assertFalse(PictureCategory.objects.get(pk=self.root.pk).is_visible)
+
+    def test_editorial_picture_save_does_not_load_the_folder(self):
+        picture = Picture.objects.get(pk=self.picture.pk)
+        picture.title = 'Sunset'
+        picture.save()
+        folder_cache = Picture._meta.get_field('folder').get_cache_name()
+        self.assertNotIn(folder_cache, picture.__dict__)
+
+    def test_moving_a_category_refreshes_its_old_parent(self):
+        other = PictureCategory.objects.create(title="Work", slug="work", is_published=True)
+        category = PictureCategory.objects.get(pk=self.category.pk)
+        category.parent = other
+        category.save()
+        self.assertFalse(PictureCategory.objects.get(pk=self.root.pk).is_visible)
+        self.assertTrue(PictureCategory.objects.get(pk=other.pk).is_visible)
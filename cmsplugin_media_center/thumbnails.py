@@ -0,0 +1,102 @@
+from easy_thumbnails.files import get_thumbnailer
+
+from cmsplugin_media_center.conf import settings
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    import Image as PILImage
+
+
+# Options of the thumbnails in the templates, the same as {% thumbnail photo.image 200x200 %}
+THUMBNAIL_OPTIONS = {'size': (200, 200)}
+
+MIME_TYPES = {
+    'webp': 'image/webp',
+    'avif': 'image/avif',
+}
+
+
+def thumbnail_formats():
+    """
+    THUMBNAIL_FORMATS that the installed PIL can write, the others are skipped
+    """
+    PILImage.init()
+    formats = []
+    for extension in settings.THUMBNAIL_FORMATS:
+        if PILImage.EXTENSION.get('.%s' % extension) in PILImage.SAVE:
+            formats.append(extension)
+    return formats
+
+
+def scaled(options, scale):
+    options = dict(options)
+    options['size'] = tuple(dimension * scale for dimension in options['size'])
+    return options
+
+
+def variants(options=THUMBNAIL_OPTIONS):
+    """
+    Yields (extension, scale, options) of every thumbnail of a picture.
+    The extension is None for the JPEG/PNG fallback, which comes first.
+    """
+    for extension in [None] + thumbnail_formats():
+        for scale in settings.THUMBNAIL_SCALES:
+            yield extension, scale, scaled(options, scale)
+
+
+def get_thumbnail(image, options, extension=None):
+    """
+    Thumbnail of a filer image, in the format of the given extension or
+    the one easy_thumbnails picks for the source.
+    """
+    thumbnailer = get_thumbnailer(image)
+    if extension is None:
+        return thumbnailer.get_thumbnail(options)
+    # The thumbnailer can be the file of the image, do not leave it changed
+    saved = (thumbnailer.thumbnail_extension, thumbnailer.thumbnail_transparency_extension,
+             thumbnailer.thumbnail_preserve_extensions)
+    thumbnailer.thumbnail_extension = thumbnailer.thumbnail_transparency_extension = extension
+    thumbnailer.thumbnail_preserve_extensions = False
+    try:
+        return thumbnailer.get_thumbnail(options)
+    finally:
+        (thumbnailer.thumbnail_extension, thumbnailer.thumbnail_transparency_extension,
+         thumbnailer.thumbnail_preserve_extensions) = saved
+
+
+def variant_alias(extension, options):
+    return '%s-%dx%d' % (extension or 'default', options['size'][0], options['size'][1])
+
+
+def thumbnail_urls(image, urls=None, options=THUMBNAIL_OPTIONS):
+    """
+    [(extension, scale, url)] of every variant of a filer image.
+    URLs found in urls, {(image pk, alias): url} as returned by
+    ThumbnailURL.objects.for_images, are used without asking the storage,
+    the other thumbnails are generated and their URLs stored.
+    """
+    from cmsplugin_media_center.models import ThumbnailURL  # models imports this module
+    if urls is None:
+        urls = ThumbnailURL.objects.for_images([image])
+    result = []
+    for extension, scale, variant_options in variants(options):
+        alias = variant_alias(extension, variant_options)
+        url = urls.get((image.pk, alias))
+        if url is None:
+            url = get_thumbnail(image, variant_options, extension).url
+            ThumbnailURL.objects.store(image, alias, url)
+        result.append((extension, scale, url))
+    return result
+
+
+def generate_thumbnails(images, options=THUMBNAIL_OPTIONS):
+    """
+    Generates the thumbnails of the given filer images ahead of time
+    so the first render of the gallery does not have to.
+    """
+    count = 0
+    for image in images:
+        # Ignore the stored URLs, the thumbnail files may be gone
+        count += len(thumbnail_urls(image, urls={}, options=options))
+    return count
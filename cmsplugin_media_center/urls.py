@@ -1,9 +1,15 @@
 from django.conf.urls import patterns, url
 
-from cmsplugin_media_center.views import picture_view
+from cmsplugin_media_center.views import (
+    category_zip_view, picture_detail_view, picture_seen_view, picture_view, search_view)
 
 
 urlpatterns = patterns(
     '',
+    # "+" is not allowed in slugs, so no category can take the path of the search
+    url(r'^\+search/$', search_view, name='picture_search'),
     url(r'^(?P<category>[\w-]+)/$', picture_view, name='picture_category'),
+    url(r'^(?P<category>[\w-]+)/download/$', category_zip_view, name='picture_category_download'),
+    url(r'^(?P<category>[\w-]+)/(?P<picture>\d+)/$', picture_detail_view, name='picture_detail'),
+    url(r'^(?P<category>[\w-]+)/(?P<picture>\d+)/seen/$', picture_seen_view, name='picture_seen'),
 )
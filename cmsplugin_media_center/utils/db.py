@@ -0,0 +1,120 @@
+import time
+from functools import wraps
+
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+
+from cmsplugin_media_center.conf import settings
+
+
+class _atomic(object):
+    """
+    transaction.atomic for Django 1.5, whose commit_on_success commits the
+    transaction of the caller when it is nested. The outermost block commits
+    or rolls back, a nested one is a savepoint inside the caller's transaction.
+    Backends without savepoints (SQLite on Django 1.5) can not roll back a
+    nested block alone, the caller's transaction is left to decide.
+    """
+    def __init__(self, using=None):
+        self.using = using or DEFAULT_DB_ALIAS
+        self.savepoints = []
+
+    def __enter__(self):
+        if transaction.is_managed(using=self.using):
+            self.savepoints.append(transaction.savepoint(using=self.using))
+            return
+        transaction.enter_transaction_management(using=self.using)
+        transaction.managed(True, using=self.using)
+        self.savepoints.append(None)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sid = self.savepoints.pop()
+        if sid is not None:
+            if exc_type is None:
+                transaction.savepoint_commit(sid, using=self.using)
+            else:
+                transaction.savepoint_rollback(sid, using=self.using)
+            return
+        try:
+            if exc_type is not None:
+                transaction.rollback(using=self.using)
+                return
+            try:
+                transaction.commit(using=self.using)
+            except Exception:
+                transaction.rollback(using=self.using)
+                raise
+        finally:
+            transaction.leave_transaction_management(using=self.using)
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
+
+
+# Django 1.5 does not have transaction.atomic
+atomic = getattr(transaction, 'atomic', None) or _atomic
+
+
+def in_transaction(using):
+    """
+    Whether the code runs inside a transaction opened by atomic
+    (or by commit_on_success and the transaction middleware on Django 1.5)
+    """
+    connection = connections[using]
+    if hasattr(connection, 'in_atomic_block'):
+        return connection.in_atomic_block
+    return transaction.is_managed(using=using)
+
+
+def chunks(items, size=500):
+    """
+    Splits items in lists of at most size elements,
+    keeps `pk__in` lookups under the parameter limits of the backends.
+    """
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def is_deadlock(error):
+    """
+    Deadlocks and serialization failures are reported differently by every backend
+    so we fall back to looking at the error message.
+    """
+    message = str(error).lower()
+    return 'deadlock' in message or 'could not serialize' in message
+
+
+def retry_on_deadlock(retries=3, delay=0.05):
+    """
+    Runs the decorated function in a transaction on MEDIA_CENTER_WRITE_DATABASE
+    and runs it again if the database picked the transaction as a deadlock victim.
+
+    Only a call that opens the transaction is retried. Called inside a
+    transaction (for example the visibility cascade of a category save, or
+    a caller's atomic block) it runs in a savepoint of that transaction and
+    the deadlock goes up to whoever opened it: some databases roll back the
+    whole transaction of the victim.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            using = settings.WRITE_DATABASE
+            if in_transaction(using):
+                with atomic(using=using):
+                    return func(*args, **kwargs)
+            attempt = 0
+            while True:
+                try:
+                    with atomic(using=using):
+                        return func(*args, **kwargs)
+                except DatabaseError as e:
+                    attempt += 1
+                    if attempt > retries or not is_deadlock(e):
+                        raise
+                time.sleep(delay * attempt)
+        return wrapper
+    return decorator
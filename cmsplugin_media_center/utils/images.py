@@ -0,0 +1,119 @@
+import base64
+from datetime import datetime
+from io import BytesIO
+
+from django.conf import settings
+from django.utils.timezone import get_current_timezone, make_aware
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    import Image as PILImage
+
+
+EXIF_DATETIME_ORIGINAL = 0x9003
+PLACEHOLDER_SIZE = (16, 16)
+HASH_SIZE = 8
+HASH_CHUNKS = 4
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+def fit(size, box):
+    """
+    Size of an image of the given size scaled down to fit in box, keeping the aspect ratio
+    """
+    width, height = size
+    scale = min(float(box[0]) / width, float(box[1]) / height, 1)
+    return max(int(round(width * scale)), 1), max(int(round(height * scale)), 1)
+
+
+def exif_datetime(image):
+    try:
+        value = image._getexif()[EXIF_DATETIME_ORIGINAL]
+        taken_at = datetime.strptime(value.strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+    except Exception:
+        # No exif (not a JPEG or stripped) or a broken date
+        return None
+    if getattr(settings, 'USE_TZ', False):
+        taken_at = make_aware(taken_at, get_current_timezone())
+    return taken_at
+
+
+def dominant_color(image):
+    """
+    The most common colour of the image reduced to a small palette, as #rrggbb
+    """
+    small = image.copy()
+    small.thumbnail((64, 64))
+    quantized = small.quantize(colors=8)
+    count, index = max(quantized.getcolors())
+    palette = quantized.getpalette()[index * 3:index * 3 + 3]
+    return '#%02x%02x%02x' % tuple(palette)
+
+
+def placeholder(image):
+    """
+    A tiny blurry version of the image as a data URI, shown while the thumbnail loads
+    """
+    small = image.copy()
+    small.thumbnail(PLACEHOLDER_SIZE)
+    buf = BytesIO()
+    small.save(buf, 'JPEG', quality=40)
+    return 'data:image/jpeg;base64,' + base64.b64encode(buf.getvalue()).decode('ascii')
+
+
+def dhash(image):
+    """
+    64 bit perceptual (difference) hash: every bit tells whether a pixel of
+    a 9x8 grayscale version of the image is brighter than its right neighbour.
+    Resized, recompressed or slightly retouched copies get the same hash or
+    one a few bits away.
+    """
+    small = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), PILImage.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            index = row * (HASH_SIZE + 1) + col
+            value = (value << 1) | (pixels[index] > pixels[index + 1])
+    return value
+
+
+def hash_chunks(value):
+    """
+    The hash split in HASH_CHUNKS parts, most significant first. Two hashes
+    less than HASH_CHUNKS bits apart have at least one equal part.
+    """
+    bits = HASH_BITS // HASH_CHUNKS
+    return [(value >> (HASH_BITS - bits * (index + 1))) & ((1 << bits) - 1) for index in range(HASH_CHUNKS)]
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def image_hash(f):
+    image = PILImage.open(f)
+    image.draft('RGB', (64, 64))
+    return dhash(image.convert('RGB'))
+
+
+def extract_metadata(f):
+    """
+    Reads width, height, capture time, dominant colour, placeholder and
+    perceptual hash from an image file
+    """
+    image = PILImage.open(f)
+    width, height = image.size
+    taken_at = exif_datetime(image)
+    # Let the JPEG decoder skip most of the pixels, we only need a small image
+    image.draft('RGB', (64, 64))
+    image = image.convert('RGB')
+    return {
+        'width': width,
+        'height': height,
+        'taken_at': taken_at,
+        'dominant_color': dominant_color(image),
+        'placeholder': placeholder(image),
+        'phash': dhash(image),
+    }
@@ -0,0 +1,22 @@
+class TrackedFieldsMixin(object):
+    """
+    Remembers the values of the tracked_fields (attnames) of a model instance
+    as they were loaded or last saved, so save and the signal receivers can
+    tell what actually changed. Fields deferred when the instance was loaded
+    count as changed once they are set.
+    """
+    tracked_fields = ()
+
+    def __init__(self, *args, **kwargs):
+        super(TrackedFieldsMixin, self).__init__(*args, **kwargs)
+        self.reset_tracked_fields()
+
+    def reset_tracked_fields(self):
+        self._tracked = dict((name, self.__dict__[name]) for name in self.tracked_fields if name in self.__dict__)
+
+    def initial_value(self, name):
+        return self._tracked.get(name)
+
+    def changed_fields(self):
+        return [name for name in self.tracked_fields if name in self.__dict__ and (
+            name not in self._tracked or self.__dict__[name] != self._tracked[name])]
@@ -0,0 +1,155 @@
+"""
+ZIP archives written as a stream of chunks.
+
+The members are stored (pictures do not compress anyway) and their CRC is
+written after the data, so nothing is buffered but one chunk at a time.
+Because the sizes of the members are known up front the size of the whole
+archive is known before the first byte is sent.
+"""
+import struct
+import zlib
+
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_MARKER = 0xFFFFFFFF  # the real value is in the zip64 extra field
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+
+FLAGS = 0x08 | 0x800  # sizes and crc in a data descriptor, utf-8 names
+VERSION = 20
+VERSION_ZIP64 = 45
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+DESCRIPTOR = struct.Struct('<IIII')
+DESCRIPTOR_ZIP64 = struct.Struct('<IIQQ')
+LOCAL_EXTRA_ZIP64 = struct.Struct('<HHQQ')
+CENTRAL_EXTRA_ZIP64 = struct.Struct('<HHQQQ')
+END_RECORD = struct.Struct('<IHHHHIIH')
+END_RECORD_ZIP64 = struct.Struct('<IQHHIIQQQQ')
+END_LOCATOR_ZIP64 = struct.Struct('<IIQI')
+
+
+class ZipMember(object):
+    """
+    name - path of the file in the archive
+    size - size of the file in bytes
+    date_time - datetime of the last modification
+    open - callable returning a file-like object with the content
+    """
+    def __init__(self, name, size, date_time, open):
+        self.name = name.encode('utf-8') if not isinstance(name, bytes) else name
+        self.size = size
+        self.date_time = date_time
+        self.open = open
+        self.offset = 0
+        self.crc = 0
+
+    @property
+    def zip64(self):
+        return self.size >= ZIP64_LIMIT or self.offset >= ZIP64_LIMIT
+
+    @property
+    def dos_time(self):
+        dt = self.date_time
+        if dt is None or dt.year < 1980:
+            return 0, (1 << 5) | 1
+        return ((dt.hour << 11) | (dt.minute << 5) | (dt.second // 2),
+                ((dt.year - 1980) << 9) | (dt.month << 5) | dt.day)
+
+    def local_header(self):
+        dos_time, dos_date = self.dos_time
+        extra = LOCAL_EXTRA_ZIP64.pack(1, 16, 0, 0) if self.zip64 else b''
+        size = ZIP64_MARKER if self.zip64 else 0
+        return LOCAL_HEADER.pack(
+            0x04034b50, VERSION_ZIP64 if self.zip64 else VERSION, FLAGS, 0, dos_time, dos_date,
+            0, size, size, len(self.name), len(extra)) + self.name + extra
+
+    def descriptor(self):
+        if self.zip64:
+            return DESCRIPTOR_ZIP64.pack(0x08074b50, self.crc, self.size, self.size)
+        return DESCRIPTOR.pack(0x08074b50, self.crc, self.size, self.size)
+
+    def central_header(self):
+        dos_time, dos_date = self.dos_time
+        if self.zip64:
+            extra = CENTRAL_EXTRA_ZIP64.pack(1, 24, self.size, self.size, self.offset)
+            size = offset = ZIP64_MARKER
+            version = VERSION_ZIP64
+        else:
+            extra, size, offset, version = b'', self.size, self.offset, VERSION
+        return CENTRAL_HEADER.pack(
+            0x02014b50, version, version, FLAGS, 0, dos_time, dos_date,
+            self.crc, size, size, len(self.name), len(extra), 0, 0, 0, 0, offset) + self.name + extra
+
+    def length(self):
+        """
+        Bytes of the member in the archive: local header, data and descriptor
+        """
+        return (LOCAL_HEADER.size + len(self.name) + (LOCAL_EXTRA_ZIP64.size if self.zip64 else 0) +
+                self.size + (DESCRIPTOR_ZIP64.size if self.zip64 else DESCRIPTOR.size))
+
+    def central_length(self):
+        return CENTRAL_HEADER.size + len(self.name) + (CENTRAL_EXTRA_ZIP64.size if self.zip64 else 0)
+
+
+class ZipStream(object):
+    """
+    Iterating over it yields the archive in chunks of at most chunk_size bytes
+    (plus the headers). `size` is the exact length of the archive.
+    """
+    def __init__(self, members, chunk_size=64 * 1024):
+        self.members = list(members)
+        self.chunk_size = chunk_size
+        offset = 0
+        for member in self.members:
+            member.offset = offset
+            offset += member.length()
+        self.central_offset = offset
+        self.central_size = sum(member.central_length() for member in self.members)
+
+    @property
+    def zip64(self):
+        return (len(self.members) >= ZIP_FILECOUNT_LIMIT or
+                self.central_offset >= ZIP64_LIMIT or self.central_size >= ZIP64_LIMIT)
+
+    @property
+    def size(self):
+        end = END_RECORD.size
+        if self.zip64:
+            end += END_RECORD_ZIP64.size + END_LOCATOR_ZIP64.size
+        return self.central_offset + self.central_size + end
+
+    def __iter__(self):
+        for member in self.members:
+            yield member.local_header()
+            crc, written = 0, 0
+            f = member.open()
+            try:
+                while True:
+                    chunk = f.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    written += len(chunk)
+                    crc = zlib.crc32(chunk, crc)
+                    yield chunk
+            finally:
+                f.close()
+            if written != member.size:
+                # The headers already promised another size, there is no way to recover
+                raise IOError('%s changed while it was archived: expected %d bytes, got %d' % (
+                    member.name, member.size, written))
+            member.crc = crc & 0xFFFFFFFF
+            yield member.descriptor()
+
+        for member in self.members:
+            yield member.central_header()
+
+        count = len(self.members)
+        if self.zip64:
+            yield END_RECORD_ZIP64.pack(
+                0x06064b50, END_RECORD_ZIP64.size - 12, VERSION_ZIP64, VERSION_ZIP64, 0, 0,
+                count, count, self.central_size, self.central_offset)
+            yield END_LOCATOR_ZIP64.pack(0x07064b50, 0, self.central_offset + self.central_size, 1)
+        yield END_RECORD.pack(
+            0x06054b50, 0, 0, min(count, ZIP_FILECOUNT_LIMIT), min(count, ZIP_FILECOUNT_LIMIT),
+            min(self.central_size, ZIP64_MARKER), min(self.central_offset, ZIP64_MARKER), 0)
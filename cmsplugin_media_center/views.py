@@ -1,4 +1,18 @@
+import json
+import os
+
+from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, StreamingHttpResponse
 from django.shortcuts import render
+from django.views.decorators.csrf import csrf_exempt
+
+from cmsplugin_media_center import counters, metrics, sitemaps
+from cmsplugin_media_center.conf import settings
+from cmsplugin_media_center.models import Change, Picture, PictureCategory, PublishedCategory, PublishedPicture
+from cmsplugin_media_center.utils.zipstream import ZipMember, ZipStream
+
+
+CHANGES_LIMIT = 1000
 
 
 def picture_view(request, category=None):
@@ -9,3 +23,202 @@ def picture_view(request, category=None):
             'category': category,
         })
     return render(request, page.get_template(), context)
+
+
+def picture_detail_view(request, category, picture):
+    """
+    Renders the page of the apphook for one picture of a category, the gallery
+    plugin shows it with links to the previous and the next picture
+    """
+    page = request.current_page
+    return render(request, page.get_template(), {
+        'category': category,
+        'picture': picture,
+    })
+
+
+def search_view(request):
+    """
+    Renders the page of the apphook with the search results, the gallery
+    plugin shows them instead of the categories
+    """
+    page = request.current_page
+    return render(request, page.get_template(), {
+        'search_query': request.GET.get('q', '').strip(),
+    })
+
+
+@csrf_exempt
+def picture_seen_view(request, category, picture):
+    """
+    Counts a view of a picture of a shown category, for the lightbox to POST
+    to when it opens the picture. Nothing is written before the counters flush.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    if not settings.VIEW_COUNTS:
+        raise Http404
+    if settings.PUBLISHED_READS:
+        if not PublishedPicture.objects.filter(
+                pk=picture, category_id__in=PublishedCategory.objects.filter(slug=category).values('pk')).exists():
+            raise Http404
+    else:
+        folders = Picture.objects.filter(pk=picture, folder__slug=category).values_list('folder', flat=True)[:1]
+        if not folders or not PictureCategory.objects.shown_pks(folders):
+            raise Http404
+    counters.count('picture', int(picture))
+    return HttpResponse(status=204)
+
+
+def category_zip_view(request, category):
+    """
+    Streams a ZIP archive with the original images of a shown category.
+    With ?recursive=1 the visible subcategories are added as directories.
+    """
+    try:
+        category = PictureCategory.objects.get_visible(slug=category)
+    except PictureCategory.DoesNotExist:
+        raise Http404
+
+    categories = list(category.get_visible_descendants()) if request.GET.get('recursive') else [category]
+    paths = {}
+    for node in categories:
+        parent_path = paths.get(node.parent_id)
+        paths[node.pk] = '%s/%s' % (parent_path, node.slug) if parent_path else node.slug
+
+    members, names = [], set()
+    # The subtree as a range of the tree, not one parameter per subcategory
+    pictures = Picture.objects.filter(
+        folder__tree_id=category.tree_id, folder__lft__gte=category.lft,
+        folder__rght__lte=category.rght) if len(categories) > 1 else Picture.objects.filter(folder=category)
+    for picture in pictures.select_related('image').order_by('folder', 'pk').iterator():
+        if picture.folder_id not in paths:
+            # In a subcategory that is not shown
+            continue
+        image = picture.image
+        if not image.file or not image.is_public:
+            continue
+        name = '%s/%s' % (paths[picture.folder_id], image.original_filename or os.path.basename(image.file.name))
+        base, ext = os.path.splitext(name)
+        index = 1
+        while name in names:
+            index += 1
+            name = '%s (%d)%s' % (base, index, ext)
+        names.add(name)
+        size = image._file_size if image._file_size is not None else image.file.size
+        members.append(ZipMember(name, size, image.modified_at,
+                                 lambda f=image.file: f.storage.open(f.name, 'rb')))
+
+    archive = ZipStream(members)
+    response = StreamingHttpResponse(iter(archive), content_type='application/zip')
+    response['Content-Length'] = str(archive.size)
+    response['Content-Disposition'] = 'attachment; filename="%s.zip"' % category.slug
+    return response
+
+
+def sitemap_index_view(request):
+    """
+    Index of the media center sitemaps, see cmsplugin_media_center.sitemaps
+    """
+    locations = [request.build_absolute_uri(reverse(sitemap_view, args=(section, number)))
+                 for section in sorted(sitemaps.SECTIONS)
+                 for number in range(1, sitemaps.sitemap_count(section) + 1)]
+    return StreamingHttpResponse(sitemaps.sitemap_index(locations), content_type='application/xml')
+
+
+def sitemap_view(request, section, number):
+    number = int(number)
+    if section not in sitemaps.SECTIONS or not 1 <= number <= sitemaps.sitemap_count(section):
+        raise Http404
+    entries = sitemaps.entries(section, number, sitemaps.shown_categories())
+    base_url = request.build_absolute_uri('/')[:-1]
+    return StreamingHttpResponse(sitemaps.urlset(entries, base_url), content_type='application/xml')
+
+
+def metrics_view(request):
+    """
+    Media center metrics in the Prometheus text format.
+    It is not part of the apphook urls, add it to the project urls:
+
+        url(r'^media-center-metrics/$', 'cmsplugin_media_center.views.metrics_view')
+    """
+    if not metrics.enabled():
+        raise Http404
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def change_payloads(changes):
+    """
+    Current state of the changed objects, keyed by (kind, pk). Deleted and
+    hidden objects are left out: the feed must not publish hidden content.
+    """
+    pks = {'category': set(), 'picture': set()}
+    for change in changes:
+        if not change.deleted:
+            pks[change.kind].add(change.object_id)
+    pictures = Picture.objects.filter(pk__in=pks['picture']).select_related('image')
+    pictures = dict((picture.pk, picture) for picture in pictures)
+    categories = PictureCategory.objects.in_bulk(pks['category'])
+    shown = PictureCategory.objects.shown_pks(
+        pks['category'] | set(picture.folder_id for picture in pictures.values()))
+
+    payloads = {}
+    for pk, category in categories.items():
+        if pk in shown:
+            payloads['category', pk] = {
+                'parent': category.parent_id,
+                'slug': category.slug,
+                'title': category.title,
+                'description': category.description,
+            }
+    for pk, picture in pictures.items():
+        if picture.folder_id in shown:
+            payloads['picture', pk] = {
+                'category': picture.folder_id,
+                'image': picture.image.url,
+                'title': picture.title,
+                'description': picture.description,
+                'is_cover': picture.is_cover,
+            }
+    return payloads
+
+
+def changes_view(request):
+    """
+    Changes of the categories and pictures after ?since=<seq>, at most
+    ?limit=<n> of them, as JSON. Every object appears once with its current
+    state, or with "removed": true if it was deleted or is not shown anymore.
+    Clients keep "last_seq" for the next request and ask again while
+    "has_more" is true; starting from since=0 gives the whole gallery.
+    It is not part of the apphook urls, add it to the project urls:
+
+        url(r'^media-center-changes/$', 'cmsplugin_media_center.views.changes_view')
+    """
+    try:
+        since = max(int(request.GET.get('since', 0)), 0)
+        limit = min(max(int(request.GET.get('limit', 500)), 1), CHANGES_LIMIT)
+    except ValueError:
+        return HttpResponseBadRequest('since and limit must be integers')
+
+    changes = Change.objects.since(since, limit)
+    latest = {}
+    for change in changes:
+        latest[change.kind, change.object_id] = change
+    payloads = change_payloads(latest.values())
+
+    items = []
+    for key, change in sorted(latest.items(), key=lambda item: item[1].seq):
+        item = {'seq': change.seq, 'kind': change.kind, 'id': change.object_id}
+        if key in payloads:
+            item.update(payloads[key])
+        else:
+            item['removed'] = True
+        items.append(item)
+
+    last_seq = changes[-1].seq if changes else since
+    return HttpResponse(json.dumps({
+        'changes': items,
+        'last_seq': last_seq,
+        # since() may stop before a gap with newer changes behind it
+        'has_more': Change.objects.filter(seq__gt=last_seq).exists(),
+    }), content_type='application/json')
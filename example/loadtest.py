@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+Load test of the gallery pages.
+
+Seeds a generated gallery (see the media_center_generate command), serves the
+example project with a local threaded WSGI server and requests random category
+pages with both skins, first with a cold and then with a hot cache. Prints the
+latency percentiles, the throughput and the queries per request of every scenario.
+
+The database of the settings module must be migrated first:
+
+    python example/manage.py syncdb --migrate --settings=example.settings.cms3_0_X
+    python example/loadtest.py --settings=example.settings.cms3_0_X --seed-gallery --requests=500
+
+Run it with the same options before and after a configuration change
+(caching, indexes, a read replica...) to compare them.
+"""
+from __future__ import print_function
+
+import optparse
+import os
+import random
+import sys
+import threading
+import time
+
+try:
+    from urllib2 import urlopen, HTTPError
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+
+try:
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from socketserver import ThreadingMixIn
+
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+
+SKINS = ('list', 'thumbnails')
+PAGE_SLUG = 'loadtest-%s'
+
+
+def parse_args():
+    parser = optparse.OptionParser(usage='%prog [options]', description=__doc__.strip().split('\n\n')[0])
+    parser.add_option('--settings', default='example.settings.cms3_0_X')
+    parser.add_option('--seed-gallery', action='store_true', default=False,
+                      help='Generate a gallery before the test, see also --depth, --branching, --pictures.')
+    parser.add_option('--depth', type='int', default=3)
+    parser.add_option('--branching', type='int', default=4)
+    parser.add_option('--pictures', type='int', default=40)
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--requests', type='int', default=200,
+                      help='Requests per scenario (default: 200).')
+    parser.add_option('--concurrency', type='int', default=8,
+                      help='Concurrent clients (default: 8).')
+    parser.add_option('--port', type='int', default=8765)
+    return parser.parse_args()[0]
+
+
+def setup_django(settings):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.environ['DJANGO_SETTINGS_MODULE'] = settings
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+
+
+def get_placeholder(page, slot):
+    from cms.models import Placeholder
+    if hasattr(page, 'rescan_placeholders'):
+        page.rescan_placeholders()
+    try:
+        return page.placeholders.get(slot=slot)
+    except Placeholder.DoesNotExist:
+        placeholder = Placeholder.objects.create(slot=slot)
+        page.placeholders.add(placeholder)
+        return placeholder
+
+
+def publish(page, language):
+    try:
+        page.publish(language)
+    except TypeError:
+        # django CMS 2.4
+        page.publish()
+
+
+def seed(options):
+    """
+    Generates the gallery and a page with the gallery apphook for every skin
+    """
+    from cms.api import add_plugin, create_page
+    from cms.models import Title
+    from django.conf import settings
+    from django.core.management import call_command
+
+    if options.seed_gallery:
+        call_command('media_center_generate', depth=options.depth, branching=options.branching,
+                     pictures=options.pictures, seed=options.seed, prefix='loadtest')
+
+    language = settings.LANGUAGE_CODE
+    for skin in SKINS:
+        slug = PAGE_SLUG % skin
+        if Title.objects.filter(slug=slug).exists():
+            continue
+        page = create_page(slug, settings.CMS_TEMPLATES[0][0], language, slug=slug,
+                           apphook='PicturesHook', published=True)
+        add_plugin(get_placeholder(page, 'media'), 'CMSMediaPlugin', language, template=skin)
+        publish(page, language)
+
+
+class ThreadedWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def counting_queries(application):
+    """
+    Adds a X-Queries header with the number of queries the request made
+    """
+    from django.db import connection
+
+    def wrapper(environ, start_response):
+        connection.use_debug_cursor = True
+        captured = []
+        response = application(environ, lambda status, headers, *args: captured.append((status, headers, args)))
+        body = b''.join(response)
+        if hasattr(response, 'close'):
+            response.close()
+        status, headers, args = captured[0]
+        start_response(status, headers + [('X-Queries', str(len(connection.queries)))], *args)
+        return [body]
+    return wrapper
+
+
+def serve(port):
+    from django.core.wsgi import get_wsgi_application
+    server = make_server('127.0.0.1', port, counting_queries(get_wsgi_application()),
+                         server_class=ThreadedWSGIServer, handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def run_scenario(base_url, skin, slugs, options, cold):
+    from django.core.cache import cache
+
+    rng = random.Random(options.seed)
+    urls = ['%s/%s/%s/' % (base_url, PAGE_SLUG % skin, rng.choice(slugs)) for _ in range(options.requests)]
+    latencies, queries, errors = [], [], []
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if not urls:
+                    return
+                url = urls.pop()
+            if cold:
+                cache.clear()
+            started = time.time()
+            try:
+                response = urlopen(url)
+                response.read()
+                count = int(response.info().get('X-Queries', 0))
+            except HTTPError as e:
+                with lock:
+                    errors.append(e.code)
+                continue
+            elapsed = time.time() - started
+            with lock:
+                latencies.append(elapsed)
+                queries.append(count)
+
+    started = time.time()
+    clients = [threading.Thread(target=client) for _ in range(options.concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    wall = time.time() - started
+
+    if not latencies:
+        print('%-10s %-4s all %d requests failed: %s' % (skin, 'cold' if cold else 'hot', len(errors), errors[:5]))
+        return
+    print('%-10s %-4s %6d %8.1f %8.1f %8.1f %8.1f %8.1f %6d' % (
+        skin, 'cold' if cold else 'hot', len(latencies),
+        percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000, percentile(latencies, 99) * 1000,
+        len(latencies) / wall, float(sum(queries)) / len(queries), len(errors)))
+
+
+def main():
+    options = parse_args()
+    setup_django(options.settings)
+    seed(options)
+
+    from cmsplugin_media_center.models import PictureCategory
+    slugs = list(PictureCategory.objects.whole_tree().values_list('slug', flat=True))
+    if not slugs:
+        sys.exit('There are no visible categories, run it with --seed-gallery.')
+
+    server = serve(options.port)
+    base_url = 'http://127.0.0.1:%d' % options.port
+    print('%-10s %-4s %6s %8s %8s %8s %8s %8s %6s' % (
+        'skin', 'cache', 'ok', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'queries', 'errors'))
+    try:
+        for skin in SKINS:
+            for cold in (True, False):
+                run_scenario(base_url, skin, slugs, options, cold)
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()